@@ -0,0 +1,129 @@
+"""
+In-memory audio ingestion for voice and audio messages.
+"""
+
+import io
+import os
+import asyncio
+import logging
+
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+# Formats the Whisper API accepts as-is
+WHISPER_FORMATS = {"flac", "m4a", "mp3", "mp4", "mpeg", "mpga", "oga", "ogg", "wav", "webm"}
+
+# Container formats for common Telegram audio mime types
+MIME_FORMATS = {
+    "audio/ogg": "ogg",
+    "audio/opus": "ogg",
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/mp4": "m4a",
+    "audio/m4a": "m4a",
+    "audio/x-m4a": "m4a",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/flac": "flac",
+    "audio/x-flac": "flac",
+    "audio/webm": "webm",
+    "audio/aac": "aac",
+    "audio/amr": "amr",
+    "audio/x-ms-wma": "wma",
+}
+
+# Upper bound on processes used for transcoding
+AUDIO_MAX_WORKERS = int(os.environ.get("AUDIO_MAX_WORKERS", 2))
+
+# Bitrate of synthesized voice replies
+VOICE_BITRATE = os.environ.get("VOICE_BITRATE", "32k")
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=AUDIO_MAX_WORKERS)
+    return _executor
+
+
+def _transcode(data, source_format, target_format, codec=None):
+    """Convert audio bytes between formats. Runs in a worker process."""
+    from pydub import AudioSegment
+
+    segment = AudioSegment.from_file(io.BytesIO(data), format=source_format)
+    output = io.BytesIO()
+    segment.export(output, format=target_format, codec=codec)
+    return output.getvalue()
+
+
+async def transcode(data, source_format, target_format, codec=None):
+    """Convert audio bytes in the bounded process pool."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_get_executor(), _transcode, data, source_format, target_format, codec)
+
+
+def _concatenate(parts, source_format, target_format, codec=None, bitrate=None):
+    """Join audio clips and convert them. Runs in a worker process."""
+    from pydub import AudioSegment
+
+    combined = AudioSegment.empty()
+    for data in parts:
+        combined += AudioSegment.from_file(io.BytesIO(data), format=source_format)
+    output = io.BytesIO()
+    combined.export(output, format=target_format, codec=codec, bitrate=bitrate)
+    return output.getvalue()
+
+
+async def encode_voice(parts, source_format="mp3"):
+    """Join clips into one OGG/Opus file, the format of Telegram voice messages."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_get_executor(), _concatenate, parts, source_format, "ogg", "libopus", VOICE_BITRATE)
+
+
+def detect_format(file_name=None, mime_type=None):
+    """Guess the container format from a file name or mime type."""
+    if file_name and "." in file_name:
+        return file_name.rsplit(".", 1)[1].lower()
+    if mime_type:
+        return MIME_FORMATS.get(mime_type.split(";")[0].strip().lower())
+    return None
+
+
+async def download_attachment(message):
+    """Download a voice or audio attachment into memory."""
+    file = await message.effective_attachment.get_file()
+    buffer = io.BytesIO()
+    await file.download_to_memory(out=buffer)
+    return buffer.getvalue()
+
+
+async def prepare_for_transcription(data, file_name=None, mime_type=None):
+    """Return a named in-memory file Whisper can consume.
+
+    Audio already in a Whisper format is passed through untouched; anything
+    else is converted to mp3 in the process pool.
+    """
+    source_format = detect_format(file_name, mime_type) or "ogg"
+    if source_format not in WHISPER_FORMATS:
+        logger.info(f"Transcoding {source_format} audio to mp3")
+        with metrics.span("audio.transcode", source_format=source_format):
+            data = await transcode(data, source_format, "mp3")
+        source_format = "mp3"
+
+    audio_file = io.BytesIO(data)
+    # The OpenAI client infers the format from the file name
+    audio_file.name = f"audio.{source_format}"
+    return audio_file
+
+
+def shutdown():
+    """Stop the transcoding workers."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
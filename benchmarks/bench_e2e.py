@@ -0,0 +1,246 @@
+"""
+Offline end-to-end benchmark of the bot's handlers.
+
+Drives the real message_handler, document_handler and
+Prompter.generate_response with synthetic Updates against local stand-ins
+for Telegram, OpenAI, ElevenLabs and the search tools, using a temporary
+working directory for Chroma and the caches. Reports throughput,
+p50/p95/p99 latency and peak RSS for every scenario, concurrency level and
+document size, as JSON.
+
+Usage:
+    python benchmarks/bench_e2e.py --concurrency 1 8 32 --doc-kb 10 200 --output e2e.json
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeElevenLabs, FakeOpenAI, FakeSearch, FakeTelegramRequest, UpdateFactory, fake_document, fake_text  # noqa: E402
+
+SCENARIOS = ["text", "voice", "generate_response", "document"]
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0.0
+
+
+class MemorySampler():
+    """Track the peak RSS of the process while a run is going on."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            self.peak = max(self.peak, rss_bytes())
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = rss_bytes()
+        self._task = asyncio.create_task(self._sample())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.peak = max(self.peak, rss_bytes())
+
+
+class Bench():
+    def __init__(self, args):
+        self.args = args
+        self.openai = FakeOpenAI(
+            latencies={"completions": args.completion_latency, "embeddings": args.embedding_latency,
+                       "transcriptions": args.whisper_latency, "images": args.image_latency},
+            tool_ratio=args.tool_ratio, answer_words=args.answer_words).start()
+        self.telegram = FakeTelegramRequest(latency=args.telegram_latency)
+        self.elevenlabs = FakeElevenLabs(latency=args.tts_latency)
+        self.chat_ids = iter(range(1000000, 2000000))
+
+    async def setup(self):
+        # Point the clients at the stand-ins before the bot modules read their settings
+        os.environ["OPENAI_API_BASE"] = self.openai.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+        if not self.args.keep_rate_limits:
+            for name in ("OPENAI_COMPLETIONS_RPM", "OPENAI_COMPLETIONS_TPM", "OPENAI_EMBEDDINGS_RPM", "OPENAI_EMBEDDINGS_TPM",
+                         "OPENAI_WHISPER_RPM", "OPENAI_IMAGES_RPM", "ELEVENLABS_TTS_RPM", "ELEVENLABS_TTS_CPM"):
+                os.environ[f"RATE_LIMIT_{name}"] = ""
+
+        import openai
+        from telegram import Bot
+        from telegram.ext import Application, ContextTypes
+
+        import prompter
+        import speech
+        import telegram_bot
+
+        openai.api_base = self.openai.base_url
+        speech.elevenlabs = self.elevenlabs
+        searches = {name: FakeSearch(name, latency=self.args.search_latency) for name in ("wikipedia", "google", "wolframalpha")}
+        prompter._wikipedia = lambda: searches["wikipedia"]
+        prompter._google_search = lambda: searches["google"]
+        prompter._wolframalpha = lambda: searches["wolframalpha"]
+
+        self.prompter = prompter
+        self.telegram_bot = telegram_bot
+        self.context_types = ContextTypes
+        self.bot = Bot("123456:bench", request=self.telegram, get_updates_request=FakeTelegramRequest(latency=0))
+        self.application = Application.builder().bot(self.bot).build()
+        await self.application.initialize()
+        await telegram_bot.on_startup(self.application)
+        # Measure a warmed-up bot, the cold start is not part of the scenarios
+        await telegram_bot.warm_up_task
+        self.updates = UpdateFactory(self.bot, self.telegram)
+
+        self.message_handler = telegram_bot.scheduler.serialize(telegram_bot.message_handler)
+        self.document_handler = telegram_bot.scheduler.serialize(telegram_bot.document_handler)
+
+    async def teardown(self):
+        await self.telegram_bot.on_shutdown(self.application)
+        await self.application.shutdown()
+        self.openai.stop()
+
+    def _context(self, update):
+        return self.context_types.DEFAULT_TYPE.from_update(update, self.application)
+
+    async def _text(self, chat_id, index):
+        update = self.updates.text(chat_id, f"Question {chat_id}-{index}: " + fake_text(index, 12))
+        await self.message_handler(update, self._context(update))
+
+    async def _voice(self, chat_id, index):
+        update = self.updates.voice(chat_id, os.urandom(self.args.voice_kb * 1024))
+        await self.message_handler(update, self._context(update))
+
+    async def _generate_response(self, chat_id, index):
+        await self.prompter.Prompter(chat_id=chat_id).generate_response(
+            message=f"Question {chat_id}-{index}: " + fake_text(index, 12), chat_context=[])
+
+    def _document_job(self, size_bytes):
+        async def job(chat_id, index):
+            data = fake_document(f"{chat_id}-{index}", size_bytes).encode("utf-8")
+            update = self.updates.document(chat_id, f"document{index}.txt", data)
+            # Done once the summary (or the failure notice) is sent
+            done = self.telegram.wait_for(chat_id, ("Summary of the document", "Sorry"))
+            await self.document_handler(update, self._context(update))
+            await done
+        return job
+
+    async def run(self, name, job, concurrency, count):
+        """Run count jobs, concurrency chats at a time, and collect the figures."""
+        errors_before = self.telegram.errors
+        latencies = []
+        failures = 0
+        queue = asyncio.Queue()
+        for index in range(count):
+            queue.put_nowait(index)
+
+        async def worker():
+            nonlocal failures
+            chat_id = next(self.chat_ids)
+            while not queue.empty():
+                index = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    await asyncio.wait_for(job(chat_id, index), self.args.timeout)
+                except Exception as e:
+                    failures += 1
+                    logging.getLogger(__name__).warning(f"{name} job failed: {e!r}")
+                latencies.append(time.perf_counter() - start)
+
+        with MemorySampler() as memory:
+            start = time.perf_counter()
+            await asyncio.gather(*[worker() for _ in range(concurrency)])
+            elapsed = time.perf_counter() - start
+
+        return {
+            "scenario": name,
+            "concurrency": concurrency,
+            "count": count,
+            "seconds": elapsed,
+            "throughput_per_second": count / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "peak_rss_bytes": memory.peak,
+            "errors": failures + self.telegram.errors - errors_before,
+        }
+
+    async def main(self):
+        await self.setup()
+        results = []
+        try:
+            for concurrency in self.args.concurrency:
+                for scenario in self.args.scenarios:
+                    if scenario == "document":
+                        for size_kb in self.args.doc_kb:
+                            result = await self.run(scenario, self._document_job(size_kb * 1024), concurrency, self.args.documents)
+                            result["doc_kb"] = size_kb
+                            results.append(result)
+                            print(json.dumps(result), file=sys.stderr)
+                        continue
+                    job = {"text": self._text, "voice": self._voice, "generate_response": self._generate_response}[scenario]
+                    result = await self.run(scenario, job, concurrency, self.args.messages)
+                    results.append(result)
+                    print(json.dumps(result), file=sys.stderr)
+        finally:
+            await self.teardown()
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the bot's handlers.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--messages", type=int, default=64, help="messages per text, voice and generate_response run")
+    parser.add_argument("--documents", type=int, default=8, help="documents per document run")
+    parser.add_argument("--doc-kb", nargs="+", type=int, default=[10, 200])
+    parser.add_argument("--voice-kb", type=int, default=32)
+    parser.add_argument("--tool-ratio", type=float, default=0.3, help="share of agent inputs answered with a tool call")
+    parser.add_argument("--answer-words", type=int, default=60)
+    parser.add_argument("--completion-latency", type=float, default=0.3)
+    parser.add_argument("--embedding-latency", type=float, default=0.1)
+    parser.add_argument("--whisper-latency", type=float, default=0.5)
+    parser.add_argument("--image-latency", type=float, default=1.0)
+    parser.add_argument("--tts-latency", type=float, default=0.8)
+    parser.add_argument("--search-latency", type=float, default=0.4)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=300, help="seconds before a single job counts as failed")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="keep the configured provider rate limits")
+    parser.add_argument("--output", help="write the results to this file as well")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory(prefix="bench-e2e-") as workdir:
+        # Chroma, the caches and the conversation store all use relative paths
+        os.chdir(workdir)
+        # The agent runs verbosely, keep stdout for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results = asyncio.run(Bench(args).main())
+
+    output = json.dumps({"config": vars(args), "results": results}, indent=2)
+    if output_path:
+        with open(output_path, "w") as output_file:
+            output_file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Compare query latency and memory of the storage backends with many tenants.
+
+Every backend is populated with random unit vectors in one process and
+queried from a fresh one, so the memory figures include what opening the
+store costs. Results are printed as JSON.
+
+Usage:
+    python benchmarks/bench_storage.py --tenants 10000 --chunks 20 --output storage.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKENDS = ["collections", "shared", "mmap"]
+
+
+def rss_bytes():
+    """Current resident set size of this process."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0.0
+
+
+def open_backend(kind, root):
+    """Open a backend storing its data under root."""
+    from storage import CollectionBackend, MmapBackend, SharedCollectionBackend
+
+    if kind == "mmap":
+        return MmapBackend(root=os.path.join(root, "vectors")), None
+
+    import chromadb
+    from chromadb.config import Settings
+    from persistence import PersistenceManager
+
+    settings = Settings(chroma_db_impl="duckdb+parquet", persist_directory=os.path.join(root, "db"), anonymized_telemetry=False)
+    client = chromadb.Client(settings)
+    persistence = PersistenceManager(persist_directory=settings.persist_directory, dirty_threshold=sys.maxsize,
+                                     journal_path=os.path.join(root, "db", "journal.jsonl"))
+    persistence.bind(client)
+    backend_class = SharedCollectionBackend if kind == "shared" else CollectionBackend
+    return backend_class(client, persistence=persistence), persistence
+
+
+def random_vectors(rng, n, dim):
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def tenant_name(index):
+    # Chroma collection names need at least three characters
+    return f"chat{index:06d}"
+
+
+def populate(args):
+    rng = np.random.default_rng(args.seed)
+    backend, persistence = open_backend(args.worker, args.root)
+    start = time.perf_counter()
+    for index in range(args.tenants):
+        vectors = random_vectors(rng, args.chunks, args.dim)
+        ids = [f"{index}-{row}" for row in range(args.chunks)]
+        documents = [f"chunk {row} of chat {index}" for row in range(args.chunks)]
+        metadatas = [{"source": f"doc{index}"} for _ in range(args.chunks)]
+        backend.add(tenant_name(index), ids, vectors.tolist(), documents, metadatas)
+    if persistence is not None:
+        persistence.flush()
+    return {"populate_seconds": time.perf_counter() - start}
+
+
+def query(args):
+    rng = np.random.default_rng(args.seed + 1)
+    sample = random.Random(args.seed)
+    baseline = rss_bytes()
+
+    start = time.perf_counter()
+    backend, _ = open_backend(args.worker, args.root)
+    open_seconds = time.perf_counter() - start
+
+    latencies = []
+    for vector in random_vectors(rng, args.queries, args.dim):
+        tenant = tenant_name(sample.randrange(args.tenants))
+        start = time.perf_counter()
+        backend.search(tenant, vector.tolist(), args.k)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "open_seconds": open_seconds,
+        "query_p50_ms": percentile(latencies, 50) * 1000,
+        "query_p95_ms": percentile(latencies, 95) * 1000,
+        "query_p99_ms": percentile(latencies, 99) * 1000,
+        "rss_bytes": rss_bytes(),
+        "rss_growth_bytes": rss_bytes() - baseline,
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def run_worker(args, kind, phase, root):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", kind, "--phase", phase, "--root", root,
+               "--tenants", str(args.tenants), "--chunks", str(args.chunks), "--dim", str(args.dim),
+               "--queries", str(args.queries), "--k", str(args.k), "--seed", str(args.seed)]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the vector storage backends.")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--tenants", type=int, default=10000)
+    parser.add_argument("--chunks", type=int, default=20, help="chunks per tenant")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file as well")
+    parser.add_argument("--worker", choices=BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument("--phase", choices=["populate", "query"], help=argparse.SUPPRESS)
+    parser.add_argument("--root", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        result = populate(args) if args.phase == "populate" else query(args)
+        print(json.dumps(result))
+        return
+
+    results = {
+        "config": {key: getattr(args, key) for key in ("tenants", "chunks", "dim", "queries", "k", "seed")},
+        "backends": {},
+    }
+    for kind in args.backends:
+        with tempfile.TemporaryDirectory(prefix=f"bench-{kind}-") as root:
+            result = run_worker(args, kind, "populate", root)
+            result.update(run_worker(args, kind, "query", root))
+        results["backends"][kind] = result
+        print(f"{kind}: {json.dumps(result)}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+Local stand-ins for the Telegram Bot API, OpenAI, ElevenLabs and the search
+tools, with configurable latencies, for the offline benchmarks.
+"""
+
+import io
+import re
+import json
+import time
+import asyncio
+import hashlib
+import functools
+import itertools
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from telegram import Update
+from telegram.request import BaseRequest
+
+WORDS = ("the quick brown fox jumps over a lazy dog while seven wizards quietly "
+         "review parsers tokens vectors summaries queues and latency budgets").split()
+
+IMAGE_URL = "https://oaidalleapiprodscus.blob.core.windows.net/bench/image.png"
+
+TOOLS = ["Search User Documents", "Wikipedia", "Google Search", "Wolfram Alpha", "Search All Sources"]
+
+
+def _seed(value):
+    return int.from_bytes(hashlib.sha256(value.encode("utf-8")).digest()[:8], "little")
+
+
+def fake_text(seed, words):
+    """Deterministic filler text of a number of words."""
+    rng = np.random.default_rng(_seed(str(seed)))
+    return " ".join(WORDS[i] for i in rng.integers(0, len(WORDS), words))
+
+
+def fake_document(seed, size_bytes):
+    """Plain text document of about size_bytes with distinct paragraphs."""
+    paragraphs, size = [], 0
+    for index in itertools.count():
+        paragraph = f"Section {seed}.{index}. " + fake_text(f"{seed}-{index}", 60) + "."
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+        if size >= size_bytes:
+            break
+    return "\n\n".join(paragraphs)
+
+
+class FakeOpenAI():
+    """OpenAI-compatible HTTP server for completions, embeddings, Whisper and images.
+
+    Point the openai client at base_url. Agent prompts are answered directly
+    or, for tool_ratio of the inputs, with a tool call first. Every request
+    sleeps for the configured latency of its endpoint before replying.
+    """
+
+    def __init__(self, latencies=None, tool_ratio=0.0, answer_words=60, dim=1536):
+        self.latencies = {"completions": 0.3, "embeddings": 0.1, "transcriptions": 0.5, "images": 1.0, **(latencies or {})}
+        self.tool_ratio = tool_ratio
+        self.answer_words = answer_words
+        self.dim = dim
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/v1"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+                with fake._lock:
+                    fake.requests[endpoint] = fake.requests.get(endpoint, 0) + 1
+                time.sleep(fake.latencies.get(endpoint, 0.0))
+
+                if endpoint == "transcriptions":
+                    return self._json({"text": fake_text(len(body), 12)})
+                if endpoint == "images":
+                    return self._json({"created": int(time.time()), "data": [{"url": IMAGE_URL}]})
+
+                request = json.loads(body)
+                if endpoint == "embeddings":
+                    return self._json(fake.embeddings(request))
+                if endpoint == "completions":
+                    return self._completions(request)
+                self.send_error(404)
+
+            def _json(self, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _completions(self, request):
+                prompts = request["prompt"] if isinstance(request["prompt"], list) else [request["prompt"]]
+                texts = [fake.complete(prompt) for prompt in prompts]
+                if not request.get("stream"):
+                    return self._json({
+                        "id": "cmpl-bench", "object": "text_completion", "created": int(time.time()), "model": request.get("model"),
+                        "choices": [{"text": text, "index": i, "logprobs": None, "finish_reason": "stop"} for i, text in enumerate(texts)],
+                        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                    })
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for token in re.findall(r"\S*\s*", texts[0]):
+                    if not token:
+                        continue
+                    chunk = {"id": "cmpl-bench", "object": "text_completion", "created": int(time.time()), "model": request.get("model"),
+                             "choices": [{"text": token, "index": 0, "logprobs": None, "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def embeddings(self, request):
+        inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        # Token lists and strings both map to a stable unit vector
+        if inputs and isinstance(inputs[0], int):
+            inputs = [inputs]
+        data = []
+        for index, item in enumerate(inputs):
+            vector = np.random.default_rng(_seed(json.dumps(item))).standard_normal(self.dim)
+            data.append({"object": "embedding", "index": index, "embedding": (vector / np.linalg.norm(vector)).tolist()})
+        return {"object": "list", "data": data, "model": request.get("model"), "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+
+    def complete(self, prompt):
+        """Text a model could have produced for the prompt."""
+        if "Do I need to use a tool?" not in prompt:
+            return " " + fake_text(prompt[-200:], self.answer_words)
+        # Routed messages are answered in the agent's format without the agent loop
+        if "New input:" not in prompt:
+            return f"AI: {fake_text(prompt[-200:], self.answer_words)}"
+
+        user_input = prompt.rsplit("New input:", 1)[-1]
+        question = user_input.split("\n", 1)[0].strip()
+        seed = _seed(question)
+        if "Observation:" not in user_input and (seed % 1000) / 1000 < self.tool_ratio:
+            tool = TOOLS[seed % len(TOOLS)]
+            return f"Thought: Do I need to use a tool? Yes\nAction: {tool}\nAction Input: {question}"
+        return f"Thought: Do I need to use a tool? No\nAI: {fake_text(question, self.answer_words)}"
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Telegram Bot API stand-in used as the request backend of a real Bot.
+
+    Replies with plausible results for the methods the handlers call,
+    serves uploaded files for download and records every sent or edited
+    message, so a benchmark can wait for a chat's final reply.
+    """
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.files = {}
+        self.calls = {}
+        self.errors = 0
+        self._message_ids = itertools.count(1)
+        self._waiters = []
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def add_file(self, file_id, data):
+        self.files[file_id] = data
+
+    def wait_for(self, chat_id, prefixes):
+        """Future resolved with the first message for the chat starting with a prefix."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((int(chat_id), tuple(prefixes), future))
+        return future
+
+    def _message(self, chat_id, text=None):
+        message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        if text is not None:
+            message["text"] = text
+        return message
+
+    def _record(self, chat_id, text):
+        if text.startswith(("Sorry", "An error occurred")):
+            self.errors += 1
+        for waiter in list(self._waiters):
+            waiter_chat, prefixes, future = waiter
+            if waiter_chat == chat_id and text.startswith(prefixes):
+                self._waiters.remove(waiter)
+                if not future.done():
+                    future.set_result(text)
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        await asyncio.sleep(self.latency)
+
+        if "/file/bot" in url:
+            return 200, self.files[url.rsplit("/", 1)[-1]]
+
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data is not None else {}
+        chat_id = int(params.get("chat_id", 0) or 0)
+
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files[file_id]), "file_path": f"files/{file_id}"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            text = params.get("text", "")
+            self._record(chat_id, text)
+            result = self._message(chat_id, text)
+        elif endpoint == "sendVoice":
+            self._record(chat_id, "")
+            result = self._message(chat_id)
+            file_id = f"sent{result['message_id']}"
+            result["voice"] = {"file_id": file_id, "file_unique_id": file_id, "duration": 1}
+        elif endpoint in ("sendPhoto", "sendAudio"):
+            self._record(chat_id, "")
+            result = self._message(chat_id)
+        else:
+            result = True
+
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+@functools.lru_cache(maxsize=64)
+def silent_mp3(seconds):
+    """MP3 of silence, decodable like real synthesized speech."""
+    from pydub import AudioSegment
+
+    output = io.BytesIO()
+    AudioSegment.silent(duration=seconds * 1000).export(output, format="mp3")
+    return output.getvalue()
+
+
+class FakeElevenLabs():
+    """Replacement for the elevenlabs module's generate()."""
+
+    def __init__(self, latency=0.8, chars_per_second=15):
+        self.latency = latency
+        self.chars_per_second = chars_per_second
+        self.calls = 0
+
+    def generate(self, text, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        return silent_mp3(max(1, len(text) // self.chars_per_second))
+
+
+class FakeSearch():
+    """Replacement for the Wikipedia, Google and Wolfram Alpha API wrappers."""
+
+    def __init__(self, name, latency=0.4):
+        self.name = name
+        self.latency = latency
+        self.calls = 0
+
+    def run(self, query):
+        self.calls += 1
+        time.sleep(self.latency)
+        return f"{self.name} result for {query}: " + fake_text(query, 80)
+
+
+class UpdateFactory():
+    """Build real telegram Update objects bound to a bot."""
+
+    def __init__(self, bot, telegram_request):
+        self.bot = bot
+        self.telegram_request = telegram_request
+        self._ids = itertools.count(1)
+
+    def _update(self, chat_id, **message):
+        update_id = next(self._ids)
+        data = {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                **message,
+            },
+        }
+        return Update.de_json(data, self.bot)
+
+    def text(self, chat_id, text):
+        return self._update(chat_id, text=text)
+
+    def voice(self, chat_id, data):
+        file_id = f"voice{next(self._ids)}"
+        self.telegram_request.add_file(file_id, data)
+        return self._update(chat_id, voice={"file_id": file_id, "file_unique_id": file_id, "duration": 3, "mime_type": "audio/ogg"})
+
+    def document(self, chat_id, file_name, data, mime_type="text/plain"):
+        file_id = f"document{next(self._ids)}"
+        self.telegram_request.add_file(file_id, data)
+        return self._update(chat_id, document={
+            "file_id": file_id, "file_unique_id": file_id, "file_name": file_name, "mime_type": mime_type, "file_size": len(data)})
@@ -0,0 +1,271 @@
+"""
+Per-chat BM25 keyword index, kept next to the vector store for exact-term retrieval.
+"""
+
+import os
+import re
+import json
+import math
+import zlib
+import heapq
+import shutil
+import struct
+import logging
+import threading
+
+from array import array
+from collections import Counter, OrderedDict
+
+# Where the index of each chat is stored, and how many are kept in memory
+BM25_ROOT = os.environ.get("BM25_ROOT", "bm25")
+BM25_MAX_LOADED = int(os.environ.get("BM25_MAX_LOADED", 256))
+
+# BM25 term frequency saturation and length normalization
+BM25_K1 = float(os.environ.get("BM25_K1", 1.2))
+BM25_B = float(os.environ.get("BM25_B", 0.75))
+
+# A keyword match is confident when its best chunk covers the query terms, weighted
+# by their rarity, scores at least BM25_CONFIDENT_SCORE and leads the next one by BM25_CONFIDENT_MARGIN
+BM25_CONFIDENT_COVERAGE = float(os.environ.get("BM25_CONFIDENT_COVERAGE", 0.9))
+BM25_CONFIDENT_SCORE = float(os.environ.get("BM25_CONFIDENT_SCORE", 3.0))
+BM25_CONFIDENT_MARGIN = float(os.environ.get("BM25_CONFIDENT_MARGIN", 1.5))
+
+# Reciprocal rank fusion constant, higher values flatten the rank differences
+RRF_K = int(os.environ.get("RRF_K", 60))
+
+# Words, numbers and identifiers like E-1234, v1.2.3 or 10.0.0.1
+TOKEN = re.compile(r"\w+(?:[-.:/]\w+)*")
+TOKEN_SEPARATORS = re.compile(r"[-.:/_]")
+STOPWORDS = frozenset("""a an and are as at be but by can could do does did for from had has have how i if in into is it
+its me my no not of on or our so than that the their them then there these they this to was we were what when where
+which who whom why will with would you your""".split())
+
+# Every segment on disk is a length prefix followed by zlib-compressed JSON
+_HEADER = struct.Struct("<I")
+
+logger = logging.getLogger(__name__)
+
+
+def _stem(word):
+    """Strip plural and third person endings of plain words."""
+    if not word.isalpha() or len(word) <= 3:
+        return word
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Lowercase terms without stopwords; compound identifiers also yield their parts."""
+    terms = []
+    for match in TOKEN.finditer(text.lower()):
+        token = match.group()
+        if token in STOPWORDS:
+            continue
+        terms.append(_stem(token))
+        parts = TOKEN_SEPARATORS.split(token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part and part not in STOPWORDS)
+    return terms
+
+
+def fuse_ranks(rankings, k=RRF_K):
+    """Reciprocal rank fusion of ranked id lists, returns (id, score) best first."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def is_confident(hits, min_coverage=BM25_CONFIDENT_COVERAGE, min_score=BM25_CONFIDENT_SCORE, margin=BM25_CONFIDENT_MARGIN):
+    """Whether the best keyword hit is good enough to skip the vector search."""
+    if not hits:
+        return False
+    _, score, coverage = hits[0]
+    if coverage < min_coverage or score < min_score:
+        return False
+    return len(hits) == 1 or score >= margin * hits[1][1]
+
+
+class _Tenant():
+    """In-memory inverted index of one chat, replayed from its segment file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = []
+        self.rows = {}
+        self.lengths = array("I")
+        self.total_length = 0
+        # Rows of deleted chunks, skipped by searches
+        self.deleted = set()
+        # term -> (rows, term frequencies), rows ascending
+        self.postings = {}
+
+        index_path = os.path.join(path, "index.bin")
+        if not os.path.exists(index_path):
+            return
+
+        offset = 0
+        with open(index_path, "rb") as index_file:
+            data = index_file.read()
+        while offset + _HEADER.size <= len(data):
+            (size,) = _HEADER.unpack_from(data, offset)
+            end = offset + _HEADER.size + size
+            if end > len(data):
+                break
+            try:
+                segment = json.loads(zlib.decompress(data[offset + _HEADER.size:end]))
+            except (zlib.error, ValueError):
+                break
+            self.apply(segment)
+            offset = end
+
+        # A torn append is cut off, like the vector files
+        if len(data) > offset:
+            logger.warning(f"Truncating damaged keyword index {index_path} at {offset} bytes")
+            os.truncate(index_path, offset)
+
+    @property
+    def live(self):
+        return len(self.ids) - len(self.deleted)
+
+    def apply(self, segment):
+        for chunk_id in segment.get("deleted", ()):
+            row = self.rows.pop(chunk_id, None)
+            if row is not None:
+                self.deleted.add(row)
+                self.total_length -= self.lengths[row]
+
+        base = len(self.ids)
+        for chunk_id, length in zip(segment.get("ids", ()), segment.get("lengths", ())):
+            self.rows[chunk_id] = len(self.ids)
+            self.ids.append(chunk_id)
+            self.lengths.append(length)
+            self.total_length += length
+
+        for term, pairs in segment.get("terms", {}).items():
+            rows, frequencies = self.postings.get(term) or (array("I"), array("I"))
+            rows.extend(base + row for row in pairs[0::2])
+            frequencies.extend(pairs[1::2])
+            self.postings[term] = (rows, frequencies)
+
+
+class KeywordIndex():
+    """BM25 inverted indexes of all chats, stored as append-only segment files.
+
+    Each add() appends one compressed segment with the new chunks' lengths
+    and postings and fsyncs it, so indexing is incremental and the file is
+    always consistent. A chat's index is replayed into compact arrays on
+    first use and at most max_loaded chats are kept in memory. Chunks are
+    identified by the same ids as in the storage backend, deleting them
+    appends a segment that only lists the deleted ids.
+    """
+
+    def __init__(self, root=BM25_ROOT, max_loaded=BM25_MAX_LOADED, k1=BM25_K1, b=BM25_B):
+        self.root = root
+        self.max_loaded = max_loaded
+        self.k1 = k1
+        self.b = b
+        self._tenants = OrderedDict()
+        self._lock = threading.RLock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, tenant):
+        return os.path.join(self.root, tenant)
+
+    def _tenant(self, tenant):
+        with self._lock:
+            state = self._tenants.get(tenant)
+            if state is None:
+                state = _Tenant(self._path(tenant))
+                self._tenants[tenant] = state
+                while len(self._tenants) > self.max_loaded:
+                    self._tenants.popitem(last=False)
+            else:
+                self._tenants.move_to_end(tenant)
+            return state
+
+    def add(self, tenant, ids, documents):
+        """Index new chunks, ids that are already indexed are skipped."""
+        with self._lock:
+            state = self._tenant(tenant)
+            segment = {"ids": [], "lengths": [], "terms": {}}
+            for chunk_id, document in zip(ids, documents):
+                if chunk_id in state.rows or chunk_id in segment["ids"]:
+                    continue
+                terms = tokenize(document)
+                row = len(segment["ids"])
+                segment["ids"].append(chunk_id)
+                segment["lengths"].append(len(terms))
+                for term, frequency in Counter(terms).items():
+                    segment["terms"].setdefault(term, []).extend((row, frequency))
+            if not segment["ids"]:
+                return 0
+
+            self._append(state, segment)
+            return len(segment["ids"])
+
+    def delete(self, tenant, ids):
+        """Remove chunks from the index, unknown ids are skipped."""
+        with self._lock:
+            state = self._tenant(tenant)
+            deleted = [chunk_id for chunk_id in dict.fromkeys(ids) if chunk_id in state.rows]
+            if deleted:
+                self._append(state, {"deleted": deleted})
+            return len(deleted)
+
+    def _append(self, state, segment):
+        payload = zlib.compress(json.dumps(segment, separators=(",", ":")).encode("utf-8"))
+        os.makedirs(state.path, exist_ok=True)
+        with open(os.path.join(state.path, "index.bin"), "ab") as index_file:
+            index_file.write(_HEADER.pack(len(payload)) + payload)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        state.apply(segment)
+
+    def search(self, tenant, query, n):
+        """Return up to n (chunk_id, score, coverage) hits, best first.
+
+        coverage is the share of the query's IDF the chunk contains, terms
+        that occur in no chunk count with the highest IDF.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        with self._lock:
+            state = self._tenant(tenant)
+            if not terms or not state.live:
+                return []
+
+            count = state.live
+            average_length = state.total_length / count or 1
+            scores = {}
+            matched = {}
+            total_idf = 0.0
+            for term in terms:
+                rows, frequencies = state.postings.get(term) or ((), ())
+                matching = len(rows) - sum(1 for row in rows if row in state.deleted) if state.deleted else len(rows)
+                idf = math.log(1 + (count - matching + 0.5) / (matching + 0.5))
+                total_idf += idf
+                for row, frequency in zip(rows, frequencies):
+                    if row in state.deleted:
+                        continue
+                    norm = frequency + self.k1 * (1 - self.b + self.b * state.lengths[row] / average_length)
+                    scores[row] = scores.get(row, 0.0) + idf * frequency * (self.k1 + 1) / norm
+                    matched[row] = matched.get(row, 0.0) + idf
+
+            best = heapq.nlargest(n, scores.items(), key=lambda item: item[1])
+            return [(state.ids[row], score, matched[row] / total_idf) for row, score in best]
+
+    def count(self, tenant):
+        return self._tenant(tenant).live
+
+    def delete_tenant(self, tenant):
+        with self._lock:
+            self._tenants.pop(tenant, None)
+            shutil.rmtree(self._path(tenant), ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {"loaded": len(self._tenants)}
@@ -0,0 +1,295 @@
+"""
+Local caches shared by the bot's components.
+"""
+
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of host parameters per statement
+SQLITE_MAX_PARAMS = 500
+
+
+class DiskCache():
+    """Key/value cache persisted in SQLite and bounded by total value size.
+
+    Values are bytes. Once the stored values exceed max_bytes, the least
+    recently accessed entries are evicted until the cache is back under 90%
+    of the limit.
+    """
+
+    def __init__(self, path, max_bytes, table="cache"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.table = table
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL)""")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)")
+        self._conn.commit()
+        self._size = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Return a dict with the cached values of the keys that are present."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+                batch = keys[start:start + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders})", batch)
+                found.update(rows)
+
+                # Track recency for eviction
+                hit_keys = [key for key in batch if key in found]
+                if hit_keys:
+                    now = time.time()
+                    self._conn.executemany(
+                        f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", [(now, key) for key in hit_keys])
+            self._conn.commit()
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        """Store several key/value pairs and evict if over the size limit."""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(items), SQLITE_MAX_PARAMS):
+                batch = list(items)[start:start + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                replaced = self._conn.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM {self.table} WHERE key IN ({placeholders})", batch).fetchone()[0]
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, size, accessed_at) VALUES (?, ?, ?, ?)",
+                    [(key, items[key], len(items[key]), now) for key in batch])
+                self._size += sum(len(items[key]) for key in batch) - replaced
+            self._evict()
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            row = self._conn.execute(f"SELECT size FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self._conn.commit()
+                self._size -= row[0]
+
+    def _evict(self):
+        """Drop least recently accessed entries. Must hold the lock."""
+        if self._size <= self.max_bytes:
+            return
+        # Other processes sharing the database may have written or evicted since
+        self._size = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if self._size <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute(f"SELECT key, size FROM {self.table} ORDER BY accessed_at")
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        """Return hit/miss counters, hit rate and stored size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "bytes": self._size,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ToolResultCache():
+    """In-memory TTL cache for tool results with in-flight coalescing.
+
+    Queries are normalized (case and whitespace) before lookup. Each tool
+    has its own TTL, and the cache holds at most maxsize results, dropping
+    the least recently used first. Concurrent misses for the same query wait
+    on a single upstream call instead of each making their own.
+    """
+
+    def __init__(self, ttls=None, default_ttl=300, maxsize=1024):
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.maxsize = maxsize
+
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def normalize(query):
+        return " ".join(str(query).lower().split()).strip(" ?!.")
+
+    async def get_or_fetch(self, tool, query, fetch):
+        """Return the cached result for a query or await fetch() once for it.
+
+        Results that are None are returned but not cached. When the call
+        that fetches is cancelled, the calls waiting for it fetch again.
+        """
+        key = (tool, self.normalize(query))
+        now = time.monotonic()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > now:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Only the owner was cancelled, this caller still wants the result
+                task = asyncio.current_task()
+                if not inflight.cancelled() or getattr(task, "cancelling", lambda: 0)():
+                    raise
+            return await self.get_or_fetch(tool, query, fetch)
+
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if value is not None:
+                self._entries[key] = (now + self.ttls.get(tool, self.default_ttl), value)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        """Return hit, miss and coalesce counters."""
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "size": len(self._entries),
+        }
+
+
+class SemanticAnswerCache():
+    """Answers keyed by query embedding, reused for near-duplicate queries.
+
+    A lookup hits when a cached query embedding has at least the given
+    cosine similarity and was stored under the same key. invalidate() drops
+    every entry and must be called whenever the searched data changes;
+    answers computed against an older version are not stored.
+    """
+
+    def __init__(self, similarity=0.97, maxsize=64):
+        self.similarity = similarity
+        self.maxsize = maxsize
+        self.version = 0
+
+        self._keys = []
+        self._vectors = []
+        self._answers = []
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, embedding, key=None):
+        """Return the answer of the most similar cached query, or None."""
+        if self._vectors:
+            similarities = np.stack(self._vectors) @ self._normalize(embedding)
+            for index in np.argsort(-similarities):
+                if similarities[index] < self.similarity:
+                    break
+                if self._keys[index] == key:
+                    self.hits += 1
+                    return self._answers[index]
+        self.misses += 1
+        return None
+
+    def set(self, embedding, answer, key=None, version=None):
+        """Cache an answer unless the data changed since version was read."""
+        if version is not None and version != self.version:
+            return
+        self._keys.append(key)
+        self._vectors.append(self._normalize(embedding))
+        self._answers.append(answer)
+        if len(self._answers) > self.maxsize:
+            del self._keys[0], self._vectors[0], self._answers[0]
+
+    def invalidate(self):
+        self.version += 1
+        self._keys, self._vectors, self._answers = [], [], []
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._answers),
+        }
@@ -0,0 +1,74 @@
+"""
+LangChain callback handlers for rate limiting and stage tracing.
+"""
+
+import openai
+
+from langchain.callbacks.base import AsyncCallbackHandler
+
+from metrics import Span, current_span, llm_tokens
+from ratelimit import _retry_after, estimate_tokens, get_limiter
+
+
+class RateLimitCallbackHandler(AsyncCallbackHandler):
+    """Acquire quota before each LangChain LLM call and back off on 429s."""
+
+    def __init__(self, endpoint="openai.completions"):
+        self.limiter = get_limiter(endpoint)
+
+    async def on_llm_start(self, serialized, prompts, **kwargs):
+        max_tokens = serialized.get("kwargs", {}).get("max_tokens", 256) if isinstance(serialized, dict) else 256
+        tokens = sum(estimate_tokens(prompt) for prompt in prompts) + (max_tokens if max_tokens and max_tokens > 0 else 256)
+        await self.limiter.acquire(tokens=tokens)
+
+    async def on_llm_error(self, error, **kwargs):
+        if isinstance(error, openai.error.RateLimitError):
+            self.limiter.pause(_retry_after(error) or 1)
+
+
+class MetricsCallbackHandler(AsyncCallbackHandler):
+    """Spans for the LLM calls and tool runs of a LangChain run.
+
+    LangChain runs callbacks in their own tasks, so the spans are attached
+    to the parent given here instead of the current span.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent if parent is not None else current_span()
+        self.iterations = 0
+        self._spans = {}
+
+    async def on_llm_start(self, serialized, prompts, run_id=None, **kwargs):
+        self._spans[run_id] = Span("llm", parent=self.parent).start()
+
+    async def on_llm_end(self, response, run_id=None, **kwargs):
+        llm_span = self._spans.pop(run_id, None)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if usage.get(kind):
+                llm_tokens.observe(usage[kind], kind=kind)
+        if llm_span is not None:
+            llm_span.set(**usage)
+            llm_span.finish()
+
+    async def on_llm_error(self, error, run_id=None, **kwargs):
+        llm_span = self._spans.pop(run_id, None)
+        if llm_span is not None:
+            llm_span.finish(error)
+
+    async def on_tool_start(self, serialized, input_str, run_id=None, **kwargs):
+        name = serialized.get("name", "tool") if isinstance(serialized, dict) else "tool"
+        self._spans[run_id] = Span(f"tool:{name}", parent=self.parent).start()
+
+    async def on_tool_end(self, output, run_id=None, **kwargs):
+        tool_span = self._spans.pop(run_id, None)
+        if tool_span is not None:
+            tool_span.finish()
+
+    async def on_tool_error(self, error, run_id=None, **kwargs):
+        tool_span = self._spans.pop(run_id, None)
+        if tool_span is not None:
+            tool_span.finish(error)
+
+    async def on_agent_action(self, action, run_id=None, **kwargs):
+        self.iterations += 1
@@ -0,0 +1,210 @@
+"""
+Streaming document parsing and token-aware chunking for ingestion.
+"""
+
+import os
+import zlib
+import logging
+import importlib.util
+
+import tiktoken
+from langchain.docstore.document import Document
+
+# Chunk sizes in tokens of the embedding model
+CHUNK_TOKENS = int(os.environ.get("CHUNK_TOKENS", 256))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 32))
+
+# Plain text files are read paragraph by paragraph
+TEXT_EXTENSIONS = {".txt", ".md", ".markdown", ".rst", ".csv", ".tsv", ".log", ".json", ".py"}
+
+# Cap on a single text element, so a file without blank lines still streams
+MAX_ELEMENT_CHARS = 16 * 1024
+
+# Web page sections end after about one in this many elements, chosen by content
+SECTION_BOUNDARY_MODULUS = 4
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_paragraphs(text_lines, metadata):
+    lines, size = [], 0
+    for line in text_lines:
+        if not line.strip() or size >= MAX_ELEMENT_CHARS:
+            if lines:
+                yield "".join(lines), metadata
+            lines, size = [], 0
+        if line.strip():
+            lines.append(line)
+            size += len(line)
+    if lines:
+        yield "".join(lines), metadata
+
+
+def _iter_text(path, source):
+    with open(path, encoding="utf-8", errors="replace") as text_file:
+        yield from _iter_paragraphs(text_file, {"source": source})
+
+
+def _iter_pdf(path, source):
+    # pdfminer parses one page at a time
+    from pdfminer.high_level import extract_pages
+    from pdfminer.layout import LTTextContainer
+
+    for page_number, layout in enumerate(extract_pages(path), 1):
+        text = "".join(element.get_text() for element in layout if isinstance(element, LTTextContainer))
+        if text.strip():
+            yield text, {"source": source, "page": page_number}
+
+
+def _iter_unstructured(path, source):
+    from unstructured.partition.auto import partition
+
+    for element in partition(filename=path):
+        text = str(element)
+        if not text.strip():
+            continue
+        metadata = {"source": source}
+        page_number = getattr(element.metadata, "page_number", None)
+        if page_number is not None:
+            metadata["page"] = page_number
+        yield text, metadata
+
+
+def iter_file_elements(path, name=None):
+    """Yield (text, metadata) elements of a file as it is parsed.
+
+    The source of the elements is name, e.g. the file name the user sent,
+    or the path. Text files and PDFs are read incrementally. Other formats
+    go through unstructured, which parses the whole file before the first
+    element.
+    """
+    source = name or path
+    extension = os.path.splitext(path)[1].lower()
+    if extension in TEXT_EXTENSIONS:
+        return _iter_text(path, source)
+    if extension == ".pdf":
+        if importlib.util.find_spec("pdfminer") is not None:
+            return _iter_pdf(path, source)
+        logger.warning("pdfminer is not installed, parsing the PDF in one pass")
+    return _iter_unstructured(path, source)
+
+
+def iter_document_elements(docs):
+    """Yield (text, metadata) elements of already loaded langchain documents."""
+    for doc in docs:
+        yield doc.page_content, doc.metadata
+
+
+def iter_web_elements(text, url, content_type="text/html"):
+    """Yield (text, metadata) elements of a fetched web page.
+
+    HTML goes through unstructured, other text is split into paragraphs.
+    """
+    metadata = {"source": url}
+    if content_type and "html" not in content_type:
+        yield from _iter_paragraphs(text.splitlines(keepends=True), metadata)
+        return
+
+    from unstructured.partition.html import partition_html
+
+    for element in partition_html(text=text):
+        element_text = str(element)
+        if element_text.strip():
+            yield element_text, metadata
+
+
+def batched(iterable, size):
+    """Yield lists of up to size items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class TokenChunker():
+    """Split a stream of text elements into overlapping chunks of tokens.
+
+    Elements are appended to a token buffer and a chunk of chunk_tokens is
+    emitted as soon as the buffer holds one, so only the current chunk and
+    the overlap are kept in memory. Each chunk carries the metadata of the
+    element it starts in.
+    """
+
+    def __init__(self, chunk_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS, encoding_name="cl100k_base"):
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError("overlap_tokens must be smaller than chunk_tokens")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self._separator = self.encoding.encode("\n\n")
+
+    def _document(self, tokens, spans):
+        return Document(page_content=self.encoding.decode(tokens).strip(), metadata=dict(spans[0][1]))
+
+    def _section(self, group):
+        return Document(page_content="\n\n".join(text.strip() for text, _ in group), metadata=dict(group[0][1]))
+
+    def split_sections(self, elements):
+        """Yield Documents of whole elements that end on content-defined boundaries.
+
+        Elements are merged until one whose hash marks a boundary, once the
+        section holds a quarter chunk, or until the next one would overflow
+        chunk_tokens. Longer elements are split on their own. An edit only
+        changes the sections around it, so the unchanged sections of a
+        re-fetched page keep their chunk ids. Sections do not overlap.
+        """
+        group, size = [], 0
+        for text, metadata in elements:
+            tokens = len(self.encoding.encode(text, disallowed_special=()))
+            if not text.strip():
+                continue
+            if group and (tokens > self.chunk_tokens or size + tokens > self.chunk_tokens):
+                yield self._section(group)
+                group, size = [], 0
+            if tokens > self.chunk_tokens:
+                yield from self.split([(text, metadata)])
+                continue
+
+            group.append((text, metadata))
+            size += tokens + len(self._separator)
+            if size >= self.chunk_tokens // 4 and zlib.crc32(text.encode("utf-8")) % SECTION_BOUNDARY_MODULUS == 0:
+                yield self._section(group)
+                group, size = [], 0
+
+        if group:
+            yield self._section(group)
+
+    def split(self, elements):
+        """Yield Documents for an iterable of (text, metadata) elements."""
+        buffer = []
+        # (offset in buffer, metadata) of the elements in the buffer
+        spans = []
+        emitted = False
+        step = self.chunk_tokens - self.overlap_tokens
+
+        for text, metadata in elements:
+            tokens = self.encoding.encode(text, disallowed_special=())
+            if not tokens:
+                continue
+            spans.append((len(buffer), metadata))
+            buffer.extend(tokens)
+            buffer.extend(self._separator)
+
+            while len(buffer) >= self.chunk_tokens:
+                yield self._document(buffer[:self.chunk_tokens], spans)
+                emitted = True
+                buffer = buffer[step:]
+                shifted = [(offset - step, metadata) for offset, metadata in spans]
+                # Keep the element the new buffer starts in
+                first = max((i for i, (offset, _) in enumerate(shifted) if offset <= 0), default=0)
+                spans = [(max(offset, 0), metadata) for offset, metadata in shifted[first:]]
+
+        # The tail, unless it is only the overlap of the last chunk
+        if buffer and (not emitted or len(buffer) > self.overlap_tokens + len(self._separator)):
+            document = self._document(buffer, spans)
+            if document.page_content:
+                yield document
@@ -0,0 +1,140 @@
+"""
+Persistent conversation memory with a per-chat token budget.
+"""
+
+import os
+import asyncio
+import logging
+import functools
+
+import tiktoken
+
+from shared_state import open_conversation_state
+
+# Conversation store settings
+CONVERSATION_DB = os.environ.get("CONVERSATION_DB", "conversations.sqlite3")
+CONVERSATION_TOKEN_BUDGET = int(os.environ.get("CONVERSATION_TOKEN_BUDGET", 1500))
+CONVERSATION_MODEL = os.environ.get("AGENT_MODEL", "text-davinci-003")
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStore():
+    """Chat history kept in the shared state and within a token budget.
+
+    Turns are stored on disk, so nothing is evicted when many chats are
+    active. get_context() returns the rolling summary plus as many recent
+    turns as fit the budget. Once the stored turns exceed the budget, the
+    oldest ones are folded into the summary in the background by the
+    summarizer coroutine, called as summarizer(summary, turns).
+    """
+
+    def __init__(self, path=CONVERSATION_DB, token_budget=CONVERSATION_TOKEN_BUDGET, summarizer=None, model=CONVERSATION_MODEL, state=None):
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.model = model
+        self.state = state or open_conversation_state(path)
+
+        self._compactions = {}
+
+    @functools.cached_property
+    def encoding(self):
+        """Tokenizer of the model, loaded on first use."""
+        try:
+            return tiktoken.encoding_for_model(self.model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    async def _run(self, func, *args):
+        """Run a blocking database call off the event loop."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, lambda: func(*args))
+
+    def _load(self, chat_id):
+        summary, used, stored = self.state.load(chat_id)
+
+        turns = []
+        for _, human, ai, tokens in reversed(stored):
+            if used + tokens > self.token_budget and turns:
+                break
+            used += tokens
+            turns.append({"Human": human, "AI": ai})
+
+        turns.reverse()
+        if summary:
+            turns.insert(0, {"Summary": summary})
+        return turns
+
+    def _insert(self, chat_id, human, ai):
+        tokens = self.count_tokens(f"Human: {human}\nAI: {ai}")
+        return self.state.append(chat_id, human, ai, tokens)
+
+    def _select_overflow(self, chat_id):
+        """Return the summary and the oldest turns that don't fit half the budget."""
+        summary, _, rows = self.state.load(chat_id)
+        rows = rows[::-1]
+
+        # Keep the newest turns within half the budget to leave room for new ones
+        kept = 0
+        for index, (_, _, _, tokens) in enumerate(rows):
+            if kept + tokens > self.token_budget // 2:
+                overflow = rows[index:]
+                break
+            kept += tokens
+        else:
+            overflow = []
+
+        overflow.reverse()
+        return summary, overflow
+
+    def _replace(self, chat_id, summary, last_id):
+        tokens = self.count_tokens(summary) if summary is not None else 0
+        self.state.replace(chat_id, summary, tokens, last_id)
+
+    def _delete(self, chat_id):
+        self.state.delete(chat_id)
+
+    async def get_context(self, chat_id):
+        """Return the summary and recent turns of a chat within the token budget."""
+        return await self._run(self._load, str(chat_id))
+
+    async def add_turn(self, chat_id, human, ai):
+        """Store a turn and schedule compaction once the chat exceeds its budget."""
+        chat_id = str(chat_id)
+        total = await self._run(self._insert, chat_id, human, ai)
+
+        if total > self.token_budget and chat_id not in self._compactions:
+            task = asyncio.create_task(self._compact(chat_id))
+            self._compactions[chat_id] = task
+            task.add_done_callback(lambda _: self._compactions.pop(chat_id, None))
+
+    async def _compact(self, chat_id):
+        """Fold the oldest turns of a chat into its rolling summary."""
+        try:
+            summary, overflow = await self._run(self._select_overflow, chat_id)
+            if not overflow:
+                return
+
+            turns = [{"Human": human, "AI": ai} for _, human, ai, _ in overflow]
+            if self.summarizer is not None:
+                summary = await self.summarizer(summary, turns)
+                if not summary:
+                    # Keep the turns until a summary can be produced
+                    return
+
+            await self._run(self._replace, chat_id, summary, overflow[-1][0])
+        except Exception as e:
+            logger.error(f"Error compacting conversation: {e}")
+
+    async def clear(self, chat_id):
+        """Forget the history of a chat."""
+        await self._run(self._delete, str(chat_id))
+
+    async def close(self):
+        """Wait for pending compactions and close the database."""
+        if self._compactions:
+            await asyncio.gather(*self._compactions.values(), return_exceptions=True)
+        self.state.close()
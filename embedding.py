@@ -0,0 +1,189 @@
+"""
+Embedding client wrappers: a persistent cache keyed by chunk content and a
+micro-batcher that merges concurrent requests.
+"""
+
+import os
+import array
+import asyncio
+import hashlib
+import logging
+
+from langchain.embeddings.base import Embeddings
+
+from shared_state import open_cache
+from ratelimit import bound_loop, estimate_tokens, get_limiter
+
+# Embedding cache settings
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# Embedding batch limits
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 512))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.environ.get("EMBEDDING_BATCH_MAX_TOKENS", 100000))
+EMBEDDING_BATCH_DELAY = float(os.environ.get("EMBEDDING_BATCH_DELAY", 0.02))
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(text):
+    """Stable identifier for a chunk of text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _pack(vector):
+    return array.array("f", vector).tobytes()
+
+
+def _unpack(value):
+    vector = array.array("f")
+    vector.frombytes(value)
+    return vector.tolist()
+
+
+class EmbeddingBatcher():
+    """Merge embedding requests from concurrent callers into shared batches.
+
+    Texts queue up until the batch reaches max_size texts or max_tokens
+    tokens, or until max_delay seconds have passed since the first one
+    arrived. The batch is then sent as a single upstream request and the
+    vectors are routed back to each caller. Callers in worker threads use
+    embed_sync(), which hands the texts over to the event loop.
+    """
+
+    def __init__(self, embeddings, limiter=None, max_size=EMBEDDING_BATCH_SIZE, max_tokens=EMBEDDING_BATCH_MAX_TOKENS, max_delay=EMBEDDING_BATCH_DELAY):
+        self.embeddings = embeddings
+        self.limiter = limiter or get_limiter("openai.embeddings")
+        self.max_size = max_size
+        self.max_tokens = max_tokens
+        self.max_delay = max_delay
+
+        self._pending = []
+        self._pending_tokens = 0
+        self._timer = None
+
+        self.batches = 0
+        self.texts = 0
+
+    async def embed(self, texts):
+        """Embed texts as part of the next shared batch."""
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            tokens = estimate_tokens(text)
+            if self._pending and (len(self._pending) >= self.max_size or self._pending_tokens + tokens > self.max_tokens):
+                self._flush()
+            future = loop.create_future()
+            self._pending.append((text, tokens, future))
+            self._pending_tokens += tokens
+            futures.append(future)
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._pending and self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+
+        return list(await asyncio.gather(*futures))
+
+    def embed_sync(self, texts):
+        """Blocking embed for code running in worker threads."""
+        # Worker threads submit to the loop bound at startup
+        loop = bound_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is None or not loop.is_running() or running is loop:
+            # No loop to batch on, call the API directly
+            self.limiter.acquire_sync(tokens=sum(estimate_tokens(text) for text in texts))
+            return self.embeddings.embed_documents(texts)
+        return asyncio.run_coroutine_threadsafe(self.embed(texts), loop).result()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, tokens = self._pending, self._pending_tokens
+        self._pending, self._pending_tokens = [], 0
+        if batch:
+            asyncio.create_task(self._send(batch, tokens))
+
+    async def _send(self, batch, tokens):
+        # Identical texts from different callers are embedded once
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        try:
+            await self.limiter.acquire(tokens=tokens)
+            vectors = dict(zip(texts, await self.embeddings.aembed_documents(texts)))
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.texts += len(batch)
+        for text, _, future in batch:
+            if not future.done():
+                future.set_result(vectors[text])
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "average_batch_size": self.texts / self.batches if self.batches else 0.0,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that are looked up by content hash before calling the API.
+
+    Keys combine the model name with the text hash, so switching models
+    never returns stale vectors. Only texts missing from the cache are sent
+    to the wrapped embeddings client, through a shared EmbeddingBatcher.
+    """
+
+    def __init__(self, embeddings, cache=None, model_name=None, batcher=None):
+        self.embeddings = embeddings
+        self.model_name = model_name or getattr(embeddings, "model", type(embeddings).__name__)
+        self.cache = cache or open_cache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_BYTES, table="embeddings")
+        self.batcher = batcher or EmbeddingBatcher(embeddings)
+
+    def _key(self, text):
+        return f"{self.model_name}:{content_hash(text)}"
+
+    def _lookup(self, texts):
+        """Return the cached vectors by key and the unique texts that are missing."""
+        keys = [self._key(text) for text in texts]
+        cached = {key: _unpack(value) for key, value in self.cache.get_many(keys).items()}
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in cached))
+        return keys, cached, missing
+
+    def _store(self, cached, missing, vectors):
+        entries = {}
+        for text, vector in zip(missing, vectors):
+            key = self._key(text)
+            cached[key] = vector
+            entries[key] = _pack(vector)
+        self.cache.set_many(entries)
+
+    def embed_documents(self, texts):
+        keys, cached, missing = self._lookup(texts)
+        if missing:
+            self._store(cached, missing, self.batcher.embed_sync(missing))
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        keys, cached, missing = self._lookup(texts)
+        if missing:
+            self._store(cached, missing, await self.batcher.embed(missing))
+        return [cached[key] for key in keys]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+    def stats(self):
+        """Return the cache hit/miss counters and batching figures."""
+        return {**self.cache.stats(), **self.batcher.stats()}
@@ -0,0 +1,97 @@
+"""
+Background job queue for document and URL ingestion.
+"""
+
+import os
+import asyncio
+import logging
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Ingestion limits
+INGEST_MAX_WORKERS = int(os.environ.get("INGEST_MAX_WORKERS", 4))
+INGEST_MAX_CONCURRENT = int(os.environ.get("INGEST_MAX_CONCURRENT", 2))
+INGEST_MAX_PENDING = int(os.environ.get("INGEST_MAX_PENDING", 20))
+
+logger = logging.getLogger(__name__)
+
+# Thread pool for blocking parsing, splitting and vector store writes
+executor = ThreadPoolExecutor(max_workers=INGEST_MAX_WORKERS, thread_name_prefix="ingest")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking ingestion step in the ingestion thread pool."""
+    loop = asyncio.get_event_loop()
+    # Carry context variables such as the current chat into the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, lambda: context.run(func, *args, **kwargs))
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class IngestionQueue():
+    """Bounded queue of ingestion jobs processed by a fixed set of workers.
+
+    At most max_concurrent jobs run at once. submit() rejects new jobs with
+    QueueFullError once max_pending are waiting, so callers can tell the
+    user to retry later instead of piling up work.
+    """
+
+    def __init__(self, max_concurrent=INGEST_MAX_CONCURRENT, max_pending=INGEST_MAX_PENDING):
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self._queue = None
+        self._workers = []
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            # Workers start from an empty context, not the one of the first job's caller
+            context = contextvars.Context()
+            self._workers = [context.run(asyncio.create_task, self._worker()) for _ in range(self.max_concurrent)]
+
+    def submit(self, job, *args, **kwargs):
+        """Queue a job coroutine function and return a future for its result.
+
+        Jobs report their own progress, the future is for callers that need
+        the result or want to react to a failure.
+        """
+        self._ensure_started()
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self._queue.put_nowait((job, args, kwargs, future))
+        except asyncio.QueueFull:
+            raise QueueFullError("Too many documents are being processed.")
+        return future
+
+    def pending(self):
+        """Return the number of jobs waiting for a worker."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _worker(self):
+        while True:
+            job, args, kwargs, future = await self._queue.get()
+            try:
+                result = await job(*args, **kwargs)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                logger.error(f"Error running ingestion job: {e}")
+                if not future.done():
+                    future.set_exception(e)
+                    # Logged above, callers that don't await the future are not warned again
+                    future.exception()
+            finally:
+                self._queue.task_done()
+
+    async def shutdown(self):
+        """Stop the workers and the thread pool."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,299 @@
+"""
+Per-update latency tracing and Prometheus-format metrics.
+"""
+
+import os
+import json
+import time
+import inspect
+import logging
+import functools
+import threading
+import contextvars
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local metrics endpoint, port 0 disables it
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9108))
+
+# Finished traces are kept in memory and optionally appended to a JSON lines file
+TRACE_HISTORY = int(os.environ.get("TRACE_HISTORY", 100))
+TRACE_DUMP_PATH = os.environ.get("TRACE_DUMP_PATH")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter():
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_labels(key)} {value}")
+        return lines
+
+
+class Histogram():
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # labels -> ([count per bucket], sum, count)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._series.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._series[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in self._series.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(key, ('le', bound))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_labels(key, ('le', '+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+class Registry():
+    """Metrics plus collectors that expose existing stats() dicts as gauges."""
+
+    def __init__(self, prefix="intellibot"):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = {}
+
+    def counter(self, name, documentation):
+        metric = Counter(f"{self.prefix}_{name}", documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        metric = Histogram(f"{self.prefix}_{name}", documentation, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, name, stats):
+        """Expose the numeric values returned by stats() as gauges."""
+        self._collectors[name] = stats
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, stats in self._collectors.items():
+            try:
+                values = stats()
+            except Exception as e:
+                logger.warning(f"Error collecting {name} stats: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauge = f"{self.prefix}_{name}_{key}"
+                    lines.extend([f"# TYPE {gauge} gauge", f"{gauge} {value}"])
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.histogram("stage_seconds", "Latency of pipeline stages.")
+stage_errors = registry.counter("stage_errors_total", "Pipeline stages that raised.")
+llm_tokens = registry.histogram("llm_tokens", "Tokens per LLM call.", TOKEN_BUCKETS)
+provider_retries = registry.histogram("provider_retries", "Retries per provider call.", COUNT_BUCKETS)
+agent_iterations = registry.histogram("agent_iterations", "Tool calls per agent run.", COUNT_BUCKETS)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_traces = deque(maxlen=TRACE_HISTORY)
+_lock = threading.Lock()
+
+
+def _record_trace(trace):
+    entry = trace.to_dict()
+    with _lock:
+        _traces.append(entry)
+        if TRACE_DUMP_PATH:
+            try:
+                with open(TRACE_DUMP_PATH, "a", encoding="utf-8") as dump:
+                    dump.write(json.dumps(entry) + "\n")
+            except OSError as e:
+                logger.warning(f"Error writing trace dump: {e}")
+
+
+class Span():
+    """Timed pipeline stage, nested under the span that was current when it was created.
+
+    Use it as a context manager to make it current for the code inside, or
+    call start() and finish() where enter and exit happen in different
+    callbacks. Every finished span is observed in stage_seconds, and
+    finished root spans are kept as traces.
+    """
+
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.children = []
+        self.started_at = None
+        self.duration = None
+        self.error = None
+        self._start = None
+        self._token = None
+
+    def start(self):
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        if self.parent is not None:
+            with _lock:
+                self.parent.children.append(self)
+        return self
+
+    def finish(self, error=None):
+        self.duration = time.perf_counter() - self._start
+        stage_seconds.observe(self.duration, stage=self.name)
+        if error is not None:
+            self.error = repr(error)
+            stage_errors.inc(stage=self.name)
+        if self.parent is None:
+            _record_trace(self)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+            "children": [child.to_dict() for child in list(self.children)],
+        }
+
+    def __enter__(self):
+        self.start()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        _current_span.reset(self._token)
+        self.finish(exc)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self.__exit__(exc_type, exc, traceback)
+
+
+def span(name, root=False, **attributes):
+    """Create a span under the current one, or a new trace with root=True."""
+    return Span(name, parent=None if root else _current_span.get(), **attributes)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def traced(name, root=False):
+    """Decorator that runs a function or coroutine function inside a span."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, root=root):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, root=root):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traces():
+    """Return the most recent finished traces."""
+    with _lock:
+        return list(_traces)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body, content_type = registry.render().encode("utf-8"), "text/plain; version=0.0.4"
+        elif path == "/traces":
+            body, content_type = json.dumps(traces()).encode("utf-8"), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_server = None
+
+
+def start_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serve /metrics and /traces from a background thread."""
+    global _server
+    if not port or _server is not None:
+        return _server
+    try:
+        _server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.error(f"Error starting metrics server: {e}")
+        return None
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return _server
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
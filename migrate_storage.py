@@ -0,0 +1,72 @@
+"""
+Copy stored chunks from the per-chat collection layout to another storage backend.
+
+Usage:
+    python migrate_storage.py shared
+    python migrate_storage.py mmap --mmap-root vectors --drop-source
+"""
+
+import sys
+import logging
+import argparse
+
+import chromadb
+
+from persistence import PersistenceManager
+from storage import CollectionBackend, MmapBackend, SharedCollectionBackend, SHARED_COLLECTION, MMAP_ROOT
+from vectordb import CHROMA_PERSIST_DIRECTORY, chroma_settings
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def migrate(source, target, tenants, drop_source=False):
+    """Copy every tenant from source to target. Returns the number of chunks copied."""
+    copied = 0
+    for index, tenant in enumerate(tenants, 1):
+        for ids, embeddings, documents, metadatas in source.export(tenant):
+            # Chunks copied by an earlier, interrupted run are skipped
+            existing = target.existing_ids(tenant, ids)
+            page = [row for row in zip(ids, embeddings, documents, metadatas) if row[0] not in existing]
+            if page:
+                target.add(tenant, *(list(column) for column in zip(*page)))
+                copied += len(page)
+
+        if drop_source:
+            source.delete_tenant(tenant)
+        if index % 100 == 0:
+            logger.info(f"Migrated {index} of {len(tenants)} chats, {copied} chunks")
+    return copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate per-chat Chroma collections to another storage backend.")
+    parser.add_argument("target", choices=["shared", "mmap"])
+    parser.add_argument("--collection", default=SHARED_COLLECTION, help="collection name for the shared backend")
+    parser.add_argument("--mmap-root", default=MMAP_ROOT, help="directory for the mmap backend")
+    parser.add_argument("--drop-source", action="store_true", help="delete each chat's collection once it is copied")
+    args = parser.parse_args(argv)
+
+    # Both Chroma layouts live in the same database, so they share one client
+    client = chromadb.Client(chroma_settings())
+    persistence = PersistenceManager(persist_directory=CHROMA_PERSIST_DIRECTORY, dirty_threshold=sys.maxsize)
+    persistence.bind(client)
+
+    source = CollectionBackend(client, persistence=persistence)
+    if args.target == "shared":
+        target = SharedCollectionBackend(client, persistence=persistence, collection_name=args.collection)
+    else:
+        target = MmapBackend(root=args.mmap_root)
+
+    tenants = [tenant for tenant in source.tenants() if tenant != args.collection]
+    logger.info(f"Migrating {len(tenants)} chats to the {target.name} backend")
+    try:
+        copied = migrate(source, target, tenants, drop_source=args.drop_source)
+    finally:
+        persistence.flush()
+    logger.info(f"Migrated {len(tenants)} chats, {copied} chunks")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Deferred, batched persistence for the Chroma store with a write-ahead journal.
+"""
+
+import os
+import json
+import time
+import array
+import base64
+import asyncio
+import logging
+import threading
+
+import metrics
+
+# Flush when this many chunks are pending or this many seconds have passed
+PERSIST_INTERVAL = float(os.environ.get("PERSIST_INTERVAL", 30))
+PERSIST_DIRTY_THRESHOLD = int(os.environ.get("PERSIST_DIRTY_THRESHOLD", 500))
+PERSIST_JOURNAL = os.environ.get("PERSIST_JOURNAL", os.path.join(os.environ.get("CHROMA_PERSIST_DIRECTORY", "db"), "journal.jsonl"))
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_vector(vector):
+    return base64.b64encode(array.array("f", vector).tobytes()).decode("ascii")
+
+
+def _decode_vector(value):
+    vector = array.array("f")
+    vector.frombytes(base64.b64decode(value))
+    return vector.tolist()
+
+
+class PersistenceManager():
+    """Batch Chroma persist() calls instead of persisting every ingestion.
+
+    Writes and deletions are appended to a journal before they reach the
+    collection, and the store is persisted once dirty_threshold chunks are
+    pending, every interval seconds, and on shutdown. After a crash,
+    replay() re-applies journaled writes that were never persisted.
+    """
+
+    def __init__(self, persist_directory="db", interval=PERSIST_INTERVAL, dirty_threshold=PERSIST_DIRTY_THRESHOLD, journal_path=PERSIST_JOURNAL):
+        self.persist_directory = persist_directory
+        self.interval = interval
+        self.dirty_threshold = dirty_threshold
+        self.journal_path = journal_path
+
+        self.client = None
+        self.dirty = 0
+        self._lock = threading.RLock()
+        self._task = None
+
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+        self.bytes_written = 0
+
+    def bind(self, client):
+        """Attach the Chroma client and recover unflushed writes."""
+        self.client = client
+        self.replay()
+
+    def _append(self, entry):
+        os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+        with open(self.journal_path, "a", encoding="utf-8") as journal:
+            journal.write(json.dumps(entry) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def add(self, collection, ids, embeddings, documents, metadatas):
+        """Journal an addition, apply it and flush if enough writes are pending."""
+        with self._lock:
+            self._append({
+                "op": "add",
+                "collection": collection.name,
+                "ids": ids,
+                "embeddings": [_encode_vector(vector) for vector in embeddings],
+                "documents": documents,
+                "metadatas": metadatas,
+            })
+            collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+            self.dirty += len(ids)
+            if self.dirty >= self.dirty_threshold:
+                self.flush()
+
+    def delete_collection(self, name):
+        """Journal and apply the deletion of a collection."""
+        with self._lock:
+            self._append({"op": "delete", "collection": name})
+            self.client.delete_collection(name)
+            self.dirty += 1
+
+    def delete(self, collection, ids=None, where=None):
+        """Journal and apply the deletion of entries from a collection."""
+        with self._lock:
+            self._append({"op": "delete_entries", "collection": collection.name, "ids": ids, "where": where})
+            collection.delete(ids=ids, where=where)
+            self.dirty += 1
+
+    def _written_bytes(self, since):
+        """Size of the files in the persist directory modified since a timestamp."""
+        total = 0
+        for root, _, files in os.walk(self.persist_directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if path == self.journal_path:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_mtime >= since:
+                    total += stat.st_size
+        return total
+
+    def flush(self):
+        """Persist pending writes and truncate the journal. Blocking."""
+        with self._lock:
+            if not self.dirty or self.client is None:
+                return
+
+            started_at = time.time()
+            start = time.monotonic()
+            with metrics.span("persist", writes=self.dirty):
+                self.client.persist()
+            elapsed = time.monotonic() - start
+
+            written = self._written_bytes(started_at - 1)
+            open(self.journal_path, "w").close()
+
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.last_flush_seconds = elapsed
+            self.bytes_written += written
+            logger.info(f"Persisted {self.dirty} pending writes in {elapsed:.3f}s, {written} bytes written")
+            self.dirty = 0
+
+    def replay(self):
+        """Re-apply journaled writes left over from an unclean shutdown."""
+        if not os.path.exists(self.journal_path) or not os.path.getsize(self.journal_path):
+            return
+
+        replayed = 0
+        with self._lock, open(self.journal_path, encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from the crash
+                    continue
+                if entry["op"] == "delete":
+                    try:
+                        self.client.delete_collection(entry["collection"])
+                    except ValueError:
+                        pass
+                elif entry["op"] == "delete_entries":
+                    collection = self.client.get_or_create_collection(entry["collection"])
+                    collection.delete(ids=entry["ids"], where=entry["where"])
+                else:
+                    collection = self.client.get_or_create_collection(entry["collection"])
+                    collection.upsert(
+                        ids=entry["ids"],
+                        embeddings=[_decode_vector(value) for value in entry["embeddings"]],
+                        documents=entry["documents"],
+                        metadatas=entry["metadatas"])
+                replayed += 1
+            self.dirty += replayed
+
+        logger.info(f"Replayed {replayed} journaled writes")
+        self.flush()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.dirty:
+                try:
+                    await loop.run_in_executor(None, self.flush)
+                except Exception as e:
+                    logger.error(f"Error persisting vector store: {e}")
+
+    def start(self):
+        """Start flushing on an interval."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the interval flush and persist what is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.flush)
+
+    def stats(self):
+        """Return flush counts, latency and bytes written."""
+        return {
+            "dirty": self.dirty,
+            "flushes": self.flushes,
+            "flush_seconds": self.flush_seconds,
+            "last_flush_seconds": self.last_flush_seconds,
+            "bytes_written": self.bytes_written,
+        }
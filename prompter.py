@@ -1,65 +1,186 @@
 import logging
 import openai
-import elevenlabs
 import asyncio
 import os
+import functools
 
 from langchain import OpenAI
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import LLMChain, ConversationChain
-from langchain.prompts import PromptTemplate
 from langchain.agents import load_tools, initialize_agent, Tool, AgentType
-from langchain.memory import ConversationBufferMemory
 from langchain.utilities import WikipediaAPIWrapper, GoogleSearchAPIWrapper
 from langchain.utilities.wolfram_alpha import WolframAlphaAPIWrapper
 
-from vectordb import VectorDB
+import metrics
+import router
+from cache import ToolResultCache
+from callbacks import MetricsCallbackHandler, RateLimitCallbackHandler
+from ratelimit import current_chat_user_id, handle_rate_limiting
+from speech import synthesizer
+from vectordb import aget_vector_db, format_matches, registry
 
 # Set API keys
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = os.environ.get("GOOGLE_CSE_ID")
 WOLFRAM_ALPHA_APPID = os.environ.get("WOLFRAM_ALPHA_APPID")
-ELEVEN_API_KEY = os.environ.get("ELEVEN_API_KEY")
 
 # Enable logging for debugging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class RateLimitError(Exception):
-    def __init__(self, message, retry_after=None):
-        super().__init__(message)
-        self.retry_after = retry_after
+# Agent model settings
+AGENT_MODEL = os.environ.get("AGENT_MODEL", "text-davinci-003")
+AGENT_TEMPERATURE = float(os.environ.get("AGENT_TEMPERATURE", 0))
 
-async def handle_rate_limiting(func, *args, is_async=True, **kwargs):
-    retries = 5
-    backoff_factor = 2
+# Personalities selectable with /selectrole
+DEFAULT_ROLE = "assistant"
+ROLE_PREFIXES = {
+    "assistant": "Assistant is a helpful AI assistant. It answers questions, explains topics and helps with everyday tasks in a friendly and concise way.",
+    "teacher": "Assistant is a patient teacher. It explains concepts step by step, uses simple examples and checks that the user has understood.",
+    "researcher": "Assistant is a thorough researcher. It looks up facts with its tools, compares sources and cites where the information came from.",
+    "coder": "Assistant is an experienced software engineer. It writes correct, idiomatic code, explains its reasoning and points out bugs or edge cases.",
+}
+TOOLS_PREFIX = """
+
+TOOLS:
+------
+
+Assistant has access to the following tools:"""
+
+# Prompt for answers without the agent. It ends like the agent's final step,
+# so the completion carries the same "AI:" marker the streaming handlers wait for.
+DIRECT_PROMPT = """{prefix}
+
+{context}Previous conversation:
+{chat_history}
+
+Human: {message}
+Thought: Do I need to use a tool? No
+"""
+DOCUMENTS_CONTEXT = """Passages from the user's saved documents and web pages:
+{passages}
+
+Answer from these passages and name their sources. If they don't contain the answer, say so.
+
+"""
+
+# Search tool result cache, TTLs in seconds per tool
+TOOL_CACHE_TTLS = {
+    "wikipedia": int(os.environ.get("WIKIPEDIA_CACHE_TTL", 86400)),
+    "google": int(os.environ.get("GOOGLE_CACHE_TTL", 900)),
+    "wolframalpha": int(os.environ.get("WOLFRAM_ALPHA_CACHE_TTL", 3600)),
+}
+TOOL_CACHE_MAX_SIZE = int(os.environ.get("TOOL_CACHE_MAX_SIZE", 1024))
+tool_cache = ToolResultCache(ttls=TOOL_CACHE_TTLS, maxsize=TOOL_CACHE_MAX_SIZE)
+
+# Search API wrappers are created once and shared by all chats
+@functools.lru_cache(maxsize=1)
+def _wikipedia():
+    return WikipediaAPIWrapper()
+
+
+@functools.lru_cache(maxsize=1)
+def _google_search():
+    return GoogleSearchAPIWrapper(google_api_key=GOOGLE_API_KEY, google_cse_id=GOOGLE_CSE_ID, k=5)
+
+
+@functools.lru_cache(maxsize=1)
+def _wolframalpha():
+    return WolframAlphaAPIWrapper(wolfram_alpha_appid=WOLFRAM_ALPHA_APPID)
+
+
+async def _run_search(wrapper, query):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, lambda: wrapper.run(query))
+
+
+def _chat_tool(method_name):
+    """Dispatch a tool call to the Prompter of the chat running the agent."""
+    async def run(query):
+        prompter = Prompter(chat_id=current_chat_user_id.get())
+        return await getattr(prompter, method_name)(query)
+    return run
+
+
+@functools.lru_cache(maxsize=32)
+def build_agent(model=AGENT_MODEL, temperature=AGENT_TEMPERATURE, role=DEFAULT_ROLE):
+    """Build the agent for a model and role once and reuse it across messages."""
+
+    # Create a model, chain and tool for the language model
+    llm = OpenAI(temperature=temperature,
+                 model=model,
+                 streaming=True,
+                 max_retries=3,
+                 openai_api_key=openai.api_key,
+                 callbacks=[RateLimitCallbackHandler("openai.completions")])
+
+    # Provide access to a list of tools that the agents will use
+    tools = load_tools(['llm-math'],
+                       llm=llm)
+
+    # Tools resolve the chat at call time through current_chat_user_id
+    image_tool = _chat_tool("generate_image")
+    wikipedia_tool = _chat_tool("search_wikipedia")
+    google_tool = _chat_tool("search_google")
+    wolframalpha_tool = _chat_tool("search_wolframalpha")
+    search_all_tool = _chat_tool("search_all")
+    database_tool = _chat_tool("search_database")
+
+    tools.extend([
+        Tool(name="Image Model", func=image_tool, coroutine=image_tool, description="Generate images from text", return_direct=True),
+        Tool(name="Wikipedia", func=wikipedia_tool, coroutine=wikipedia_tool, description="Search Wikipedia for general information"),
+        Tool(name="Google Search", func=google_tool, coroutine=google_tool, description="Search the web. Useful about current events, everyday life, news, technical topics, errors or fixes."),
+        Tool(name="Wolfram Alpha", func=wolframalpha_tool, coroutine=wolframalpha_tool, description="Search Wolfram Alpha. Useful about science, weather, climate, engineering, technology, culture and society"),
+        Tool(name="Search All Sources", func=search_all_tool, coroutine=search_all_tool, description="Search Wikipedia, Google and Wolfram Alpha at once. Use it instead of several separate searches when a question needs more than one source."),
+        Tool(name="Search User Documents", func=database_tool, coroutine=database_tool, description="Search the user's saved documents and web pages. Returns the most relevant passages with their sources."),
+    ])
+
+    # initialise the agents & make all the tools and llm available to it
+    return initialize_agent(tools=tools,
+                            llm=llm,
+                            agent=AgentType.CONVERSATIONAL_REACT_DESCRIPTION,
+                            verbose=True,
+                            max_iterations=3,
+                            early_stopping_method="generate",
+                            handle_parsing_errors="Check your output and make sure it conforms!",
+                            agent_kwargs={"prefix": ROLE_PREFIXES[role] + TOOLS_PREFIX})
+
+
+@functools.lru_cache(maxsize=8)
+def _direct_llm(model=AGENT_MODEL, temperature=AGENT_TEMPERATURE):
+    return OpenAI(temperature=temperature,
+                  model=model,
+                  streaming=True,
+                  max_retries=3,
+                  openai_api_key=openai.api_key,
+                  callbacks=[RateLimitCallbackHandler("openai.completions")])
+
+
+@functools.lru_cache(maxsize=1)
+def _summary_llm():
+    return OpenAI(temperature=0, max_retries=3, openai_api_key=openai.api_key, callbacks=[RateLimitCallbackHandler("openai.completions")])
+
+
+async def summarize_conversation(summary, turns):
+    """Fold older chat turns into the rolling conversation summary."""
+    formatted_turns = "\n".join([f"{k}: {v}" for entry in turns for k, v in entry.items()])
+    prompt = f"""Progressively summarize the conversation, adding onto the previous summary. Keep names, facts, preferences and open questions, and stay under 200 words.
+
+Previous summary:
+{summary or "(none)"}
+
+New lines of conversation:
+{formatted_turns}
+
+New summary:"""
+
+    try:
+        new_summary = await _summary_llm().apredict(prompt)
+        return new_summary.strip()
+    except Exception as e:
+        logger.error(f"Error summarizing conversation: {e}")
+        return None
 
-    for attempt in range(retries):
-        try:
-            if is_async:
-                result = await func(*args, **kwargs)
-            else:
-                loop = asyncio.get_event_loop()
-                result = await loop.run_in_executor(None, lambda: func(*args, **kwargs))
-            return result
-        except openai.error.RateLimitError as e:
-            if attempt < retries - 1:  # Check if it's the last attempt
-                retry_after = int(e.headers.get("Retry-After", 0))
-                wait_time = retry_after or (backoff_factor ** attempt)
-                logger.warning(f"Rate limit exceeded. Retrying in {wait_time} seconds...")
-                await asyncio.sleep(wait_time)
-            else:
-                raise RateLimitError("Too many rate-limited attempts.", retry_after=retry_after) from e
-        except elevenlabs.RateLimitError as e:
-            if attempt < retries - 1:
-                retry_after = int(e.headers.get("Retry-After", 0))
-                wait_time = retry_after or (backoff_factor ** attempt)
-                logger.warning(f"Rate limit exceeded. Retrying in {wait_time} seconds...")
-                await asyncio.sleep(wait_time)
-        except Exception as e:
-            raise e
 
 class Prompter:
     def __init__(self, chat_id):
@@ -69,139 +190,181 @@ class Prompter:
         else:
             self.chat_user_id = chat_id
 
+    @metrics.traced("openai.images")
     async def generate_image(self, prompt):
         try:
-            response = await handle_rate_limiting(openai.Image.acreate, prompt=prompt, n=1, size="256x256")
+            response = await handle_rate_limiting(openai.Image.acreate, prompt=prompt, n=1, size="256x256", endpoint="openai.images")
             return response['data'][0]['url']
         except Exception as e:
             logger.error(f"Error generating image: {e}")
             return None
 
+    @metrics.traced("openai.whisper")
     async def transcribe_voice(self, file):
         try:
-            transcript = await handle_rate_limiting(openai.Audio.atranscribe, model="whisper-1", file=file)
+            transcript = await handle_rate_limiting(openai.Audio.atranscribe, model="whisper-1", file=file, endpoint="openai.whisper")
             return transcript["text"]
         except Exception as e:
             logger.error(f"Error transcribing voice: {e}")
             return None
     
-    async def generate_audio(self, text):
+    def stream_audio(self):
+        """Start a voice reply that is synthesized while the answer streams in."""
+        return synthesizer.stream()
+
+    @metrics.traced("tts")
+    async def generate_audio(self, text, stream=None):
         try:
-            audio = await handle_rate_limiting(elevenlabs.generate, api_key=ELEVEN_API_KEY, text=text, voice="Bella", model="eleven_monolingual_v1", is_async=False)
+            # Sentences already synthesized by the stream are reused
+            audio = await (stream or synthesizer.stream()).finish(text)
             return audio
         except Exception as e:
             logger.error(f"Error generating audio: {e}")
             return None
 
     async def search_wikipedia(self, query):
-        wikipedia = WikipediaAPIWrapper()
         try:
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, lambda: wikipedia.run(query))
+            response = await tool_cache.get_or_fetch("wikipedia", query, lambda: _run_search(_wikipedia(), query))
             return response
         except Exception as e:
             logger.error(f"Error searching wikipedia: {e}")
             return None
     
     async def search_google(self, query):
-        search = GoogleSearchAPIWrapper(google_api_key=GOOGLE_API_KEY, google_cse_id=GOOGLE_CSE_ID, k=5)
         try:
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, lambda: search.run(query))
+            response = await tool_cache.get_or_fetch("google", query, lambda: _run_search(_google_search(), query))
             return response
         except Exception as e:
-            logger.error(f"Error searching wikipedia: {e}")
+            logger.error(f"Error searching google: {e}")
             return None
     
     async def search_wolframalpha(self, query):
-        wolframalpha = WolframAlphaAPIWrapper(wolfram_alpha_appid=WOLFRAM_ALPHA_APPID)
         try:
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, lambda: wolframalpha.run(query))
+            response = await tool_cache.get_or_fetch("wolframalpha", query, lambda: _run_search(_wolframalpha(), query))
             return response
         except Exception as e:
-            logger.error(f"Error searching wikipedia: {e}")
+            logger.error(f"Error searching wolfram alpha: {e}")
             return None
 
-    # Prompt the LLM to generate a response
-    async def generate_response(self, message, chat_context):
+    async def search_all(self, query):
+        """Search Wikipedia, Google and Wolfram Alpha concurrently."""
+        results = await asyncio.gather(self.search_wikipedia(query), self.search_google(query), self.search_wolframalpha(query))
+        sections = [f"{name}: {result}" for name, result in zip(("Wikipedia", "Google", "Wolfram Alpha"), results) if result]
+        return "\n\n".join(sections) or "No results found."
 
-        # Format the chat history as a string
-        formatted_chat_history = "\n".join([f"{k}: {v}" for entry in chat_context for k, v in entry.items()])
+    async def _complete(self, prompt, callbacks=None):
+        """Answer with a single completion instead of the agent loop."""
+        with metrics.span("direct") as direct_span:
+            handler = MetricsCallbackHandler(direct_span)
+            result = await _direct_llm(model=AGENT_MODEL, temperature=AGENT_TEMPERATURE).agenerate(
+                [prompt], stop=["\nHuman:"], callbacks=(callbacks or []) + [handler])
+        return result.generations[0][0].text.split("AI:", 1)[-1].strip()
 
-        # Create a prompt template
-        template = f"""
-        Chat History:
-        {formatted_chat_history}
+    async def _route(self, message, chat_history, role, previous_reply=None, callbacks=None):
+        """Answer small talk, image requests and document questions directly.
 
-        Human: {message}
-        AI:"""
+        Returns None for messages the agent has to handle, including
+        document questions no stored passage clearly matches.
+        """
+        route, argument = router.classify(message, previous_reply)
+        matches = []
+        if route == router.DOCUMENTS:
+            db = await aget_vector_db(self.chat_user_id)
+            if await db.count_documents():
+                matches = await db.relevant_matches(argument, min_score=router.DOCUMENTS_MIN_SCORE)
+            if not matches:
+                route = router.AGENT
+        router.routes.inc(route=route)
 
-        # Create a prompt template
-        #prompt_template = PromptTemplate(template=template, validate_template=False)
+        if route == router.IMAGE:
+            return await self.generate_image(argument)
+        if route == router.DOCUMENTS:
+            context = DOCUMENTS_CONTEXT.format(passages=format_matches(matches))
+        elif route == router.SMALL_TALK:
+            context = ""
+        else:
+            return None
+        prompt = DIRECT_PROMPT.format(prefix=ROLE_PREFIXES[role], context=context, chat_history=chat_history or "(none)", message=message)
+        return await self._complete(prompt, callbacks)
 
-        # A conversation buffer (memory) & import llm of choice
-        #memory = ConversationBufferMemory(memory_key="chat_history", input_key="input")
+    # Prompt the LLM to generate a response
+    async def generate_response(self, message, chat_context, role=None, callbacks=None):
 
-        # Create a model, chain and tool for the language model
-        llm = OpenAI(temperature=0, 
-                     model="text-davinci-003",
-                        streaming=True,
-                        max_retries=3,
-                        openai_api_key=openai.api_key)
+        # Format the chat history as a string
+        formatted_chat_history = "\n".join([f"{k}: {v}" for entry in chat_context for k, v in entry.items()])
 
-        #llm_chain = ConversationChain(llm=llm, prompt=prompt_template)
+        if role not in ROLE_PREFIXES:
+            role = DEFAULT_ROLE
 
-        # Provide access to a list of tools that the agents will use
-        tools = load_tools(['llm-math'],
-                            llm=llm)
-        
-        tools.extend([
-            Tool(name="Image Model", func=self.generate_image, coroutine=self.generate_image, description="Generate images from text", return_direct=True),
-            Tool(name="Wikipedia", func=self.search_wikipedia, coroutine=self.search_wikipedia, description="Search Wikipedia for general information"),
-            Tool(name="Google Search", func=self.search_google, coroutine=self.search_google, description="Search the web. Useful about current events, everyday life, news, technical topics, errors or fixes."),
-            Tool(name="Wolfram Alpha", func=self.search_wolframalpha, coroutine=self.search_wolframalpha, description="Search Wolfram Alpha. Useful about science, weather, climate, engineering, technology, culture and society"),
-            Tool(name="Search User Documents", func=self.search_database, coroutine=self.search_database, description="Search user documents database"),
-        ])
-        
+        token = current_chat_user_id.set(self.chat_user_id)
+        try:
+            # Simple messages skip the agent loop
+            previous_reply = next((entry["AI"] for entry in reversed(chat_context) if "AI" in entry), None)
+            try:
+                answer = await self._route(message, formatted_chat_history, role, previous_reply=previous_reply, callbacks=callbacks)
+                if answer:
+                    return answer
+            except Exception as e:
+                # The agent can still answer what the direct route failed on
+                logger.error(f"Error routing message, falling back to the agent: {e}")
 
-        # initialise the agents & make all the tools and llm available to it
-        agent = initialize_agent(tools=tools,
-                                llm=llm, 
-                                agent=AgentType.CONVERSATIONAL_REACT_DESCRIPTION, 
-                                verbose=True,
-                                max_iterations=3,
-                                early_stopping_method="generate",
-                                handle_parsing_errors="Check your output and make sure it conforms!")
+            # Reuse the cached agent for this role, only the inputs vary per message
+            agent = build_agent(model=AGENT_MODEL, temperature=AGENT_TEMPERATURE, role=role)
 
-        try:
-            answer = await agent.arun(input=template, chat_history=formatted_chat_history, return_only_outputs=True)
+            # LLM calls, tool runs and iterations are recorded under the agent span
+            with metrics.span("agent", role=role) as agent_span:
+                handler = MetricsCallbackHandler(agent_span)
+                answer = await agent.arun(input=message, chat_history=formatted_chat_history, callbacks=(callbacks or []) + [handler], return_only_outputs=True)
+                metrics.agent_iterations.observe(handler.iterations)
             return answer
         except Exception as e:
             logger.error(f"Error generating response: {e}")
             return "An error occurred while generating the response."
+        finally:
+            current_chat_user_id.reset(token)
     
-    async def save_document(self, document):
+    async def save_document(self, document, progress=None, name=None):
         try:
-            db = VectorDB(chat_user_id=self.chat_user_id)
-            summary = await db.add_document(document=document)
+            db = await aget_vector_db(self.chat_user_id)
+            token = current_chat_user_id.set(self.chat_user_id)
+            try:
+                summary = await db.add_document(document=document, progress=progress, name=name)
+            finally:
+                current_chat_user_id.reset(token)
             return summary
         except Exception as e:
             logger.error(f"Error saving document: {e}")
             return "Error saving document"
 
-    async def save_url(self, url):
+    async def save_url(self, url, progress=None):
         try:
-            db = VectorDB(chat_user_id=self.chat_user_id)
-            summary = await db.add_url(url=url)
+            db = await aget_vector_db(self.chat_user_id)
+            token = current_chat_user_id.set(self.chat_user_id)
+            try:
+                summary = await db.add_url(url=url, progress=progress)
+            finally:
+                current_chat_user_id.reset(token)
             return summary
         except Exception as e:
             logger.error(f"Error saving URL: {e}")
             return "Error saving URL"
+
+    async def save_urls(self, urls=None, progress=None):
+        """Save many pages, sitemaps or feeds, or refresh the saved pages without urls."""
+        try:
+            db = await aget_vector_db(self.chat_user_id)
+            token = current_chat_user_id.set(self.chat_user_id)
+            try:
+                return await db.add_urls(urls=urls, progress=progress)
+            finally:
+                current_chat_user_id.reset(token)
+        except Exception as e:
+            logger.error(f"Error saving URLs: {e}")
+            return None
         
     async def search_database(self, query):
         try:
-            db = VectorDB(chat_user_id=self.chat_user_id)
+            db = await aget_vector_db(self.chat_user_id)
             results = await db.query(query=query)
             return results
         except Exception as e:
@@ -210,8 +373,10 @@ class Prompter:
     
     async def clear_database(self):
         try:
-            db = VectorDB(chat_user_id=self.chat_user_id)
+            db = await aget_vector_db(self.chat_user_id)
             await db.clear_database()
+            # The collection is gone, so drop the pooled handle as well
+            registry.discard(self.chat_user_id)
             return True
         except Exception as e:
             logger.error(f"Error clearing user documents: {e}")
@@ -0,0 +1,262 @@
+"""
+Proactive, per-provider rate limiting for OpenAI and ElevenLabs requests.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import contextvars
+
+from collections import OrderedDict, deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Chat the current request belongs to, used to share quota fairly between chats
+current_chat_user_id = contextvars.ContextVar("current_chat_user_id", default=None)
+
+
+# Processes sharing the provider quotas, each one gets an equal part
+RATE_LIMIT_WORKERS = int(os.environ.get("RATE_LIMIT_WORKERS", 1))
+
+
+def _limit(name, default):
+    value = os.environ.get(f"RATE_LIMIT_{name}", default)
+    return max(1, int(value) // RATE_LIMIT_WORKERS) if value else None
+
+
+# Requests and tokens per minute for each provider endpoint
+RATE_LIMITS = {
+    "openai.completions": (_limit("OPENAI_COMPLETIONS_RPM", 3000), _limit("OPENAI_COMPLETIONS_TPM", 250000)),
+    "openai.embeddings": (_limit("OPENAI_EMBEDDINGS_RPM", 3000), _limit("OPENAI_EMBEDDINGS_TPM", 1000000)),
+    "openai.whisper": (_limit("OPENAI_WHISPER_RPM", 50), None),
+    "openai.images": (_limit("OPENAI_IMAGES_RPM", 50), None),
+    "elevenlabs.tts": (_limit("ELEVENLABS_TTS_RPM", 100), _limit("ELEVENLABS_TTS_CPM", None)),
+}
+
+
+def estimate_tokens(text):
+    """Cheap token estimate for quota accounting."""
+    return len(text) // 4 + 1
+
+
+class RateLimitError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket():
+    """Bucket of capacity units refilled continuously over a minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        """Seconds until amount units are available."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.rate
+
+    def consume(self, amount):
+        self.available -= min(amount, self.capacity)
+
+
+class RateLimiter():
+    """Requests- and tokens-per-minute limiter for one provider endpoint.
+
+    Callers wait in per-chat queues that are served round-robin, so a chat
+    sending a burst can't starve the others. pause() stops all callers, which
+    is how a Retry-After from the provider is honored globally.
+    """
+
+    def __init__(self, name, rpm, tpm=None):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+        self._queues = OrderedDict()
+        self._scheduler = None
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._loop = None
+
+        self.waits = 0
+        self.pauses = 0
+
+    def bind(self, loop):
+        """Remember the event loop so worker threads can acquire as well."""
+        self._loop = loop
+
+    def pause(self, seconds):
+        """Hold back every caller for the given number of seconds.
+
+        Safe to call from worker threads, the change is applied on the loop.
+        """
+        loop = self._loop
+        try:
+            on_loop = loop is None or asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop or not loop.is_running():
+            self._pause(seconds)
+        else:
+            loop.call_soon_threadsafe(self._pause, seconds)
+
+    def _pause(self, seconds):
+        self.pauses += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._wakeup.set()
+
+    async def acquire(self, tokens=0, key=None):
+        """Wait until a request with the given token cost may be sent."""
+        if self.requests is None and self.tokens is None:
+            return
+        self._loop = asyncio.get_running_loop()
+        if key is None:
+            key = current_chat_user_id.get()
+
+        future = self._loop.create_future()
+        self._queues.setdefault(key, deque()).append((tokens, future))
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = asyncio.create_task(self._schedule())
+        self._wakeup.set()
+        await future
+
+    def acquire_sync(self, tokens=0, key=None):
+        """Blocking acquire for code running in worker threads."""
+        loop = self._loop
+        if loop is None or not loop.is_running():
+            return
+        try:
+            if asyncio.get_running_loop() is loop:
+                # Blocking here would deadlock the event loop
+                return
+        except RuntimeError:
+            pass
+        if key is None:
+            key = current_chat_user_id.get()
+        asyncio.run_coroutine_threadsafe(self.acquire(tokens=tokens, key=key), loop).result()
+
+    def _delay(self, tokens, now):
+        delay = max(0.0, self._paused_until - now)
+        if self.requests is not None:
+            delay = max(delay, self.requests.delay(1, now))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.delay(tokens, now))
+        return delay
+
+    async def _schedule(self):
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            tokens, future = queue[0]
+
+            if not future.cancelled():
+                delay = self._delay(tokens, time.monotonic())
+                if delay > 0:
+                    self.waits += 1
+                    self._wakeup.clear()
+                    try:
+                        # Wake up early when a pause changes the schedule
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                if self.requests is not None:
+                    self.requests.consume(1)
+                if self.tokens is not None:
+                    self.tokens.consume(tokens)
+                future.set_result(None)
+
+            # Serve the next chat before this one gets another turn
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+
+    def stats(self):
+        return {
+            "waiting": sum(len(queue) for queue in self._queues.values()),
+            "waits": self.waits,
+            "pauses": self.pauses,
+        }
+
+
+limiters = {name: RateLimiter(name, rpm, tpm) for name, (rpm, tpm) in RATE_LIMITS.items()}
+
+
+def get_limiter(endpoint):
+    return limiters.get(endpoint)
+
+
+# Event loop the bot runs on, set at startup
+_loop = None
+
+
+def bind_loop(loop):
+    """Let worker threads schedule through the limiters of this loop."""
+    global _loop
+    _loop = loop
+    for limiter in limiters.values():
+        limiter.bind(loop)
+
+
+def bound_loop():
+    """Return the loop passed to bind_loop(), if any."""
+    return _loop
+
+
+def _retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return int(headers.get("Retry-After", 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+async def handle_rate_limiting(func, *args, is_async=True, endpoint=None, tokens=0, **kwargs):
+    # The provider clients are only loaded once a call is made
+    import openai
+    import elevenlabs
+
+    retries = 5
+    backoff_factor = 2
+    limiter = get_limiter(endpoint)
+
+    for attempt in range(retries):
+        if limiter is not None:
+            await limiter.acquire(tokens=tokens)
+        try:
+            if is_async:
+                result = await func(*args, **kwargs)
+            else:
+                loop = asyncio.get_event_loop()
+                result = await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+            metrics.provider_retries.observe(attempt, endpoint=endpoint)
+            return result
+        except (openai.error.RateLimitError, elevenlabs.RateLimitError) as e:
+            retry_after = _retry_after(e)
+            wait_time = retry_after or (backoff_factor ** attempt)
+            if attempt == retries - 1:  # Check if it's the last attempt
+                metrics.provider_retries.observe(attempt, endpoint=endpoint)
+                raise RateLimitError("Too many rate-limited attempts.", retry_after=retry_after) from e
+
+            logger.warning(f"Rate limit exceeded. Retrying in {wait_time} seconds...")
+            if limiter is not None:
+                # Every caller of this endpoint backs off, not just this one
+                limiter.pause(wait_time)
+            else:
+                await asyncio.sleep(wait_time)
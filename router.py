@@ -0,0 +1,73 @@
+"""
+Rule-based pre-router that answers simple messages without the ReAct agent.
+"""
+
+import os
+import re
+
+import metrics
+
+# Route messages before the agent; when off every message goes to the agent
+ROUTER_ENABLED = os.environ.get("ROUTER_ENABLED", "1") == "1"
+
+# Longest message, in words, that can still count as small talk
+SMALL_TALK_MAX_WORDS = int(os.environ.get("SMALL_TALK_MAX_WORDS", 6))
+
+AGENT = "agent"
+SMALL_TALK = "small_talk"
+IMAGE = "image"
+DOCUMENTS = "documents"
+
+_GREETING = (r"(hi|hello|hey|hiya|yo|good (morning|afternoon|evening|night)|thanks?|thank you|thx|ty|cheers|ok(ay)?|cool|"
+             r"great|nice|awesome|perfect|got it|sure|yes|no|yep|nope|yeah|bye|goodbye|see you|lol|haha+|how are you|"
+             r"how'?s it going|what'?s up|sup)")
+# The whole message has to be small talk, "thanks, now search for it" is a request
+SMALL_TALK_PATTERN = re.compile(
+    rf"^{_GREETING}([\s,.!?]+({_GREETING}|there|again|so much|a lot|all|everyone|guys))*[\s,.!?]*$", re.IGNORECASE)
+# Short answers after a reply that asked something answer the agent's question
+ANSWER_PATTERN = re.compile(r"^(ok(ay)?|sure|yes|no|yep|nope|yeah|got it)\b", re.IGNORECASE)
+
+# Small talk may only ask these questions, anything else needs the agent's tools
+SMALL_TALK_QUESTION = re.compile(r"^(hi|hello|hey)?[\s,!]*(how are you|how'?s it going|what'?s up|sup)\b", re.IGNORECASE)
+
+# Bare "draw" needs "me" or an article, and not a figure of speech such as "draw a conclusion"
+IMAGE_PATTERN = re.compile(
+    r"^(?:please\s+|can you\s+|could you\s+)?(?:draw|paint|sketch|generate|create|make|show)\s+(?:me\s+)?(?:an?\s+)?"
+    r"(?:image|picture|photo|drawing|illustration|painting|sketch)s?\s+(?:of\s+)?(?P<prompt>.+)$"
+    r"|^(?:please\s+)?(?:draw|paint|sketch)\s+(?:me\s+(?:an?\s+|the\s+)?|an?\s+)"
+    r"(?!(?:conclusions?|comparisons?|lines?|distinctions?|parallels?|blanks?|breath|attention|card|crowd|picture)\b)(?P<subject>.+)$",
+    re.IGNORECASE)
+
+# Only explicit references to the user's own material, "the file" alone may be any file
+_MATERIAL = r"(documents?|docs?|files?|pdfs?|notes|pages?|articles?|papers?|reports?)"
+DOCUMENTS_PATTERN = re.compile(
+    rf"\b(my|our)\s+(saved\s+|uploaded\s+)?{_MATERIAL}\b"
+    rf"|\b(uploaded|saved)\s+{_MATERIAL}\b"
+    rf"|\b(the|this|that|these|those)\s+{_MATERIAL}\s+(that\s+)?(i|we)\s+(just\s+)?(sent|uploaded|saved|shared|gave)\b", re.IGNORECASE)
+
+# Document questions go to the agent unless a stored passage is at least this similar
+DOCUMENTS_MIN_SCORE = float(os.environ.get("ROUTER_DOCUMENTS_MIN_SCORE", 0.78))
+
+routes = metrics.registry.counter("routes_total", "Messages per pre-router route.")
+
+
+def classify(message, previous_reply=None):
+    """Return (route, argument): the image prompt for IMAGE, the message otherwise.
+
+    previous_reply is the bot's last answer in the chat, if any.
+    """
+    text = message.strip()
+    if not ROUTER_ENABLED:
+        return AGENT, text
+
+    image = IMAGE_PATTERN.match(text)
+    if image:
+        return IMAGE, (image.group("prompt") or image.group("subject")).strip(" .!")
+    if DOCUMENTS_PATTERN.search(text):
+        return DOCUMENTS, text
+    if ANSWER_PATTERN.match(text) and "?" in (previous_reply or ""):
+        return AGENT, text
+    if len(text.split()) <= SMALL_TALK_MAX_WORDS and SMALL_TALK_PATTERN.match(text):
+        if "?" not in text or SMALL_TALK_QUESTION.match(text):
+            return SMALL_TALK, text
+    return AGENT, text
@@ -0,0 +1,95 @@
+"""
+Concurrent update processing that keeps each chat's updates in order.
+"""
+
+import os
+import asyncio
+import logging
+import functools
+
+# Scheduler limits
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 32))
+MAX_CHAT_QUEUE_DEPTH = int(os.environ.get("MAX_CHAT_QUEUE_DEPTH", 5))
+MAX_WAITING_UPDATES = int(os.environ.get("MAX_WAITING_UPDATES", 256))
+
+BUSY_TEXT = "I'm a bit busy right now. Please try again in a moment."
+
+logger = logging.getLogger(__name__)
+
+
+class ChatScheduler():
+    """Run updates of different chats in parallel and each chat's in order.
+
+    Every chat has a FIFO lock, so its updates are handled one after the
+    other in arrival order, while a global semaphore caps how many handlers
+    run at once. Updates beyond max_queue_depth for one chat, or beyond
+    max_waiting overall, are shed with a polite busy reply.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_UPDATES, max_queue_depth=MAX_CHAT_QUEUE_DEPTH, max_waiting=MAX_WAITING_UPDATES):
+        self.max_concurrent = max_concurrent
+        self.max_queue_depth = max_queue_depth
+        self.max_waiting = max_waiting
+
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._locks = {}
+        self._depths = {}
+        self._waiting = 0
+
+        self.processed = 0
+        self.shed = 0
+
+    async def run(self, chat_id, callback, *args):
+        """Run callback(*args) in order with the chat's other updates.
+
+        Returns False when the update was shed.
+        """
+        if self._depths.get(chat_id, 0) >= self.max_queue_depth or self._waiting >= self.max_waiting:
+            self.shed += 1
+            return False
+
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._depths[chat_id] = self._depths.get(chat_id, 0) + 1
+        self._waiting += 1
+        started = False
+        try:
+            async with lock:
+                async with self._semaphore:
+                    self._waiting -= 1
+                    started = True
+                    try:
+                        await callback(*args)
+                    finally:
+                        self.processed += 1
+        finally:
+            # Cancelled while still queued
+            if not started:
+                self._waiting -= 1
+            self._depths[chat_id] -= 1
+            if not self._depths[chat_id]:
+                del self._depths[chat_id]
+                del self._locks[chat_id]
+        return True
+
+    def serialize(self, handler):
+        """Wrap a PTB handler callback so it runs through the scheduler."""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            chat = update.effective_chat
+            if chat is None:
+                return await handler(update, context)
+
+            if not await self.run(chat.id, handler, update, context):
+                logger.warning(f"Shedding update for chat {chat.id}, too many updates in flight")
+                if update.effective_message is not None:
+                    await update.effective_message.reply_text(BUSY_TEXT)
+        return wrapper
+
+    def stats(self):
+        return {
+            "in_flight": self.max_concurrent - self._semaphore._value,
+            "waiting": self._waiting,
+            "chats": len(self._depths),
+            "processed": self.processed,
+            "shed": self.shed,
+        }
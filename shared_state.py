@@ -0,0 +1,527 @@
+"""
+State shared by the bot's worker processes: conversation history, caches and fetched web pages.
+"""
+
+import os
+import abc
+import json
+import time
+import fcntl
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import contextlib
+
+from cache import SQLITE_MAX_PARAMS, DiskCache
+
+# Where shared state is kept: "sqlite" databases, or "files" with one file
+# per entry, e.g. on a volume shared by several nodes
+SHARED_STATE = os.environ.get("SHARED_STATE", "sqlite")
+SHARED_STATE_DIR = os.environ.get("SHARED_STATE_DIR", "state")
+
+logger = logging.getLogger(__name__)
+
+
+def _file_name(key):
+    return hashlib.sha256(str(key).encode("utf-8")).hexdigest()
+
+
+def _write_atomic(path, data):
+    """Write a file so readers in other processes never see it half written."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+
+class KeyValueStore(abc.ABC):
+    """Interface of the byte caches (embeddings, summaries, speech).
+
+    DiskCache in cache.py is the SQLite implementation, FileCache the
+    file-backed one. Implementations must be safe to share between
+    processes.
+    """
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    @abc.abstractmethod
+    def get_many(self, keys):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    @abc.abstractmethod
+    def set_many(self, items):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, key):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stats(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# DiskCache lives in cache.py, which this module builds on
+KeyValueStore.register(DiskCache)
+
+
+class FileCache(KeyValueStore):
+    """Byte cache with one file per key, evicting the least recently used files.
+
+    Writes are atomic renames, so any number of processes can share the
+    directory. Each process tracks the bytes it wrote since the directory
+    was last scanned, and rescans before evicting, so the limit holds
+    approximately when several processes write at once.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._size = self._scan_size()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        name = _file_name(key)
+        return os.path.join(self.root, name[:2], name)
+
+    def _entries(self):
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if not entry.name.startswith(".tmp"):
+                    with contextlib.suppress(FileNotFoundError):
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def get_many(self, keys):
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for key in keys:
+            path = self._path(key)
+            try:
+                with open(path, "rb") as cached:
+                    found[key] = cached.read()
+                # The modification time tracks recency for eviction
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items):
+        written = 0
+        for key, value in items.items():
+            _write_atomic(self._path(key), value)
+            written += len(value)
+
+        with self._lock:
+            self._size += written
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def delete(self, key):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(key))
+
+    def _evict(self):
+        """Remove the least recently used files. Must hold the lock."""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if self._size <= target:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+                self.evictions += 1
+            self._size -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "bytes": self._size,
+            }
+
+
+def open_cache(path, max_bytes, table="cache", kind=None):
+    """Open the cache for a table with the configured shared state kind."""
+    kind = kind or SHARED_STATE
+    if kind == "files":
+        return FileCache(os.path.join(SHARED_STATE_DIR, table), max_bytes)
+    if kind != "sqlite":
+        raise ValueError(f"Unknown shared state kind: {kind}")
+    return DiskCache(path, max_bytes, table=table)
+
+
+class ConversationState(abc.ABC):
+    """Interface ConversationStore uses to store the turns and summary of each chat.
+
+    All methods are blocking and are called from a thread pool. Turns are
+    (id, human, ai, tokens) tuples with ids increasing per chat.
+    """
+
+    @abc.abstractmethod
+    def load(self, chat_id):
+        """Return (summary, summary_tokens, turns), turns oldest first."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def append(self, chat_id, human, ai, tokens):
+        """Store a turn and return the tokens of all stored turns of the chat."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def replace(self, chat_id, summary, summary_tokens, last_id):
+        """Set the summary, unless it is None, and drop the turns up to last_id."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, chat_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteConversationState(ConversationState):
+    """Turns and summaries in SQLite, shared by processes on one host."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                human TEXT NOT NULL,
+                ai TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                created_at REAL NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS turns_chat_id ON turns (chat_id, id)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS summaries (
+                chat_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                tokens INTEGER NOT NULL)""")
+        self._conn.commit()
+
+    def load(self, chat_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, tokens FROM summaries WHERE chat_id = ?", (chat_id,)).fetchone()
+            turns = self._conn.execute(
+                "SELECT id, human, ai, tokens FROM turns WHERE chat_id = ? ORDER BY id", (chat_id,)).fetchall()
+        summary, tokens = row if row else (None, 0)
+        return summary, tokens, turns
+
+    def append(self, chat_id, human, ai, tokens):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO turns (chat_id, human, ai, tokens, created_at) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, human, ai, tokens, time.time()))
+            self._conn.commit()
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(tokens), 0) FROM turns WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+
+    def replace(self, chat_id, summary, summary_tokens, last_id):
+        with self._lock:
+            if summary is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO summaries (chat_id, summary, tokens) VALUES (?, ?, ?)",
+                    (chat_id, summary, summary_tokens))
+            self._conn.execute("DELETE FROM turns WHERE chat_id = ? AND id <= ?", (chat_id, last_id))
+            self._conn.commit()
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM turns WHERE chat_id = ?", (chat_id,))
+            self._conn.execute("DELETE FROM summaries WHERE chat_id = ?", (chat_id,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class _ChatFiles():
+    """One JSON file per chat, updated under an exclusive file lock.
+
+    Works on any shared file system with flock support, so workers on
+    several nodes can serve the same chats.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, chat_id):
+        return os.path.join(self.root, _file_name(chat_id) + ".json")
+
+    @contextlib.contextmanager
+    def _locked(self, chat_id):
+        with open(self._path(chat_id) + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, chat_id, state):
+        _write_atomic(self._path(chat_id), json.dumps(state).encode("utf-8"))
+
+    def delete(self, chat_id):
+        with self._locked(chat_id):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(chat_id))
+
+
+class FileConversationState(_ChatFiles, ConversationState):
+    """Turns and summary of each chat in its own JSON file."""
+
+    def _read(self, chat_id):
+        try:
+            with open(self._path(chat_id), encoding="utf-8") as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return {"summary": None, "summary_tokens": 0, "next_id": 1, "turns": []}
+
+    def load(self, chat_id):
+        with self._locked(chat_id):
+            state = self._read(chat_id)
+        return state["summary"], state["summary_tokens"], [tuple(turn) for turn in state["turns"]]
+
+    def append(self, chat_id, human, ai, tokens):
+        with self._locked(chat_id):
+            state = self._read(chat_id)
+            state["turns"].append([state["next_id"], human, ai, tokens])
+            state["next_id"] += 1
+            self._write(chat_id, state)
+        return sum(turn[3] for turn in state["turns"])
+
+    def replace(self, chat_id, summary, summary_tokens, last_id):
+        with self._locked(chat_id):
+            state = self._read(chat_id)
+            if summary is not None:
+                state["summary"], state["summary_tokens"] = summary, summary_tokens
+            state["turns"] = [turn for turn in state["turns"] if turn[0] > last_id]
+            self._write(chat_id, state)
+
+
+def open_conversation_state(path, kind=None):
+    """Open the conversation state with the configured shared state kind."""
+    kind = kind or SHARED_STATE
+    if kind == "files":
+        return FileConversationState(os.path.join(SHARED_STATE_DIR, "conversations"))
+    if kind != "sqlite":
+        raise ValueError(f"Unknown shared state kind: {kind}")
+    return SQLiteConversationState(path)
+
+
+class PageState(abc.ABC):
+    """Interface for the web pages each chat saved: validators, summary and chunk ids.
+
+    Records are dicts with etag, last_modified, digest (hash of the
+    fetched body) and summary. Chunk ids are content hashes shared by
+    every source of a chat, so uploaded documents record their chunks as
+    references too and a page refresh never removes them. All methods
+    are blocking.
+    """
+
+    @abc.abstractmethod
+    def get(self, chat_id, url):
+        """Return the record of a page, or None if the chat never saved it."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def urls(self, chat_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def replace(self, chat_id, url, record, chunk_ids):
+        """Store a page and its chunk ids.
+
+        Returns the ids the page had before that no page or reference of
+        the chat has now, these are the stale chunks to remove from the
+        chat's store.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reference(self, chat_id, source, chunk_ids):
+        """Record chunks another source of the chat, e.g. a document, keeps."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, chat_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLitePageState(PageState):
+    """Pages and their chunk ids in SQLite, shared by processes on one host."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                chat_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                digest TEXT,
+                summary TEXT,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (chat_id, url))""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS page_chunks (
+                chat_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                PRIMARY KEY (chat_id, url, chunk_id))""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS page_chunks_chunk_id ON page_chunks (chat_id, chunk_id)")
+        self._conn.commit()
+
+    def get(self, chat_id, url):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, digest, summary FROM pages WHERE chat_id = ? AND url = ?", (chat_id, url)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("etag", "last_modified", "digest", "summary"), row))
+
+    def urls(self, chat_id):
+        with self._lock:
+            rows = self._conn.execute("SELECT url FROM pages WHERE chat_id = ? ORDER BY fetched_at", (chat_id,)).fetchall()
+        return [url for (url,) in rows]
+
+    def replace(self, chat_id, url, record, chunk_ids):
+        chunk_ids = set(chunk_ids)
+        with self._lock:
+            old = {chunk_id for (chunk_id,) in self._conn.execute(
+                "SELECT chunk_id FROM page_chunks WHERE chat_id = ? AND url = ?", (chat_id, url))}
+            removed = list(old - chunk_ids)
+            for start in range(0, len(removed), SQLITE_MAX_PARAMS):
+                batch = removed[start:start + SQLITE_MAX_PARAMS]
+                self._conn.execute(
+                    f"DELETE FROM page_chunks WHERE chat_id = ? AND url = ? AND chunk_id IN ({','.join('?' * len(batch))})",
+                    [chat_id, url, *batch])
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO page_chunks (chat_id, url, chunk_id) VALUES (?, ?, ?)",
+                [(chat_id, url, chunk_id) for chunk_id in chunk_ids - old])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (chat_id, url, etag, last_modified, digest, summary, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, url, record.get("etag"), record.get("last_modified"), record.get("digest"), record.get("summary"), time.time()))
+
+            # Chunks are content hashes, other pages of the chat can share them
+            shared = set()
+            for start in range(0, len(removed), SQLITE_MAX_PARAMS):
+                batch = removed[start:start + SQLITE_MAX_PARAMS]
+                shared.update(chunk_id for (chunk_id,) in self._conn.execute(
+                    f"SELECT DISTINCT chunk_id FROM page_chunks WHERE chat_id = ? AND chunk_id IN ({','.join('?' * len(batch))})",
+                    [chat_id, *batch]))
+            self._conn.commit()
+        return [chunk_id for chunk_id in removed if chunk_id not in shared]
+
+    def reference(self, chat_id, source, chunk_ids):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO page_chunks (chat_id, url, chunk_id) VALUES (?, ?, ?)",
+                [(chat_id, source, chunk_id) for chunk_id in set(chunk_ids)])
+            self._conn.commit()
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM page_chunks WHERE chat_id = ?", (chat_id,))
+            self._conn.execute("DELETE FROM pages WHERE chat_id = ?", (chat_id,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class FilePageState(_ChatFiles, PageState):
+    """All pages of each chat in its own JSON file."""
+
+    def _read(self, chat_id):
+        try:
+            with open(self._path(chat_id), encoding="utf-8") as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, chat_id, url):
+        with self._locked(chat_id):
+            page = self._read(chat_id).get(url)
+        if page is None:
+            return None
+        return {name: page.get(name) for name in ("etag", "last_modified", "digest", "summary")}
+
+    def urls(self, chat_id):
+        with self._locked(chat_id):
+            pages = self._read(chat_id)
+        return sorted((url for url, page in pages.items() if not page.get("reference")), key=lambda url: pages[url]["fetched_at"])
+
+    def replace(self, chat_id, url, record, chunk_ids):
+        with self._locked(chat_id):
+            pages = self._read(chat_id)
+            old = set(pages.get(url, {}).get("chunk_ids", ()))
+            pages[url] = {**record, "chunk_ids": sorted(set(chunk_ids)), "fetched_at": time.time()}
+            self._write(chat_id, pages)
+        referenced = {chunk_id for page in pages.values() for chunk_id in page["chunk_ids"]}
+        return [chunk_id for chunk_id in old if chunk_id not in referenced]
+
+    def reference(self, chat_id, source, chunk_ids):
+        with self._locked(chat_id):
+            pages = self._read(chat_id)
+            chunk_ids = set(chunk_ids) | set(pages.get(source, {}).get("chunk_ids", ()))
+            pages[source] = {"reference": True, "chunk_ids": sorted(chunk_ids), "fetched_at": time.time()}
+            self._write(chat_id, pages)
+
+
+def open_page_state(path, kind=None):
+    """Open the web page state with the configured shared state kind."""
+    kind = kind or SHARED_STATE
+    if kind == "files":
+        return FilePageState(os.path.join(SHARED_STATE_DIR, "pages"))
+    if kind != "sqlite":
+        raise ValueError(f"Unknown shared state kind: {kind}")
+    return SQLitePageState(path)
@@ -0,0 +1,194 @@
+"""
+Sentence-by-sentence text to speech with cached audio and Telegram file_id reuse.
+"""
+
+import os
+import re
+import asyncio
+import hashlib
+import logging
+
+from telegram.error import BadRequest
+
+import audio
+import metrics
+from shared_state import open_cache
+from ratelimit import handle_rate_limiting
+from startup import lazy_import
+
+# The ElevenLabs client is loaded on the first synthesis
+elevenlabs = lazy_import("elevenlabs")
+
+ELEVEN_API_KEY = os.environ.get("ELEVEN_API_KEY")
+
+# ElevenLabs voice settings
+TTS_VOICE = os.environ.get("TTS_VOICE", "Bella")
+TTS_MODEL = os.environ.get("TTS_MODEL", "eleven_monolingual_v1")
+TTS_MAX_CONCURRENCY = int(os.environ.get("TTS_MAX_CONCURRENCY", 3))
+
+# Sentences shorter than this are joined with the next one
+TTS_MIN_CHARS = int(os.environ.get("TTS_MIN_CHARS", 40))
+
+# Synthesized sentences and the file_ids of sent voice messages
+TTS_CACHE_PATH = os.environ.get("TTS_CACHE_PATH", "speech_cache.sqlite3")
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# End of a sentence, including closing quotes or brackets and the whitespace after it
+SENTENCE_END = re.compile(r"[.!?…]+[\"')\]]*\s+|\n+")
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class Speech():
+    """A synthesized voice reply, as OGG/Opus bytes or a Telegram file_id."""
+
+    def __init__(self, key, text, data=None, file_id=None):
+        self.key = key
+        self.text = text
+        self.data = data
+        self.file_id = file_id
+
+
+class SpeechSynthesizer():
+    """ElevenLabs text to speech, one cached call per sentence.
+
+    Sentences are cached by (text, voice, model), so common phrases are
+    only synthesized once, and their MP3s are joined and encoded to
+    OGG/Opus in the audio process pool. Voice messages that were sent
+    before are re-sent by their Telegram file_id instead of uploading them.
+    """
+
+    def __init__(self, voice=TTS_VOICE, model=TTS_MODEL, max_concurrency=TTS_MAX_CONCURRENCY, cache=None, file_ids=None):
+        self.voice = voice
+        self.model = model
+        self.cache = cache or open_cache(TTS_CACHE_PATH, TTS_CACHE_MAX_BYTES, table="speech")
+        self.file_ids = file_ids or open_cache(TTS_CACHE_PATH, TTS_CACHE_MAX_BYTES, table="voice_file_ids")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def key(self, text):
+        return _hash(self.voice, self.model, text)
+
+    async def sentence(self, text):
+        """Return the MP3 audio of one piece of text."""
+        key = self.key(text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        async with self._semaphore:
+            with metrics.span("elevenlabs.tts", chars=len(text)):
+                data = await handle_rate_limiting(elevenlabs.generate, api_key=ELEVEN_API_KEY, text=text, voice=self.voice, model=self.model, is_async=False, endpoint="elevenlabs.tts", tokens=len(text))
+
+        self.cache.set(key, data)
+        return data
+
+    def stream(self):
+        """Start synthesizing an answer that is still being generated."""
+        return SpeechStream(self)
+
+    async def synthesize(self, text):
+        """Return the Speech for a complete text."""
+        return await self.stream().finish(text)
+
+    async def reply(self, message, speech):
+        """Send a voice reply, reusing the Telegram file_id when there is one."""
+        if speech.file_id is not None:
+            try:
+                return await message.reply_voice(voice=speech.file_id)
+            except BadRequest as e:
+                logger.info(f"Stored voice file_id was rejected, uploading again: {e}")
+                self.file_ids.delete(speech.key)
+                speech = await self.synthesize(speech.text)
+
+        if speech is None or speech.data is None:
+            return None
+        with metrics.span("telegram.send_voice"):
+            sent = await message.reply_voice(voice=speech.data)
+        if sent is not None and sent.voice is not None:
+            self.file_ids.set(speech.key, sent.voice.file_id.encode("utf-8"))
+        return sent
+
+
+class SpeechStream():
+    """Synthesize an answer sentence by sentence while it streams in.
+
+    update() takes the answer generated so far and starts synthesis for
+    every sentence it completes, so most of the audio is ready when the
+    answer is. The split only depends on the text, which keeps the sentence
+    cache keys stable between streamed and complete answers.
+    """
+
+    def __init__(self, synthesizer):
+        self.synthesizer = synthesizer
+        self._text = ""
+        # End of the text already handed to synthesis, and of the last scan
+        self._start = 0
+        self._scanned = 0
+        self._tasks = []
+
+    def _dispatch(self, piece):
+        self._tasks.append(asyncio.create_task(self.synthesizer.sentence(piece)))
+
+    def _split(self, text, final=False):
+        for match in SENTENCE_END.finditer(text, self._scanned):
+            self._scanned = match.end()
+            piece = text[self._start:match.end()].strip()
+            if len(piece) >= TTS_MIN_CHARS:
+                self._dispatch(piece)
+                self._start = match.end()
+        if final:
+            piece = text[self._start:].strip()
+            if piece:
+                self._dispatch(piece)
+            self._start = self._scanned = len(text)
+
+    async def update(self, text):
+        """Feed the answer generated so far."""
+        if not text.startswith(self._text[:self._start]):
+            # The answer was rewritten, what was dispatched no longer applies
+            self.cancel()
+        self._text = text
+        self._split(text)
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._text = ""
+        self._start = self._scanned = 0
+
+    async def finish(self, text):
+        """Synthesize what is left and return the Speech for the whole text."""
+        text = text.strip()
+        key = self.synthesizer.key(text)
+        file_id = self.synthesizer.file_ids.get(key)
+        if file_id is not None:
+            self.cancel()
+            return Speech(key, text, file_id=file_id.decode("utf-8"))
+
+        if not text.startswith(self._text[:self._start].rstrip()):
+            self.cancel()
+        self._text = text
+        self._split(text, final=True)
+
+        try:
+            parts = await asyncio.gather(*self._tasks)
+        except BaseException:
+            self.cancel()
+            raise
+        if not parts:
+            return None
+        with metrics.span("audio.encode_voice", parts=len(parts)):
+            data = await audio.encode_voice(parts, source_format="mp3")
+        return Speech(key, text, data=data)
+
+
+synthesizer = SpeechSynthesizer()
@@ -0,0 +1,159 @@
+"""
+Startup timing: per-module import times, lazily imported modules and a startup report.
+"""
+
+import os
+import sys
+import time
+import logging
+import importlib
+import threading
+
+from importlib.abc import Loader, MetaPathFinder
+
+# Log where startup time went once the bot is up
+STARTUP_REPORT = os.environ.get("STARTUP_REPORT", "1") == "1"
+STARTUP_REPORT_TOP = int(os.environ.get("STARTUP_REPORT_TOP", 15))
+
+logger = logging.getLogger(__name__)
+
+started_at = time.perf_counter()
+
+
+class _TimingLoader(Loader):
+    """Loader wrapper that times exec_module of the wrapped loader."""
+
+    def __init__(self, loader, timer):
+        self.loader = loader
+        self.timer = timer
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Code that inspects module.__loader__ sees the real loader
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+        self.timer._enter()
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.timer._exit(module.__name__, time.perf_counter() - start)
+
+
+class ImportTimer(MetaPathFinder):
+    """Record how long each module takes to import.
+
+    Installed first on sys.meta_path, it lets the other finders locate the
+    module and wraps the loader they return. Both the cumulative time and
+    the time excluding nested imports are kept per module.
+    """
+
+    def __init__(self):
+        self.cumulative = {}
+        self.own = {}
+        self._local = threading.local()
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                spec.loader = _TimingLoader(spec.loader, self)
+            return spec
+        return None
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _enter(self):
+        self._stack().append(0.0)
+
+    def _exit(self, name, elapsed):
+        stack = self._stack()
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        self.cumulative[name] = elapsed
+        self.own[name] = elapsed - nested
+
+    def by_package(self):
+        """Import time per top-level package, excluding nested imports of other packages."""
+        totals = {}
+        for name, seconds in self.own.items():
+            package = name.split(".", 1)[0]
+            totals[package] = totals.get(package, 0.0) + seconds
+        return totals
+
+
+timer = ImportTimer()
+if STARTUP_REPORT:
+    timer.install()
+
+# Lazily imported modules and the seconds their first import took
+lazy_imports = {}
+
+
+class LazyModule():
+    """Module proxy that imports the module on first attribute access."""
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def load(self):
+        """Import the module now, e.g. from a warm-up thread."""
+        module = self.__dict__["_module"]
+        if module is None:
+            start = time.perf_counter()
+            module = importlib.import_module(self._name)
+            if self._name not in lazy_imports:
+                lazy_imports[self._name] = time.perf_counter() - start
+                logger.info(f"Imported {self._name} in {lazy_imports[self._name]:.2f}s")
+            self.__dict__["_module"] = module
+        return module
+
+    @property
+    def loaded(self):
+        return self.__dict__["_module"] is not None or self._name in sys.modules
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def report(steps=None):
+    """Log the time to startup, the slowest packages and the warm-up steps."""
+    if not STARTUP_REPORT:
+        return
+    lines = [f"Startup took {time.perf_counter() - started_at:.2f}s"]
+    packages = sorted(timer.by_package().items(), key=lambda item: item[1], reverse=True)
+    for package, seconds in packages[:STARTUP_REPORT_TOP]:
+        lines.append(f"  import {package}: {seconds:.3f}s")
+    for name, seconds in lazy_imports.items():
+        lines.append(f"  lazy import {name}: {seconds:.3f}s")
+    for name, seconds in (steps or {}).items():
+        lines.append(f"  warm-up {name}: {seconds:.3f}s")
+    logger.info("\n".join(lines))
@@ -0,0 +1,465 @@
+"""
+Storage backends for the chunks and vectors of each chat (tenant).
+"""
+
+import os
+import abc
+import json
+import shutil
+import logging
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+
+# Settings for the memory-mapped backend
+MMAP_ROOT = os.environ.get("MMAP_ROOT", "vectors")
+MMAP_MAX_LOADED = int(os.environ.get("MMAP_MAX_LOADED", 1024))
+
+# Name of the single collection used by the shared backend
+SHARED_COLLECTION = os.environ.get("SHARED_COLLECTION", "documents")
+
+# Chroma fetches large collections page by page
+EXPORT_PAGE_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBackend(abc.ABC):
+    """Interface VectorDB uses to store and search the chunks of a tenant.
+
+    All methods are blocking and are called from the ingestion thread pool.
+    search() returns (document, metadata, score, embedding) tuples, best
+    first, where score is the cosine similarity and embedding is only set
+    when include_embeddings is true.
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def existing_ids(self, tenant, ids):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add(self, tenant, ids, embeddings, documents, metadatas):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, tenant, ids):
+        """Return a dict of chunk id to (document, metadata) for the stored ids."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, tenant, ids):
+        """Remove chunks of a tenant, ids that are not stored are ignored."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def search(self, tenant, embedding, n, include_embeddings=False):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def count(self, tenant):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_tenant(self, tenant):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def tenants(self):
+        """Return the names of all tenants with stored chunks."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def export(self, tenant):
+        """Yield (ids, embeddings, documents, metadatas) pages of a tenant."""
+        raise NotImplementedError
+
+
+def _chroma_results(results, include_embeddings):
+    """Convert a Chroma query result into search() tuples."""
+    documents, metadatas, distances = results["documents"][0], results["metadatas"][0], results["distances"][0]
+    embeddings = results["embeddings"][0] if include_embeddings else [None] * len(documents)
+    # Chroma returns squared L2 distances, OpenAI embeddings are unit length
+    return [(document, metadata or {}, 1.0 - distance / 2, vector)
+            for document, metadata, distance, vector in zip(documents, metadatas, distances, embeddings)]
+
+
+class CollectionBackend(StorageBackend):
+    """One Chroma collection per tenant, the original layout."""
+
+    name = "collections"
+
+    def __init__(self, client, persistence=None, max_open=1024):
+        self.client = client
+        self.persistence = persistence
+        self.max_open = max_open
+        self._collections = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _collection(self, tenant):
+        with self._lock:
+            collection = self._collections.get(tenant)
+            if collection is None:
+                collection = self.client.get_or_create_collection(tenant)
+                self._collections[tenant] = collection
+                while len(self._collections) > self.max_open:
+                    self._collections.popitem(last=False)
+            else:
+                self._collections.move_to_end(tenant)
+            return collection
+
+    def existing_ids(self, tenant, ids):
+        if not ids:
+            return set()
+        return set(self._collection(tenant).get(ids=ids, include=[])["ids"])
+
+    def add(self, tenant, ids, embeddings, documents, metadatas):
+        collection = self._collection(tenant)
+        if self.persistence is not None:
+            # Journaled now, persisted to disk in batches
+            self.persistence.add(collection, ids, embeddings, documents, metadatas)
+        else:
+            collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+            self.client.persist()
+
+    def get(self, tenant, ids):
+        if not ids:
+            return {}
+        page = self._collection(tenant).get(ids=ids, include=["documents", "metadatas"])
+        return {chunk_id: (document, metadata or {}) for chunk_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"])}
+
+    def delete(self, tenant, ids):
+        if not ids:
+            return
+        collection = self._collection(tenant)
+        if self.persistence is not None:
+            self.persistence.delete(collection, ids=list(ids))
+        else:
+            collection.delete(ids=list(ids))
+            self.client.persist()
+
+    def search(self, tenant, embedding, n, include_embeddings=False):
+        collection = self._collection(tenant)
+        count = collection.count()
+        if not count:
+            return []
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if include_embeddings else [])
+        results = collection.query(query_embeddings=[embedding], n_results=min(n, count), include=include)
+        return _chroma_results(results, include_embeddings)
+
+    def count(self, tenant):
+        return self._collection(tenant).count()
+
+    def delete_tenant(self, tenant):
+        with self._lock:
+            self._collections.pop(tenant, None)
+        if self.persistence is not None:
+            self.persistence.delete_collection(tenant)
+        else:
+            self.client.delete_collection(tenant)
+            self.client.persist()
+
+    def tenants(self):
+        return [collection.name for collection in self.client.list_collections()]
+
+    def export(self, tenant):
+        collection = self._collection(tenant)
+        for offset in range(0, collection.count(), EXPORT_PAGE_SIZE):
+            page = collection.get(include=["embeddings", "documents", "metadatas"], offset=offset, limit=EXPORT_PAGE_SIZE)
+            yield page["ids"], page["embeddings"], page["documents"], page["metadatas"]
+
+
+class SharedCollectionBackend(CollectionBackend):
+    """A single Chroma collection for all tenants, partitioned by metadata.
+
+    Chunk ids are prefixed with the tenant and every chunk carries a
+    "tenant" metadata field that searches filter on, so the number of
+    collections no longer grows with the number of chats.
+    """
+
+    name = "shared"
+
+    def __init__(self, client, persistence=None, collection_name=SHARED_COLLECTION):
+        super().__init__(client, persistence=persistence)
+        self.collection_name = collection_name
+        # Chunk counts per tenant, filled on first use
+        self._counts = {}
+
+    @staticmethod
+    def _prefix(tenant, ids):
+        return [f"{tenant}:{chunk_id}" for chunk_id in ids]
+
+    def existing_ids(self, tenant, ids):
+        if not ids:
+            return set()
+        found = self._collection(self.collection_name).get(ids=self._prefix(tenant, ids), include=[])["ids"]
+        return {chunk_id.split(":", 1)[1] for chunk_id in found}
+
+    def add(self, tenant, ids, embeddings, documents, metadatas):
+        count = self.count(tenant)
+        metadatas = [{**(metadata or {}), "tenant": tenant} for metadata in metadatas]
+        super().add(self.collection_name, self._prefix(tenant, ids), embeddings, documents, metadatas)
+        self._counts[tenant] = count + len(ids)
+
+    def get(self, tenant, ids):
+        if not ids:
+            return {}
+        page = self._collection(self.collection_name).get(ids=self._prefix(tenant, ids), include=["documents", "metadatas"])
+        return {chunk_id.split(":", 1)[1]: (document, {key: value for key, value in (metadata or {}).items() if key != "tenant"})
+                for chunk_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"])}
+
+    def delete(self, tenant, ids):
+        existing = self.existing_ids(tenant, ids)
+        if not existing:
+            return
+        count = self.count(tenant)
+        super().delete(self.collection_name, self._prefix(tenant, existing))
+        self._counts[tenant] = count - len(existing)
+
+    def search(self, tenant, embedding, n, include_embeddings=False):
+        collection = self._collection(self.collection_name)
+        count = self.count(tenant)
+        if not count:
+            return []
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if include_embeddings else [])
+        results = collection.query(query_embeddings=[embedding], n_results=min(n, count), where={"tenant": tenant}, include=include)
+        return _chroma_results(results, include_embeddings)
+
+    def count(self, tenant):
+        count = self._counts.get(tenant)
+        if count is None:
+            count = len(self._collection(self.collection_name).get(where={"tenant": tenant}, include=[])["ids"])
+            self._counts[tenant] = count
+        return count
+
+    def delete_tenant(self, tenant):
+        self._counts.pop(tenant, None)
+        collection = self._collection(self.collection_name)
+        if self.persistence is not None:
+            self.persistence.delete(collection, where={"tenant": tenant})
+        else:
+            collection.delete(where={"tenant": tenant})
+            self.client.persist()
+
+    def tenants(self):
+        collection = self._collection(self.collection_name)
+        tenants = set()
+        for offset in range(0, collection.count(), EXPORT_PAGE_SIZE):
+            page = collection.get(include=["metadatas"], offset=offset, limit=EXPORT_PAGE_SIZE)
+            tenants.update(metadata["tenant"] for metadata in page["metadatas"] if metadata)
+        return sorted(tenants)
+
+    def export(self, tenant):
+        collection = self._collection(self.collection_name)
+        ids = collection.get(where={"tenant": tenant}, include=[])["ids"]
+        for start in range(0, len(ids), EXPORT_PAGE_SIZE):
+            page = collection.get(ids=ids[start:start + EXPORT_PAGE_SIZE], include=["embeddings", "documents", "metadatas"])
+            metadatas = [{key: value for key, value in (metadata or {}).items() if key != "tenant"} for metadata in page["metadatas"]]
+            yield [chunk_id.split(":", 1)[1] for chunk_id in page["ids"]], page["embeddings"], page["documents"], metadatas
+
+
+class _MmapTenant():
+    """In-memory view of one tenant of the memory-mapped backend."""
+
+    def __init__(self, path):
+        self.path = path
+        self.dim = None
+        self.rows = {}
+        self.offsets = []
+        # Rows of deleted chunks, masked until the tenant is deleted
+        self.deleted = set()
+        self._vectors = None
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as meta:
+                self.dim = json.load(meta)["dim"]
+
+        chunks_path = os.path.join(path, "chunks.jsonl")
+        if self.dim is None or not os.path.exists(chunks_path):
+            return
+
+        # Only rows present in both files count, a torn append is cut off
+        vectors_path = os.path.join(path, "vectors.f32")
+        stored_rows = os.path.getsize(vectors_path) // (4 * self.dim)
+        offset = 0
+        with open(chunks_path, "rb") as chunks:
+            for line in chunks:
+                if len(self.offsets) >= stored_rows or not line.endswith(b"\n"):
+                    break
+                chunk_id = json.loads(line)["id"]
+                self.rows[chunk_id] = len(self.offsets)
+                self.offsets.append(offset)
+                offset += len(line)
+
+        if os.path.getsize(chunks_path) > offset:
+            os.truncate(chunks_path, offset)
+        if os.path.getsize(vectors_path) > len(self.offsets) * 4 * self.dim:
+            os.truncate(vectors_path, len(self.offsets) * 4 * self.dim)
+
+        deleted_path = os.path.join(path, "deleted.rows")
+        if os.path.exists(deleted_path):
+            with open(deleted_path, encoding="utf-8") as deleted:
+                self.deleted = {int(line) for line in deleted if line.endswith("\n") and int(line) < len(self.offsets)}
+            self.rows = {chunk_id: row for chunk_id, row in self.rows.items() if row not in self.deleted}
+
+    def vectors(self):
+        """Memory-map the stored vectors, pages are read on demand."""
+        if self._vectors is None and self.offsets:
+            self._vectors = np.memmap(os.path.join(self.path, "vectors.f32"), dtype=np.float32, mode="r", shape=(len(self.offsets), self.dim))
+        return self._vectors
+
+    def read_chunks(self, rows):
+        chunks = []
+        with open(os.path.join(self.path, "chunks.jsonl"), "rb") as chunk_file:
+            for row in rows:
+                chunk_file.seek(self.offsets[row])
+                chunks.append(json.loads(chunk_file.readline()))
+        return chunks
+
+
+class MmapBackend(StorageBackend):
+    """Per-tenant flat vector files, memory-mapped and loaded lazily.
+
+    Each tenant directory holds vectors.f32 with normalized float32 rows and
+    chunks.jsonl with one line per row. A tenant is only read when first
+    used and at most max_loaded tenants are kept open, so memory follows
+    the active chats rather than the total. Searches are exact dot products
+    over the mapped rows, which is fast at per-chat sizes. Appends are
+    fsynced, so the files are always consistent without a separate persist.
+    Deleted chunks are recorded as row tombstones in deleted.rows.
+    """
+
+    name = "mmap"
+
+    def __init__(self, root=MMAP_ROOT, max_loaded=MMAP_MAX_LOADED):
+        self.root = root
+        self.max_loaded = max_loaded
+        self._tenants = OrderedDict()
+        self._lock = threading.RLock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, tenant):
+        return os.path.join(self.root, tenant)
+
+    def _tenant(self, tenant):
+        with self._lock:
+            state = self._tenants.get(tenant)
+            if state is None:
+                state = _MmapTenant(self._path(tenant))
+                self._tenants[tenant] = state
+                while len(self._tenants) > self.max_loaded:
+                    self._tenants.popitem(last=False)
+            else:
+                self._tenants.move_to_end(tenant)
+            return state
+
+    def existing_ids(self, tenant, ids):
+        rows = self._tenant(tenant).rows
+        return {chunk_id for chunk_id in ids if chunk_id in rows}
+
+    def add(self, tenant, ids, embeddings, documents, metadatas):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        with self._lock:
+            state = self._tenant(tenant)
+            os.makedirs(state.path, exist_ok=True)
+            if state.dim is None:
+                state.dim = vectors.shape[1]
+                with open(os.path.join(state.path, "meta.json"), "w", encoding="utf-8") as meta:
+                    json.dump({"dim": state.dim}, meta)
+
+            with open(os.path.join(state.path, "vectors.f32"), "ab") as vector_file:
+                vector_file.write(vectors.tobytes())
+                vector_file.flush()
+                os.fsync(vector_file.fileno())
+
+            chunks_path = os.path.join(state.path, "chunks.jsonl")
+            offset = os.path.getsize(chunks_path) if os.path.exists(chunks_path) else 0
+            with open(chunks_path, "ab") as chunk_file:
+                for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                    line = (json.dumps({"id": chunk_id, "document": document, "metadata": metadata or {}}) + "\n").encode("utf-8")
+                    chunk_file.write(line)
+                    state.rows[chunk_id] = len(state.offsets)
+                    state.offsets.append(offset)
+                    offset += len(line)
+                chunk_file.flush()
+                os.fsync(chunk_file.fileno())
+
+            # The mapping has to be reopened to see the new rows
+            state._vectors = None
+
+    def get(self, tenant, ids):
+        state = self._tenant(tenant)
+        rows = [state.rows[chunk_id] for chunk_id in ids if chunk_id in state.rows]
+        return {chunk["id"]: (chunk["document"], chunk["metadata"]) for chunk in state.read_chunks(rows)}
+
+    def delete(self, tenant, ids):
+        with self._lock:
+            state = self._tenant(tenant)
+            doomed = [chunk_id for chunk_id in ids if chunk_id in state.rows]
+            if not doomed:
+                return
+
+            # Rows stay in the append-only files and are masked, so a crash
+            # can only lose the tombstone, never misalign vectors and chunks
+            with open(os.path.join(state.path, "deleted.rows"), "a", encoding="utf-8") as deleted_file:
+                deleted_file.write("".join(f"{state.rows[chunk_id]}\n" for chunk_id in doomed))
+                deleted_file.flush()
+                os.fsync(deleted_file.fileno())
+            for chunk_id in doomed:
+                state.deleted.add(state.rows.pop(chunk_id))
+
+    def search(self, tenant, embedding, n, include_embeddings=False):
+        with self._lock:
+            state = self._tenant(tenant)
+            vectors = state.vectors()
+            deleted = list(state.deleted)
+        if vectors is None:
+            return []
+
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        scores = vectors @ (query / norm if norm else query)
+        if deleted:
+            scores[deleted] = -np.inf
+            n = min(n, len(scores) - len(deleted))
+
+        if len(scores) > n:
+            rows = np.argpartition(-scores, n)[:n]
+        else:
+            rows = np.arange(len(scores))
+        rows = rows[np.argsort(-scores[rows])]
+        rows = rows[np.isfinite(scores[rows])]
+
+        chunks = state.read_chunks(rows)
+        return [(chunk["document"], chunk["metadata"], float(scores[row]), vectors[row].tolist() if include_embeddings else None)
+                for row, chunk in zip(rows, chunks)]
+
+    def count(self, tenant):
+        state = self._tenant(tenant)
+        return len(state.offsets) - len(state.deleted)
+
+    def delete_tenant(self, tenant):
+        with self._lock:
+            self._tenants.pop(tenant, None)
+            shutil.rmtree(self._path(tenant), ignore_errors=True)
+
+    def tenants(self):
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(self._path(name)))
+
+    def export(self, tenant):
+        state = self._tenant(tenant)
+        vectors = state.vectors()
+        for start in range(0, len(state.offsets), EXPORT_PAGE_SIZE):
+            rows = [row for row in range(start, min(start + EXPORT_PAGE_SIZE, len(state.offsets))) if row not in state.deleted]
+            if not rows:
+                continue
+            chunks = state.read_chunks(rows)
+            yield ([chunk["id"] for chunk in chunks], vectors[rows].tolist(),
+                   [chunk["document"] for chunk in chunks], [chunk["metadata"] for chunk in chunks])
@@ -0,0 +1,134 @@
+"""
+Streaming of LLM tokens into Telegram messages through progressive edits.
+"""
+
+import os
+import asyncio
+import logging
+
+from langchain.callbacks.base import AsyncCallbackHandler
+from telegram.error import BadRequest, RetryAfter
+
+# Enable streaming replies and throttle how often a message gets edited
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+PLACEHOLDER_TEXT = "…"
+
+logger = logging.getLogger(__name__)
+
+
+class FinalAnswerCallbackHandler(AsyncCallbackHandler):
+    """Forward only the final-answer tokens of an agent run.
+
+    The conversational ReAct agent writes its scratchpad first and prefixes
+    the answer with "AI:". Tokens before that marker are dropped, the rest is
+    passed to on_text as the answer accumulated so far. With ai_prefix=None
+    every token is forwarded, which suits plain completions.
+    """
+
+    def __init__(self, on_text, ai_prefix="AI"):
+        self.on_text = on_text
+        self.marker = f"\n{ai_prefix}:" if ai_prefix else None
+        self._buffer = ""
+        self._answer = None
+
+    async def on_llm_start(self, serialized, prompts, **kwargs):
+        # Every LLM call of the agent loop starts a fresh scratchpad
+        self._buffer = ""
+        self._answer = None if self.marker else ""
+
+    async def on_llm_new_token(self, token, **kwargs):
+        if self._answer is None:
+            self._buffer += token
+            index = ("\n" + self._buffer).find(self.marker)
+            if index == -1:
+                return
+            self._answer = self._buffer[index + len(self.marker) - 1:].lstrip()
+        else:
+            self._answer += token
+
+        if self._answer:
+            await self.on_text(self._answer)
+
+
+class MessageStreamer():
+    """Edit a Telegram message with the latest text, coalescing updates.
+
+    update() only records the newest text; a background task pushes it to
+    Telegram at most once per interval so bursts of tokens become a single
+    edit and the chat stays under Telegram's edit rate limits.
+    """
+
+    def __init__(self, message, interval=STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._text = ""
+        self._sent = PLACEHOLDER_TEXT
+        self._changed = asyncio.Event()
+        self._task = None
+
+    @classmethod
+    async def reply_to(cls, message, interval=STREAM_EDIT_INTERVAL):
+        """Send a placeholder reply and start streaming into it."""
+        placeholder = await message.reply_text(text=PLACEHOLDER_TEXT)
+        streamer = cls(placeholder, interval=interval)
+        streamer._task = asyncio.create_task(streamer._run())
+        return streamer
+
+    async def update(self, text):
+        self._text = text[:TELEGRAM_MAX_MESSAGE_LENGTH]
+        self._changed.set()
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            await self._edit(self._text)
+            await asyncio.sleep(self.interval)
+
+    async def _edit(self, text):
+        if not text.strip() or text == self._sent:
+            return
+        try:
+            await self.message.edit_text(text=text)
+            self._sent = text
+        except RetryAfter as e:
+            logger.warning(f"Message edits throttled, retrying in {e.retry_after} seconds...")
+            await asyncio.sleep(e.retry_after)
+        except BadRequest as e:
+            # Raised e.g. when the text did not change since the last edit
+            logger.debug(f"Skipping message edit: {e}")
+
+    async def _stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def finish(self, text):
+        """Stop streaming and show the complete text."""
+        await self._stop()
+        text = text[:TELEGRAM_MAX_MESSAGE_LENGTH]
+        while text.strip() and text != self._sent:
+            try:
+                await self.message.edit_text(text=text)
+                self._sent = text
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                logger.debug(f"Skipping message edit: {e}")
+                break
+        return self.message
+
+    async def discard(self):
+        """Stop streaming and remove the placeholder message."""
+        await self._stop()
+        try:
+            await self.message.delete()
+        except BadRequest as e:
+            logger.debug(f"Could not delete placeholder message: {e}")
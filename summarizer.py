@@ -0,0 +1,184 @@
+"""
+Map-reduce summarization with concurrent map calls and content-hash caching.
+"""
+
+import os
+import asyncio
+import hashlib
+import logging
+
+import tiktoken
+
+from shared_state import open_cache
+
+# Summarization settings
+SUMMARY_MAX_CONCURRENCY = int(os.environ.get("SUMMARY_MAX_CONCURRENCY", 4))
+SUMMARY_CHUNK_TOKENS = int(os.environ.get("SUMMARY_CHUNK_TOKENS", 3000))
+SUMMARY_CACHE_PATH = os.environ.get("SUMMARY_CACHE_PATH", "summary_cache.sqlite3")
+SUMMARY_CACHE_MAX_BYTES = int(os.environ.get("SUMMARY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Reduce rounds before falling back to truncating the partial summaries
+SUMMARY_MAX_ROUNDS = 4
+
+SUMMARY_PROMPT = """Write a concise summary of the following text, use simple language and bullet points:
+{text}
+
+SUMMARY:"""
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class Summarizer():
+    """Summarize many chunks with as few, concurrent LLM calls as possible.
+
+    Chunks are packed into groups that fill the model's window
+    (chunk_tokens) instead of one call per chunk. Map calls run concurrently
+    up to max_concurrency, and reduce rounds repeat until a single group
+    remains. Both map outputs and final summaries are cached on disk by
+    content hash, so re-uploads cost no LLM calls.
+    """
+
+    def __init__(self, llm, max_concurrency=SUMMARY_MAX_CONCURRENCY, chunk_tokens=SUMMARY_CHUNK_TOKENS, cache=None):
+        self.llm = llm
+        self.chunk_tokens = chunk_tokens
+        self.model_name = getattr(llm, "model_name", type(llm).__name__)
+        self.cache = cache or open_cache(SUMMARY_CACHE_PATH, SUMMARY_CACHE_MAX_BYTES, table="summaries")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+        try:
+            self.encoding = tiktoken.encoding_for_model(self.model_name)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def _fill(self, texts, current, used):
+        """Pack texts onto a partial group, return the full groups and the new partial group."""
+        groups = []
+        for text in texts:
+            tokens = self.encoding.encode(text, disallowed_special=())
+            # Split texts that would not fit a group on their own
+            for start in range(0, max(len(tokens), 1), self.chunk_tokens):
+                piece = tokens[start:start + self.chunk_tokens]
+                if used + len(piece) > self.chunk_tokens and current:
+                    groups.append("\n\n".join(current))
+                    current, used = [], 0
+                current.append(text if len(piece) == len(tokens) else self.encoding.decode(piece))
+                used += len(piece)
+        return groups, current, used
+
+    def pack(self, texts):
+        """Greedily join texts into groups of at most chunk_tokens tokens."""
+        groups, current, _ = self._fill(texts, [], 0)
+        if current:
+            groups.append("\n\n".join(current))
+        return groups
+
+    async def _summarize_text(self, text):
+        """Summarize one group, reusing a cached output for the same content."""
+        key = _hash(self.model_name, SUMMARY_PROMPT, text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached.decode("utf-8")
+
+        async with self._semaphore:
+            summary = (await self.llm.apredict(SUMMARY_PROMPT.format(text=text))).strip()
+
+        self.cache.set(key, summary.encode("utf-8"))
+        return summary
+
+    async def _reduce(self, outputs):
+        """Combine map outputs into one summary."""
+        groups = self.pack(outputs)
+        rounds = 1
+        while len(groups) > 1:
+            rounds += 1
+            outputs = await asyncio.gather(*[self._summarize_text(group) for group in groups])
+            if rounds >= SUMMARY_MAX_ROUNDS:
+                # Partial summaries are not shrinking, keep what fits one call
+                groups = self.pack(outputs)[:1]
+                break
+            groups = self.pack(outputs)
+
+        return await self._summarize_text(groups[0]) if groups else ""
+
+    def session(self):
+        """Start summarizing a document whose chunks arrive in batches."""
+        return SummarySession(self)
+
+    async def summarize(self, texts):
+        """Return a summary of the given chunks."""
+        document_key = _hash(self.model_name, "document", *texts)
+        cached = self.cache.get(document_key)
+        if cached is not None:
+            return cached.decode("utf-8")
+
+        session = self.session()
+        await session.add(texts)
+        return await session.result()
+
+
+class SummarySession():
+    """Incremental summary of one document.
+
+    Map calls for a group start as soon as it is full, while the rest of
+    the document is still being parsed, so only the pending groups and the
+    partial summaries are held in memory. add() waits while max_pending
+    groups are in flight. The result and its cache key match what
+    Summarizer.summarize() returns for the same chunks.
+    """
+
+    def __init__(self, summarizer, max_pending=None):
+        self.summarizer = summarizer
+        self.max_pending = max_pending or 2 * SUMMARY_MAX_CONCURRENCY
+        self._digest = hashlib.sha256()
+        for part in (summarizer.model_name, "document"):
+            self._update(part)
+        self._current, self._used = [], 0
+        self._tasks = []
+
+    def _update(self, part):
+        self._digest.update(part.encode("utf-8"))
+        self._digest.update(b"\0")
+
+    async def add(self, texts):
+        """Add chunks and start map calls for the groups they fill."""
+        for text in texts:
+            self._update(text)
+        groups, self._current, self._used = self.summarizer._fill(texts, self._current, self._used)
+        for group in groups:
+            pending = [task for task in self._tasks if not task.done()]
+            if len(pending) >= self.max_pending:
+                await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            self._tasks.append(asyncio.create_task(self.summarizer._summarize_text(group)))
+
+    def cancel(self):
+        """Abandon the summary, e.g. when ingestion failed."""
+        for task in self._tasks:
+            task.cancel()
+
+    async def result(self):
+        """Wait for the map calls and return the document summary."""
+        document_key = self._digest.hexdigest()
+        cached = self.summarizer.cache.get(document_key)
+        if cached is not None:
+            self.cancel()
+            return cached.decode("utf-8")
+
+        last = "\n\n".join(self._current)
+        if not self._tasks:
+            # The whole document fits a single call
+            summary = await self.summarizer._summarize_text(last) if last else ""
+        else:
+            if last:
+                self._tasks.append(asyncio.create_task(self.summarizer._summarize_text(last)))
+            summary = await self.summarizer._reduce(await asyncio.gather(*self._tasks))
+
+        self.summarizer.cache.set(document_key, summary.encode("utf-8"))
+        return summary
@@ -1,26 +1,63 @@
+# Imported first so the startup report covers every import that follows
+import startup
+
 import os
+import time
 import logging
 import re
+import shutil
 import asyncio
-import aiofiles
+import tempfile
+import contextlib
 
-from pydub import AudioSegment
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CommandHandler, MessageHandler, filters, CallbackQueryHandler, Application, ContextTypes
 from telegram.constants import ChatAction
-from cachetools import TTLCache, cached
-
-from prompter import Prompter
+from telegram.error import TelegramError
+
+import audio
+import metrics
+import ratelimit
+from conversation import ConversationStore
+from ingestion import IngestionQueue, QueueFullError
+from scheduler import ChatScheduler
+import speech
+import webhook
+
+# LangChain, Chroma and the OpenAI client are loaded on first use or by the warm-up
+prompter_module = startup.lazy_import("prompter")
+streaming = startup.lazy_import("streaming")
+vectordb = startup.lazy_import("vectordb")
 
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
+# Load the agent, tokenizers and vector store in the background after startup
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+
 # Enable logging for debugging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Chat history and buffer size
-chat_context = TTLCache(maxsize=10, ttl=14400)
+async def summarize_conversation(summary, turns):
+    return await prompter_module.summarize_conversation(summary, turns)
+
+
+# Chat history, kept within a token budget and persisted on disk
+conversations = ConversationStore(summarizer=summarize_conversation)
+
+# Documents and web pages are ingested in the background
+ingestion_queue = IngestionQueue()
+INGESTION_BUSY_TEXT = "I'm processing a lot of documents right now. Please try again in a few minutes."
+INGESTION_FAILED_TEXT = "Sorry, something went wrong while saving this. Please try again."
+
+# Seconds between progress edits of a bulk ingestion, Telegram limits message edits
+BULK_STATUS_INTERVAL = 3
+
+URL_PATTERN = r"(https?://\S+)"
+
+# Chats are handled in parallel, each chat's own updates in order
+scheduler = ChatScheduler()
 
 # Start command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -34,28 +71,60 @@ async def send_typing_status(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await asyncio.sleep(5)  # Send typing status every 5 seconds
 
 # Process text message
-async def process_message(prompter, update, user_message, chat_id):
-    url_pattern = r"(https?://\S+)"
-    url_match = re.match(url_pattern, user_message)
-    if url_match:
+async def process_message(prompter, update, user_message, chat_id, role=None):
+    url_match = re.match(URL_PATTERN, user_message)
+    urls = re.findall(URL_PATTERN, user_message)
+    if url_match and len(urls) > 1:
+        await submit_urls(prompter, update, urls, chat_id)
+        response = None
+    elif url_match:
         url = url_match.group(1)
-        summary = await prompter.save_url(url=url)
-        response = "Summary of the web page: " + summary
-        await update.message.reply_text(text=response, quote=True)
-        user_message = f"{url} saved to my documents database."
+        # Acknowledge right away, the summary follows once the page is ingested
+        status = await update.message.reply_text(text=f"Saving {url}...", quote=True)
+        try:
+            submit_ingestion(ingest_url, prompter, update, status, url, chat_id)
+        except QueueFullError:
+            await set_status(status, INGESTION_BUSY_TEXT)
+        response = None
     else:
-        response = await prompter.generate_response(message=user_message, chat_context=chat_context[chat_id])
+        # Stream text replies into a placeholder message, voice replies are
+        # synthesized sentence by sentence while the answer is generated
+        voice_reply = update.message.voice or update.message.audio
+        streamer = None
+        speech_stream = None
+        callbacks = None
+        if voice_reply:
+            speech_stream = prompter.stream_audio()
+            callbacks = [streaming.FinalAnswerCallbackHandler(on_text=speech_stream.update)]
+        elif streaming.STREAM_RESPONSES:
+            streamer = await streaming.MessageStreamer.reply_to(update.message)
+            callbacks = [streaming.FinalAnswerCallbackHandler(on_text=streamer.update)]
+
         image_url_pattern = r"(https://oaidalleapiprodscus\.blob\..*)"
-        image_match = re.match(image_url_pattern, response)
+        try:
+            response = await prompter.generate_response(message=user_message, chat_context=await conversations.get_context(chat_id), role=role, callbacks=callbacks)
+            image_match = re.match(image_url_pattern, response)
+        except BaseException:
+            # Don't leave the placeholder, its edit task or the synthesis running
+            if streamer:
+                with contextlib.suppress(TelegramError):
+                    await streamer.discard()
+            if speech_stream:
+                speech_stream.cancel()
+            raise
         if image_match:
             image_url = image_match.group(1)
+            if streamer:
+                await streamer.discard()
+            if speech_stream:
+                speech_stream.cancel()
             await update.message.reply_photo(image_url)
+        elif streamer:
+            await streamer.finish(response)
         else:
-            if update.message.voice or update.message.audio:
-                audio = await prompter.generate_audio(text=response)
-                if audio:
-                    await update.message.reply_voice(voice=audio)
-                else:
+            if voice_reply:
+                voice = await prompter.generate_audio(text=response, stream=speech_stream)
+                if not voice or not await speech.synthesizer.reply(update.message, voice):
                     await update.message.reply_text(text=response)
             else:
                 await update.message.reply_text(text=response)
@@ -63,65 +132,116 @@ async def process_message(prompter, update, user_message, chat_id):
     return user_message, response
 
 
+# Show ingestion progress in the acknowledgement message
+async def set_status(status, text):
+    try:
+        await status.edit_text(text=text)
+    except TelegramError as e:
+        logger.debug(f"Could not update status message: {e}")
+
+
+# Queue an ingestion job, a job that fails says so in its status message
+def submit_ingestion(job, prompter, update, status, *args):
+    def report_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            asyncio.create_task(set_status(status, INGESTION_FAILED_TEXT))
+
+    ingestion_queue.submit(job, prompter, update, status, *args).add_done_callback(report_failure)
+
+
+# Background job: ingest a web page and send its summary
+@metrics.traced("ingest.url", root=True)
+async def ingest_url(prompter, update, status, url, chat_id):
+    async def progress(stage):
+        await set_status(status, f"{url}\n{stage}")
+
+    summary = await prompter.save_url(url=url, progress=progress)
+    if not summary:
+        await set_status(status, f"Sorry, I couldn't save {url}. Please try again.")
+        return
+
+    response = "Summary of the web page: " + summary
+    await update.message.reply_text(text=response, quote=True)
+    await set_status(status, f"{url}\nSaved to your documents.")
+    await conversations.add_turn(chat_id, f"{url} saved to my documents database.", response)
+
+
+# Background job: save many web pages, or refresh the saved ones without urls
+@metrics.traced("ingest.urls", root=True)
+async def ingest_urls(prompter, update, status, urls, chat_id):
+    last_status = 0.0
+
+    async def progress(stage):
+        nonlocal last_status
+        if time.monotonic() - last_status >= BULK_STATUS_INTERVAL:
+            last_status = time.monotonic()
+            await set_status(status, stage)
+
+    counts = await prompter.save_urls(urls=urls, progress=progress)
+    if counts is None:
+        await set_status(status, "Sorry, I couldn't save those pages. Please try again.")
+        return
+
+    response = (f"Saved {counts['new']} new and {counts['updated']} updated pages, "
+                f"{counts['unchanged']} unchanged, {counts['failed']} failed.")
+    await set_status(status, response)
+    request = "Refresh my saved web pages." if urls is None else f"{len(urls)} URLs saved to my documents database."
+    await conversations.add_turn(chat_id, request, response)
+
+
+# Queue a bulk ingestion and acknowledge it
+async def submit_urls(prompter, update, urls, chat_id):
+    text = f"Saving {len(urls)} URLs..." if urls else "Checking your saved pages for changes..."
+    status = await update.message.reply_text(text=text, quote=True)
+    try:
+        submit_ingestion(ingest_urls, prompter, update, status, urls, chat_id)
+    except QueueFullError:
+        await set_status(status, INGESTION_BUSY_TEXT)
+
+
+# Background job: ingest an uploaded document and send its summary
+@metrics.traced("ingest.document", root=True)
+async def ingest_document(prompter, update, status, file_path, file_name, chat_id):
+    async def progress(stage):
+        await set_status(status, f"{file_name}\n{stage}")
+
+    try:
+        summary = await prompter.save_document(document=file_path, progress=progress, name=file_name)
+    finally:
+        shutil.rmtree(os.path.dirname(file_path), ignore_errors=True)
+
+    if not summary:
+        await set_status(status, f"Sorry, I couldn't process {file_name}. Please try again.")
+        return
+
+    response = "Summary of the document: " + summary
+    await update.message.reply_text(text=response, quote=True)
+    await set_status(status, f"{file_name}\nSaved to your documents.")
+    await conversations.add_turn(chat_id, f"{file_name} saved to my documents database.", response)
+
+
 # Message handler
+@metrics.traced("update.message", root=True)
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Get the chat id
     chat_id = update.message.chat_id
 
-    # If the chat context is empty, initialize it
-    if chat_id not in chat_context:
-        chat_context[chat_id] = []
-    
-    prompter = Prompter(chat_id=chat_id)
+    prompter = prompter_module.Prompter(chat_id=chat_id)
     
     try:
         user_message = None
         # Get the user message
         # Check if the message is a voice message or text message
-        if update.message.voice:
-            file = await update.message.effective_attachment.get_file()
-            await file.download_to_drive("voice_message.ogg")
-
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, lambda: AudioSegment.from_ogg("voice_message.ogg").export("voice_message.mp3", format="mp3"))
-
-            with open("voice_message.mp3", "rb") as f:
-                transcript = await prompter.transcribe_voice(file=f)
-            
-            """
-            # This async version of this code is not working. Need to fix it.
-            async with aiofiles.tempfile.NamedTemporaryFile(prefix="voice_message_", suffix=".ogg") as voice_file:
-                file = await update.message.effective_attachment.get_file()
-                await file.download_to_drive(voice_file.name)
-                await voice_file.flush()
-
-                async with aiofiles.tempfile.NamedTemporaryFile(prefix="voice_message_", suffix=".mp3") as mp3_file:
-                    loop = asyncio.get_event_loop()
-                    await loop.run_in_executor(None, lambda: AudioSegment.from_ogg(voice_file.name).export(mp3_file.name, format="mp3"))
-                    await mp3_file.flush()
-
-                    async with aiofiles.open(mp3_file.name, "rb") as f:
-                        transcript = await prompter.transcribe_voice(file=f)
-            """
-            user_message = transcript
-
-        elif update.message.audio:
-            file = await update.message.effective_attachment.get_file()
-            await file.download_to_drive("audio_message.mp3")
-
-            with open("audio_message.mp3", "rb") as f:
-                transcript = await prompter.transcribe_voice(file=f)
-            """
-            # This async version of this code is not working. Need to fix it.
-            async with aiofiles.tempfile.NamedTemporaryFile(prefix="audio_message_", suffix=".mp3") as audio_file:
-                file = await update.message.effective_attachment.get_file()
-                await file.download_to_drive(audio_file.name)
-                await audio_file.flush()
-
-            async with aiofiles.open(file_name, "rb") as f:
-                transcript = await prompter.transcribe_voice(file=f)
-            """
+        if update.message.voice or update.message.audio:
+            # Download into memory and only transcode formats Whisper can't read
+            attachment = update.message.effective_attachment
+            with metrics.span("telegram.download"):
+                data = await audio.download_attachment(update.message)
+            audio_file = await audio.prepare_for_transcription(
+                data, file_name=getattr(attachment, "file_name", None), mime_type=attachment.mime_type)
+
+            transcript = await prompter.transcribe_voice(file=audio_file)
             user_message = transcript
 
         else:
@@ -134,9 +254,10 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             typing_task = asyncio.create_task(send_typing_status(update, context))
 
             # Get a response for the user message
-            user_message, response = await process_message(prompter, update, user_message, chat_id)
+            user_message, response = await process_message(prompter, update, user_message, chat_id, role=context.user_data.get("role"))
 
-            chat_context[chat_id].extend([{ "Human": user_message, "AI": response }])
+            if response:
+                await conversations.add_turn(chat_id, user_message, response)
 
             # Stop the typing status task
             typing_task.cancel()
@@ -153,42 +274,28 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Sorry, I couldn't process your message. Please try again.")
 
 # Document handler
+@metrics.traced("update.document", root=True)
 async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Get the chat id
     chat_id = update.message.chat_id
 
-    # If the chat context is empty, initialize it
-    if chat_id not in chat_context:
-        chat_context[chat_id] = []
-    
-    prompter = Prompter(chat_id=chat_id)
+    prompter = prompter_module.Prompter(chat_id=chat_id)
     
     try:
-        # Get the document
+        # Get the document, each upload gets its own directory so names can't clash
         file_name = update.message.document.file_name
-        file = await update.message.effective_attachment.get_file()
-        await file.download_to_drive(file_name)
-
-        # Create the typing status task
-        typing_task = asyncio.create_task(send_typing_status(update, context))
-
-        # Save the document to the vector database and get the summary
-        summary = await prompter.save_document(document=file_name)
-
-        response = "Summary of the document: " + summary
-
-        await update.message.reply_text(text=response, quote=True)
-
-        chat_context[chat_id].extend([{ "Human": f"{file_name} saved to my documents database.", "AI": response }])
+        file_path = os.path.join(tempfile.mkdtemp(prefix="document_"), os.path.basename(file_name))
+        with metrics.span("telegram.download"):
+            file = await update.message.effective_attachment.get_file()
+            await file.download_to_drive(file_path)
 
-        # Stop the typing status task
-        typing_task.cancel()
+        # Acknowledge right away, the summary follows once the document is ingested
+        status = await update.message.reply_text(text=f"Got {file_name}, processing it...", quote=True)
         try:
-            await typing_task
-        except asyncio.CancelledError:
-            pass
-
-        os.remove(file_name)
+            submit_ingestion(ingest_document, prompter, update, status, file_path, file_name, chat_id)
+        except QueueFullError:
+            shutil.rmtree(os.path.dirname(file_path), ignore_errors=True)
+            await set_status(status, INGESTION_BUSY_TEXT)
     
     except Exception as e:
         logger.error(f"Error during document processing: {e}")
@@ -200,7 +307,7 @@ async def clear_database(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Get the chat id
     chat_id = update.message.chat_id
 
-    prompter = Prompter(chat_id=chat_id)
+    prompter = prompter_module.Prompter(chat_id=chat_id)
 
     # if the database is cleared, send a message to the user
     if await prompter.clear_database():
@@ -209,6 +316,23 @@ async def clear_database(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text(text="Database not cleared.")
 
 
+# Save several web pages, sitemaps or RSS feeds
+async def ingest(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.message.chat_id
+    urls = [arg for arg in context.args if re.match(URL_PATTERN, arg)]
+    if not urls:
+        await update.message.reply_text(text="Send /ingest followed by the URLs of web pages, sitemaps or RSS feeds.")
+        return
+
+    await submit_urls(prompter_module.Prompter(chat_id=chat_id), update, urls, chat_id)
+
+
+# Re-check the saved web pages and update the ones that changed
+async def refresh(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.message.chat_id
+    await submit_urls(prompter_module.Prompter(chat_id=chat_id), update, None, chat_id)
+
+
 # Select role for the assistant
 async def select_role(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = [
@@ -241,24 +365,110 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         'An error occurred while processing your message. Please try again.')
 
 
-def main() -> None:
-    # Set up the updater and dispatcher
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+warm_up_task = None
+
+
+# Import and initialize the heavy components without holding up polling
+async def warm_up() -> None:
+    loop = asyncio.get_running_loop()
+    steps = {}
+
+    async def step(name, func):
+        start = time.perf_counter()
+        try:
+            await loop.run_in_executor(None, func)
+            return True
+        except Exception as e:
+            logger.warning(f"Warm-up step {name} failed: {e}")
+            return False
+        finally:
+            steps[name] = time.perf_counter() - start
+
+    # Background persistence starts as soon as the vector store is importable
+    if await step("import vectordb", vectordb.load):
+        try:
+            vectordb.registry.start()
+            metrics.registry.register_collector("vectordb", vectordb.registry.stats)
+            metrics.registry.register_collector("persistence", vectordb.registry.persistence.stats)
+        except Exception as e:
+            logger.warning(f"Starting the vector store failed: {e}")
+
+    if WARMUP:
+        await step("import prompter", prompter_module.load)
+        await step("import streaming", streaming.load)
+        await step("vector store", vectordb.registry.shared)
+        await step("tokenizers", lambda: (conversations.encoding, vectordb.TokenChunker()))
+        await step("agent", lambda: prompter_module.build_agent(role=prompter_module.DEFAULT_ROLE))
+        if isinstance(speech.elevenlabs, startup.LazyModule):
+            await step("speech", speech.elevenlabs.load)
+
+    startup.report(steps)
+
+
+# Bind shared components to the running loop and warm up in the background
+async def on_startup(application: Application) -> None:
+    global warm_up_task
+    ratelimit.bind_loop(asyncio.get_running_loop())
+
+    # Existing counters are exported next to the stage histograms
+    metrics.registry.register_collector("scheduler", scheduler.stats)
+    metrics.registry.register_collector("ingestion", lambda: {"pending": ingestion_queue.pending()})
+    for name, limiter in ratelimit.limiters.items():
+        metrics.registry.register_collector("ratelimit_" + name.replace(".", "_"), limiter.stats)
+    metrics.start_server()
+
+    warm_up_task = asyncio.create_task(warm_up())
+
+
+# Release worker pools on shutdown
+async def on_shutdown(application: Application) -> None:
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+        try:
+            await warm_up_task
+        except asyncio.CancelledError:
+            pass
+    metrics.stop_server()
+    audio.shutdown()
+    await ingestion_queue.shutdown()
+    if vectordb.loaded:
+        await vectordb.registry.close()
+    await conversations.close()
+
+
+# Register the handlers on an application built from the builder
+def build_application(builder) -> Application:
+    # PTB dispatches updates concurrently, the scheduler keeps per-chat order and sheds load
+    application = builder.concurrent_updates(scheduler.max_concurrent + scheduler.max_waiting) \
+        .post_init(on_startup).post_shutdown(on_shutdown).build()
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("selectrole", select_role))
     application.add_handler(CallbackQueryHandler(role_callback))
-    application.add_handler(CommandHandler("clear_database", clear_database))
+    application.add_handler(CommandHandler("clear_database", scheduler.serialize(clear_database)))
+    application.add_handler(CommandHandler("ingest", scheduler.serialize(ingest)))
+    application.add_handler(CommandHandler("refresh", scheduler.serialize(refresh)))
     application.add_handler(MessageHandler(
-        filters.TEXT | filters.VOICE | filters.AUDIO & ~filters.COMMAND, message_handler))
+        filters.TEXT | filters.VOICE | filters.AUDIO & ~filters.COMMAND, scheduler.serialize(message_handler)))
     application.add_handler(MessageHandler(
         filters.Document.MimeType("application/pdf") | filters.Document.MimeType("text/plain") | filters.Document.MimeType("application/msword") | filters.Document.MimeType("application/vnd.openxmlformats-officedocument.wordprocessingml.document") | filters.Document.MimeType("text/html") | filters.Document.MimeType("text/csv") | filters.Document.MimeType("text/tab-separated-values") | filters.Document.MimeType("text/richtext"),
-        document_handler))
+        scheduler.serialize(document_handler)))
     application.add_error_handler(error_handler)
+    return application
+
+
+def main() -> None:
+    # With a webhook URL, updates are received over HTTP and spread over worker processes
+    if webhook.WEBHOOK_URL:
+        webhook.serve()
+        return
+
+    # Set up the updater and dispatcher
+    application = build_application(Application.builder().token(TELEGRAM_BOT_TOKEN))
     # Start the bot
     application.run_polling()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,71 @@
+"""
+Routes chosen by the rule-based pre-router.
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import router  # noqa: E402
+
+
+class ClassifyTest(unittest.TestCase):
+
+    def assertRoute(self, message, route, previous_reply=None):
+        self.assertEqual(router.classify(message, previous_reply)[0], route, message)
+
+    def test_small_talk(self):
+        for message in ["hi", "Hello!", "hi there", "ok thanks", "thank you so much", "Good morning, everyone",
+                        "how are you?", "hey, what's up?", "lol", "bye!"]:
+            self.assertRoute(message, router.SMALL_TALK)
+
+    def test_small_talk_followed_by_a_request(self):
+        for message in ["thanks, search google for it", "hi, what is the weather in Paris?", "hello can you help me",
+                        "cool, now translate it", "thanks what about tomorrow?"]:
+            self.assertRoute(message, router.AGENT)
+
+    def test_short_answers(self):
+        self.assertRoute("ok", router.SMALL_TALK, previous_reply="Here is the summary.")
+        self.assertRoute("yes", router.AGENT, previous_reply="Should I search for more?")
+        self.assertRoute("sure, go ahead", router.AGENT)
+        self.assertRoute("no, the other one", router.AGENT)
+        self.assertRoute("ok thanks", router.SMALL_TALK)
+        self.assertRoute("ok thanks", router.AGENT, previous_reply="Want the full list?")
+
+    def test_image_requests(self):
+        self.assertEqual(router.classify("draw me a cat on a skateboard"), (router.IMAGE, "cat on a skateboard"))
+        self.assertEqual(router.classify("Draw a lighthouse at dusk."), (router.IMAGE, "lighthouse at dusk"))
+        self.assertEqual(router.classify("generate an image of a red fox"), (router.IMAGE, "a red fox"))
+        self.assertEqual(router.classify("please make a picture of the moon"), (router.IMAGE, "the moon"))
+
+    def test_figures_of_speech_are_not_images(self):
+        for message in ["draw a conclusion from this", "draw the line between them", "draw a line between the two ideas",
+                        "sketch out the plan for me", "draw attention to the risks",
+                        "draw on your experience"]:
+            self.assertRoute(message, router.AGENT)
+
+    def test_document_questions(self):
+        for message in ["what do my notes say about pricing?", "summarize the uploaded pdf",
+                        "what is in the file I just sent"]:
+            self.assertRoute(message, router.DOCUMENTS)
+
+    def test_other_messages_go_to_the_agent(self):
+        for message in ["what is the capital of France?", "read the file format spec for PNG", "hi " * 10]:
+            self.assertRoute(message, router.AGENT)
+
+    def test_disabled(self):
+        enabled = router.ROUTER_ENABLED
+        router.ROUTER_ENABLED = False
+        try:
+            self.assertRoute("hi", router.AGENT)
+        finally:
+            router.ROUTER_ENABLED = enabled
+
+
+if __name__ == "__main__":
+    unittest.main()
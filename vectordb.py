@@ -3,30 +3,165 @@ Vector database for storing vectors and their metadata.
 """
 
 import os
+import time
+import hashlib
 import logging
 import asyncio
+import weakref
+import threading
 
-from langchain.document_loaders import UnstructuredFileLoader, WebBaseLoader
+from collections import Counter, OrderedDict
+
+import numpy as np
+from langchain.docstore.document import Document
 from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import Chroma
 from langchain import OpenAI
-from langchain.chains import RetrievalQAWithSourcesChain
-from langchain.prompts import PromptTemplate
-from langchain.chains.summarize import load_summarize_chain
-from chromadb.config import Settings
+
+import metrics
+from bm25 import KeywordIndex, fuse_ranks, is_confident
+from callbacks import RateLimitCallbackHandler
+from cache import SemanticAnswerCache
+from chunking import TokenChunker, batched, iter_file_elements, iter_web_elements
+from embedding import CachedEmbeddings, content_hash
+from ingestion import run_blocking
+from persistence import PersistenceManager
+from shared_state import open_page_state
+from storage import CollectionBackend, MmapBackend, SharedCollectionBackend
+from summarizer import Summarizer
+from web import fetcher
 
 # Set API keys
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
 # Set Chroma settings
-CHROMA_SETTINGS = Settings(
-    chroma_db_impl="duckdb+parquet",
-    persist_directory="db",
-    anonymized_telemetry=False)
+CHROMA_PERSIST_DIRECTORY = os.environ.get("CHROMA_PERSIST_DIRECTORY", "db")
+
+
+def chroma_settings(persist_directory=CHROMA_PERSIST_DIRECTORY):
+    """Chroma settings, chromadb is only imported when a client is needed."""
+    from chromadb.config import Settings
+
+    return Settings(
+        chroma_db_impl="duckdb+parquet",
+        persist_directory=persist_directory,
+        anonymized_telemetry=False)
+
+# Storage layout: "collections" (one Chroma collection per chat), "shared"
+# (one collection partitioned by chat) or "mmap" (memory-mapped files per chat)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "collections")
+
+# Chunks embedded and stored per batch while a document is still being parsed
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 64))
+
+# Validators and chunk ids of the web pages each chat saved, so refreshes
+# are conditional GETs and only re-embed the chunks that changed
+WEB_PAGES_DB = os.environ.get("WEB_PAGES_DB", "web_pages.sqlite3")
+
+# Pages fetched and stored at once by a bulk request, and the most pages it may save
+WEB_INGEST_CONCURRENCY = int(os.environ.get("WEB_INGEST_CONCURRENCY", 8))
+WEB_MAX_URLS = int(os.environ.get("WEB_MAX_URLS", 200))
+
+# Sitemap indexes list sitemaps, so listings are followed this many levels deep
+WEB_MAX_LISTING_DEPTH = 2
+
+# Registry limits for pooled VectorDB handles
+VECTORDB_MAX_ENTRIES = int(os.environ.get("VECTORDB_MAX_ENTRIES", 256))
+VECTORDB_IDLE_TTL = int(os.environ.get("VECTORDB_IDLE_TTL", 3600))
+
+# Retrieval settings for the "Search User Documents" tool. Mode "chunks"
+# returns the top passages directly, "qa" answers with an extra LLM call.
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "chunks")
+RETRIEVAL_K = int(os.environ.get("RETRIEVAL_K", 4))
+RETRIEVAL_MMR = os.environ.get("RETRIEVAL_MMR", "0") == "1"
+RETRIEVAL_SCORE_THRESHOLD = float(os.environ.get("RETRIEVAL_SCORE_THRESHOLD", 0.0))
+
+# Fuse BM25 keyword ranks with the vector ranks, and answer confident keyword
+# matches (names, error codes, IDs) without embedding the query
+RETRIEVAL_HYBRID = os.environ.get("RETRIEVAL_HYBRID", "1") == "1"
+RETRIEVAL_LEXICAL_ONLY = os.environ.get("RETRIEVAL_LEXICAL_ONLY", "1") == "1"
+
+# Near-duplicate queries reuse cached answers until the collection changes
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.97))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 64))
+
+
+def create_backend(kind=STORAGE_BACKEND, persistence=None):
+    """Create the storage backend for the configured layout."""
+    if kind == "mmap":
+        return MmapBackend()
+
+    import chromadb
+
+    client = chromadb.Client(chroma_settings())
+    if persistence is not None:
+        persistence.bind(client)
+    if kind == "shared":
+        return SharedCollectionBackend(client, persistence=persistence)
+    if kind == "collections":
+        return CollectionBackend(client, persistence=persistence)
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+
+def format_matches(matches):
+    """Render retrieved chunks with their sources for the agent.
+
+    Scores are cosine similarities, None for chunks found by keywords
+    alone, which are shown as keyword matches.
+    """
+    if not matches:
+        return "No matching passages found in the user's documents."
+    return "\n\n".join(
+        f"[{index}] ({'keyword match' if score is None else f'similarity {score:.2f}'}, "
+        f"source: {doc.metadata.get('source', 'unknown')})\n{doc.page_content}"
+        for index, (doc, score) in enumerate(matches, 1))
+
+
+class PendingChunks():
+    """Chunk ids each chat is storing but has not recorded in the page state yet.
+
+    A page refresh removes the chunks no page or document of the chat has,
+    while another ingestion of the chat may be storing the same chunk.
+    Ingestions hold their ids before checking which are stored and release
+    them once their source is recorded. Stale chunks are computed and
+    removed under the chat's lock, skipping held ids. Covers the
+    ingestions of one process.
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+        self._held = {}
+
+    def lock(self, chat_id):
+        """The chat's lock, held while its stale chunks are found and removed."""
+        lock = self._locks.get(chat_id)
+        if lock is None:
+            lock = self._locks[chat_id] = asyncio.Lock()
+        return lock
+
+    async def hold(self, chat_id, ids):
+        async with self.lock(chat_id):
+            self._held.setdefault(chat_id, Counter()).update(ids)
+
+    async def release(self, chat_id, ids):
+        async with self.lock(chat_id):
+            held = self._held.get(chat_id)
+            if held is None:
+                return
+            held.subtract(ids)
+            for chunk_id in [chunk_id for chunk_id, count in held.items() if count <= 0]:
+                del held[chunk_id]
+            if not held:
+                del self._held[chat_id]
+
+    def unheld(self, chat_id, ids):
+        """The ids no ingestion of the chat holds. Call with the chat's lock."""
+        held = self._held.get(chat_id, {})
+        return [chunk_id for chunk_id in ids if chunk_id not in held]
+
 
 class VectorDB():
-    def __init__(self, chat_user_id):
+    def __init__(self, chat_user_id, backend=None, embeddings=None, llm=None, summarizer=None, keywords=None, pages=None,
+                 pending=None):
         if not isinstance(chat_user_id, str):
             raise ValueError("chat_user_id must be string")
             
@@ -34,71 +169,335 @@ class VectorDB():
         logging.basicConfig(
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-        self.text_splitter = CharacterTextSplitter(chunk_size=500, chunk_overlap=0)
-        self.embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
-        self.vector_store = Chroma(embedding_function=self.embeddings, client_settings=CHROMA_SETTINGS, persist_directory="db", collection_name=chat_user_id)
-        self.llm = OpenAI(openai_api_key=OPENAI_API_KEY, temperature=0)
+        self.chat_user_id = chat_user_id
+        self.chunker = TokenChunker()
+        self.embeddings = embeddings or CachedEmbeddings(OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY))
+        self.backend = backend or create_backend()
+        self.keywords = keywords or KeywordIndex()
+        self.pages = pages or open_page_state(WEB_PAGES_DB)
+        self.pending = pending or PendingChunks()
+        self.llm = llm or OpenAI(openai_api_key=OPENAI_API_KEY, temperature=0, callbacks=[RateLimitCallbackHandler("openai.completions")])
+        self.summarizer = summarizer or Summarizer(self.llm)
+        self.answer_cache = SemanticAnswerCache(similarity=ANSWER_CACHE_SIMILARITY, maxsize=ANSWER_CACHE_SIZE)
 
-    async def add_document(self, document):
-        """Ingest a document into the vector store."""
-        try:
-            # Load the document
-            loader = UnstructuredFileLoader(document)
-            doc = loader.load()
+    async def _report(self, progress, stage):
+        """Forward an ingestion stage to the optional progress callback."""
+        if progress is not None:
+            try:
+                await progress(stage)
+            except Exception as e:
+                self.logger.warning(f"Error reporting progress: {e}")
+
+    def add_documents(self, docs):
+        """Embed and store chunks that are not in the collection yet.
+
+        Chunks are identified by their content hash, so re-sending the same
+        document or URL embeds and inserts nothing. Blocking, runs in the
+        ingestion pool. Returns the number of new chunks.
+        """
+        unique = {}
+        for doc in docs:
+            unique.setdefault(content_hash(doc.page_content), doc)
+
+        ids = list(unique)
+        existing = self.backend.existing_ids(self.chat_user_id, ids)
+        new_ids = [chunk_id for chunk_id in ids if chunk_id not in existing]
+
+        if new_ids:
+            documents = [unique[chunk_id].page_content for chunk_id in new_ids]
+            metadatas = [unique[chunk_id].metadata for chunk_id in new_ids]
 
-            # Split the document into sentences
-            texts = self.text_splitter.split_documents(doc)
-            
             # Store the embeddings
-            self.vector_store.add_documents(documents=texts)
-            
-            # Persist the vector store to disk
-            self.vector_store.persist()
+            with metrics.span("embed", chunks=len(documents)):
+                embeddings = self.embeddings.embed_documents(documents)
+            with metrics.span("store", chunks=len(documents)):
+                self.backend.add(self.chat_user_id, new_ids, embeddings, documents, metadatas)
+            with metrics.span("index_keywords", chunks=len(documents)):
+                self.keywords.add(self.chat_user_id, new_ids, documents)
+
+            # Cached answers may miss the new chunks
+            self.answer_cache.invalidate()
+
+        self.logger.info(f"Stored {len(new_ids)} new of {len(docs)} chunks, embedding cache: {self.embeddings.stats()}")
+        return len(new_ids)
+
+    def delete_chunks(self, ids):
+        """Remove chunks from the store and the keyword index. Blocking."""
+        with metrics.span("delete", chunks=len(ids)):
+            self.backend.delete(self.chat_user_id, ids)
+            self.keywords.delete(self.chat_user_id, ids)
+        self.answer_cache.invalidate()
 
-            # return the summary of the document
-            summary = await self.summarize(texts)
+    async def _ingest(self, elements, progress=None, chunk_ids=None, summarize=True, sections=False):
+        """Chunk, embed and store a stream of elements in bounded batches.
+
+        The next batch is parsed while the current one is embedded, so at
+        most two batches are in memory and the first chunks are searchable
+        before the document is fully read. Returns the document summary, or
+        None without summarize. The ids of all chunks are added to chunk_ids
+        and held in pending until the caller releases them. With sections,
+        chunks end on content-defined element boundaries.
+        """
+        split = self.chunker.split_sections if sections else self.chunker.split
+        batches = batched(split(elements), INGEST_BATCH_SIZE)
+        session = self.summarizer.session() if summarize else None
+        chunks = 0
+
+        next_batch = asyncio.ensure_future(run_blocking(next, batches, None))
+        try:
+            while True:
+                batch = await next_batch
+                if batch is None:
+                    break
+                next_batch = asyncio.ensure_future(run_blocking(next, batches, None))
+
+                if chunk_ids is not None:
+                    # Held before add_documents checks which chunks are stored
+                    ids = {content_hash(doc.page_content) for doc in batch} - chunk_ids
+                    await self.pending.hold(self.chat_user_id, ids)
+                    chunk_ids.update(ids)
+                await run_blocking(self.add_documents, batch)
+                if session is not None:
+                    await session.add([doc.page_content for doc in batch])
+                chunks += len(batch)
+                await self._report(progress, f"Indexed {chunks} chunks...")
+        except BaseException:
+            next_batch.cancel()
+            if session is not None:
+                session.cancel()
+            raise
+
+        if session is None:
+            return None
+        await self._report(progress, "Summarizing...")
+        with metrics.span("summarize", chunks=chunks):
+            return await session.result()
+
+    async def add_document(self, document, progress=None, name=None):
+        """Ingest a document into the vector store, name is the source shown for its passages."""
+        chunk_ids = set()
+        try:
+            # Parse, split and index the document as it is read
+            await self._report(progress, "Reading the document...")
+            summary = await self._ingest(iter_file_elements(document, name), progress, chunk_ids=chunk_ids)
+
+            # Chunks it shares with saved web pages stay when the pages change
+            await run_blocking(self.pages.reference, self.chat_user_id, "document:" + (name or os.path.basename(document)), chunk_ids)
 
             return summary
         except Exception as e:
             self.logger.error(f"Error adding document: {e}")
             return None
+        finally:
+            await self.pending.release(self.chat_user_id, chunk_ids)
     
     
-    async def add_url(self, url):
-        """Ingest a web page into the vector store."""
-        try:
-            loader = WebBaseLoader(url)
+    async def _refresh_page(self, url, summarize=True, progress=None, listings=False):
+        """Fetch a web page and store what changed since the chat last saved it.
 
-            docs = loader.load()
+        The fetch is conditional on the stored ETag and Last-Modified. Chunk
+        ids are content hashes, so unchanged chunks are not embedded again,
+        and chunks the page no longer has are removed unless another saved
+        page has them. Returns (status, summary, links), status is "new",
+        "updated", "unchanged" or, with listings, "listing" for a sitemap or
+        feed whose page URLs are in links.
+        """
+        record = await run_blocking(self.pages.get, self.chat_user_id, url)
+        # A page saved without a summary is fetched in full to summarize it
+        current = record is not None and bool(record["summary"] or not summarize)
+        validators = record if current else {}
+        page = await fetcher.fetch(url, etag=validators.get("etag"), last_modified=validators.get("last_modified"))
+        if page.not_modified:
+            return "unchanged", record["summary"], []
 
-            # Split the document into sentences
-            texts = self.text_splitter.split_documents(docs)
+        if listings:
+            links = page.links()
+            if links:
+                return "listing", None, links
 
-            # Store the embeddings
-            self.vector_store.add_documents(documents=texts)
-            
-            # Persist the vector store to disk
-            self.vector_store.persist()
+        # Servers without validators send the same body again
+        digest = hashlib.sha256(page.body).hexdigest()
+        if current and record["digest"] == digest:
+            return "unchanged", record["summary"], []
 
-            # Gather the summary
-            summary = await self.summarize(texts)
+        chunk_ids = set()
+        try:
+            # Chunks that keep their boundaries across edits keep their ids
+            summary = await self._ingest(iter_web_elements(page.text, url, page.content_type), progress,
+                                         chunk_ids=chunk_ids, summarize=summarize, sections=True)
+            fetched = {"etag": page.etag, "last_modified": page.last_modified, "digest": digest, "summary": summary}
+            # Sources recorded before the lock keep their chunks, the ones still storing hold them
+            async with self.pending.lock(self.chat_user_id):
+                stale = await run_blocking(self.pages.replace, self.chat_user_id, url, fetched, chunk_ids)
+                stale = self.pending.unheld(self.chat_user_id, stale)
+                if stale:
+                    await run_blocking(self.delete_chunks, stale)
+        finally:
+            await self.pending.release(self.chat_user_id, chunk_ids)
+        return "updated" if record else "new", summary, []
+
+    async def add_url(self, url, progress=None):
+        """Ingest a web page into the vector store, or what changed since it was saved."""
+        try:
+            await self._report(progress, "Fetching the page...")
+            _, summary, _ = await self._refresh_page(url, progress=progress)
 
             return summary
         except Exception as e:
             self.logger.error(f"Error adding url: {e}")
             return None
+
+    async def add_urls(self, urls=None, progress=None):
+        """Save many web pages concurrently, without summaries.
+
+        Sitemaps and RSS or Atom feeds are expanded to the pages they list,
+        up to WEB_MAX_URLS pages. Without urls, every page the chat saved
+        before is refreshed. Returns a Counter of page statuses, where
+        "failed" counts pages that could not be fetched or stored.
+        """
+        listings = urls is not None
+        if urls is None:
+            urls = await run_blocking(self.pages.urls, self.chat_user_id)
+
+        counts = Counter()
+        seen = set()
+        semaphore = asyncio.Semaphore(WEB_INGEST_CONCURRENCY)
+
+        def admit(links):
+            links = [link for link in dict.fromkeys(links) if link not in seen][:max(0, WEB_MAX_URLS - len(seen))]
+            seen.update(links)
+            return links
+
+        async def save(url, depth):
+            async with semaphore:
+                try:
+                    status, _, links = await self._refresh_page(url, summarize=False, listings=listings and depth < WEB_MAX_LISTING_DEPTH)
+                except Exception as e:
+                    self.logger.warning(f"Error saving {url}: {e}")
+                    status, links = "failed", []
+
+            # The listing's pages are saved after its slot is released
+            if status == "listing":
+                await asyncio.gather(*(save(link, depth + 1) for link in admit(links)))
+                return
+            counts[status] += 1
+            await self._report(progress, f"Checked {sum(counts.values())} pages...")
+
+        with metrics.span("add_urls", urls=len(urls)) as add_span:
+            await asyncio.gather(*(save(url, 0) for url in admit(urls)))
+            add_span.set(**counts)
+        return counts
     
 
-    async def query(self, query):
+    def search_by_vector(self, embedding, k=RETRIEVAL_K, mmr=RETRIEVAL_MMR, score_threshold=RETRIEVAL_SCORE_THRESHOLD):
+        """Return (document, score) pairs for the chunks closest to an embedding.
+
+        Scores are cosine similarities. With mmr, 4*k candidates are fetched
+        and re-ranked for diversity. Blocking, run it in the ingestion pool.
+        """
+        with metrics.span("search", k=k, mmr=mmr):
+            results = self.backend.search(self.chat_user_id, embedding, k * 4 if mmr else k, include_embeddings=mmr)
+
+        indices = range(len(results))
+        if mmr and results:
+            from langchain.vectorstores.utils import maximal_marginal_relevance
+            indices = maximal_marginal_relevance(np.array(embedding, dtype=np.float32), [result[3] for result in results], k=k)
+
+        matches = [(Document(page_content=results[i][0], metadata=results[i][1]), results[i][2]) for i in indices]
+        return [(doc, score) for doc, score in matches if score >= score_threshold][:k]
+
+    def search_keywords(self, query, n):
+        """Return (chunk_id, score, coverage) BM25 hits. Blocking."""
+        with metrics.span("search_keywords"):
+            return self.keywords.search(self.chat_user_id, query, n)
+
+    def keyword_matches(self, hits):
+        """Return (document, None) pairs for keyword hits, they have no similarity. Blocking."""
+        stored = self.backend.get(self.chat_user_id, [chunk_id for chunk_id, _, _ in hits])
+        return [(Document(page_content=stored[chunk_id][0], metadata=stored[chunk_id][1]), None)
+                for chunk_id, _, _ in hits if chunk_id in stored]
+
+    def search_hybrid(self, embedding, hits, k=RETRIEVAL_K, mmr=RETRIEVAL_MMR, score_threshold=RETRIEVAL_SCORE_THRESHOLD):
+        """Fuse vector and keyword ranks, returns (document, score) pairs in fused order.
+
+        Scores are cosine similarities like search_by_vector(), chunks only
+        the keywords found are scored with their cached embeddings and
+        dropped below score_threshold too. Without keyword hits this is
+        search_by_vector(). Blocking.
+        """
+        matches = self.search_by_vector(embedding, k=k * 4 if hits else k, mmr=mmr, score_threshold=score_threshold)
+        if not hits:
+            return matches
+
+        # Chunk ids are content hashes, so vector results are matched to hits by their text
+        documents = {content_hash(doc.page_content): (doc, score) for doc, score in matches}
+        fused = fuse_ranks([list(documents), [chunk_id for chunk_id, _, _ in hits]])[:k]
+        missing = self.backend.get(self.chat_user_id, [chunk_id for chunk_id, _ in fused if chunk_id not in documents])
+        if missing:
+            vectors = np.asarray(self.embeddings.embed_documents([document for document, _ in missing.values()]), dtype=np.float32)
+            similarities = vectors @ np.asarray(embedding, dtype=np.float32)
+            for (chunk_id, (document, metadata)), similarity in zip(missing.items(), similarities):
+                if similarity >= score_threshold:
+                    documents[chunk_id] = (Document(page_content=document, metadata=metadata), float(similarity))
+        return [documents[chunk_id] for chunk_id, _ in fused if chunk_id in documents]
+
+    async def relevant_matches(self, query, min_score, k=RETRIEVAL_K):
+        """Return (document, score) pairs that clearly match a query, or an empty list.
+
+        A confident keyword match counts, otherwise only chunks with a
+        cosine similarity of at least min_score.
+        """
+        if RETRIEVAL_HYBRID:
+            hits = await run_blocking(self.search_keywords, query, k * 4)
+            if is_confident(hits):
+                return await run_blocking(self.keyword_matches, hits[:k])
+
+        with metrics.span("embed_query"):
+            embedding = await self.embeddings.aembed_query(query)
+        return await run_blocking(self.search_by_vector, embedding, k=k, score_threshold=min_score)
+
+    async def _answer(self, query, docs):
+        """Answer a question over retrieved chunks with an LLM."""
+        from langchain.chains.qa_with_sources import load_qa_with_sources_chain
+        chain = load_qa_with_sources_chain(self.llm, chain_type="stuff")
+        return await chain.arun(input_documents=docs, question=query)
+
+    @metrics.traced("vectordb.query")
+    async def query(self, query, mode=RETRIEVAL_MODE, k=RETRIEVAL_K, mmr=RETRIEVAL_MMR, score_threshold=RETRIEVAL_SCORE_THRESHOLD):
         """Query the vector store for similar vectors."""
         try:
-            # Query the vector store
-            chain = RetrievalQAWithSourcesChain.from_chain_type(
-                llm=self.llm, chain_type="stuff", retriever=self.vector_store.as_retriever())
+            hits = []
+            if RETRIEVAL_HYBRID:
+                hits = await run_blocking(self.search_keywords, query, k * 4)
+
+                # Exact-term lookups are answered from the local index alone
+                if RETRIEVAL_LEXICAL_ONLY and is_confident(hits):
+                    metrics.current_span().set(lexical_only=True)
+                    matches = await run_blocking(self.keyword_matches, hits[:k])
+                    if matches:
+                        if mode == "qa":
+                            return await self._answer(query, [doc for doc, _ in matches])
+                        return format_matches(matches)
 
-            # Get the results
-            results = await chain.arun(question=query, return_only_outputs=True)
+            # Embed the query once for both the answer cache and the search
+            with metrics.span("embed_query"):
+                embedding = await self.embeddings.aembed_query(query)
 
+            # Near-duplicate queries can name different terms, e.g. two error codes
+            cache_key = (mode, k, mmr, score_threshold, tuple(chunk_id for chunk_id, _, _ in hits[:k]))
+            version = self.answer_cache.version
+            results = self.answer_cache.get(embedding, key=cache_key)
+            if results is not None:
+                return results
+
+            if mode == "qa":
+                matches = await run_blocking(self.search_hybrid, embedding, hits, k=k, mmr=False, score_threshold=0.0)
+                results = await self._answer(query, [doc for doc, _ in matches])
+            else:
+                matches = await run_blocking(self.search_hybrid, embedding, hits, k=k, mmr=mmr, score_threshold=score_threshold)
+                results = format_matches(matches)
+
+            self.answer_cache.set(embedding, results, key=cache_key, version=version)
             return results
         except Exception as e:
             self.logger.error(f"Error querying vector store: {e}")
@@ -107,37 +506,143 @@ class VectorDB():
     
     async def summarize(self, docs):
         """Get the summary of a document."""
-        
-        # Prompt template only for the stuff chain type
-        prompt_tempate = """Write a concise summary of the following text, use simple language and bullet points:
-                        {text}
-
-                        SUMMARY:"""
-        
-        prompt = PromptTemplate(template=prompt_tempate, 
-                                input_variables=["text"])
-
-        # Create the chain
-        chain = load_summarize_chain(self.llm,
-                                     chain_type="map_reduce",
-                                     map_prompt=prompt,
-                                     combine_prompt=prompt)
-        
         try:
-            summary = await chain.arun(input_documents=docs, return_only_outputs=True)
+            summary = await self.summarizer.summarize([doc.page_content for doc in docs])
 
             return summary
         except Exception as e:
             self.logger.error(f"Error gathering summary: {e}")
             return None
     
+    async def count_documents(self):
+        """Return the number of stored chunks of the chat."""
+        return await run_blocking(self.backend.count, self.chat_user_id)
+
     async def clear_database(self):
         """Clear the vector store."""
         try:
-            # Delete the collection from the vector store
-            self.vector_store.delete_collection()
+            # Delete the chat's chunks from the vector store
+            await run_blocking(self.backend.delete_tenant, self.chat_user_id)
+            await run_blocking(self.keywords.delete_tenant, self.chat_user_id)
+            await run_blocking(self.pages.delete, self.chat_user_id)
+            self.answer_cache.invalidate()
 
             return True
         except Exception as e:
             self.logger.error(f"Error clearing vector store: {e}")
             return False
+
+
+class VectorDBRegistry():
+    """Process-wide pool of VectorDB handles keyed by chat_user_id.
+
+    All handles share one storage backend, one embeddings client and one LLM.
+    Entries are evicted least-recently-used first once max_entries is
+    reached, and whenever they have been idle for longer than idle_ttl.
+    """
+
+    def __init__(self, max_entries=VECTORDB_MAX_ENTRIES, idle_ttl=VECTORDB_IDLE_TTL):
+        self.logger = logging.getLogger(__name__)
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._shared_clients = None
+        self._shared_lock = threading.Lock()
+        self.persistence = PersistenceManager(persist_directory=CHROMA_PERSIST_DIRECTORY)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def shared(self):
+        """Create the shared clients on first use, once even when called from several threads.
+
+        Blocking, the warm-up calls it from a worker thread.
+        """
+        with self._shared_lock:
+            if self._shared_clients is None:
+                llm = OpenAI(openai_api_key=OPENAI_API_KEY, temperature=0, callbacks=[RateLimitCallbackHandler("openai.completions")])
+                self._shared_clients = {
+                    "backend": create_backend(STORAGE_BACKEND, persistence=self.persistence),
+                    "embeddings": CachedEmbeddings(OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)),
+                    "llm": llm,
+                    "summarizer": Summarizer(llm),
+                    "keywords": KeywordIndex(),
+                    "pages": open_page_state(WEB_PAGES_DB),
+                    "pending": PendingChunks(),
+                }
+            return self._shared_clients
+
+    async def warm(self):
+        """Create the shared clients without blocking the event loop."""
+        if self._shared_clients is None:
+            await asyncio.get_running_loop().run_in_executor(None, self.shared)
+
+    def _evict_idle(self, now):
+        """Drop entries that have not been used within idle_ttl."""
+        while self._entries:
+            chat_user_id, (_, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            del self._entries[chat_user_id]
+            self.evictions += 1
+
+    def get(self, chat_user_id):
+        """Return the pooled VectorDB for a chat, creating it if needed."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+
+            entry = self._entries.get(chat_user_id)
+            if entry is not None:
+                self.hits += 1
+                self._entries[chat_user_id] = (entry[0], now)
+                self._entries.move_to_end(chat_user_id)
+                return entry[0]
+
+            self.misses += 1
+            db = VectorDB(chat_user_id=chat_user_id, **self.shared())
+
+            self._entries[chat_user_id] = (db, now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+            return db
+
+    def discard(self, chat_user_id):
+        """Forget the handle for a chat, e.g. after its collection is deleted."""
+        with self._lock:
+            self._entries.pop(chat_user_id, None)
+
+    def stats(self):
+        """Return hit/miss counters and the current pool size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+
+    def start(self):
+        """Start background persistence. Call from the running event loop."""
+        self.persistence.start()
+
+    async def close(self):
+        """Persist pending writes and close the HTTP session before shutdown."""
+        await self.persistence.stop()
+        await fetcher.close()
+
+
+registry = VectorDBRegistry()
+
+
+async def aget_vector_db(chat_user_id):
+    """Return the shared VectorDB handle for a chat, building the shared clients off the event loop."""
+    await registry.warm()
+    return registry.get(chat_user_id)
@@ -0,0 +1,144 @@
+"""
+Pooled, conditional fetching of web pages, sitemaps and feeds for URL ingestion.
+"""
+
+import os
+import logging
+
+from xml.etree import ElementTree
+
+import metrics
+
+# Connection pool of the shared HTTP session
+WEB_MAX_CONNECTIONS = int(os.environ.get("WEB_MAX_CONNECTIONS", 32))
+WEB_MAX_PER_HOST = int(os.environ.get("WEB_MAX_PER_HOST", 4))
+WEB_TIMEOUT = float(os.environ.get("WEB_TIMEOUT", 30))
+WEB_USER_AGENT = os.environ.get("WEB_USER_AGENT", "intellibot (+https://github.com/davletovb/intellibot)")
+
+# Larger responses are refused instead of being parsed
+WEB_MAX_BYTES = int(os.environ.get("WEB_MAX_BYTES", 10 * 1024 * 1024))
+READ_CHUNK_BYTES = 64 * 1024
+
+# Content types that can hold a sitemap or a feed
+LISTING_CONTENT_TYPES = ("xml", "rss", "atom")
+
+logger = logging.getLogger(__name__)
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_listing(body):
+    """Return the URLs listed by a sitemap, sitemap index, RSS or Atom feed.
+
+    Returns an empty list for other documents.
+    """
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        return []
+
+    kind = _local_name(root.tag)
+    urls = []
+    if kind in ("urlset", "sitemapindex"):
+        urls = [element.text for element in root.iter() if _local_name(element.tag) == "loc"]
+    elif kind in ("rss", "RDF"):
+        for item in root.iter():
+            if _local_name(item.tag) == "item":
+                urls.extend(child.text for child in item if _local_name(child.tag) == "link")
+    elif kind == "feed":
+        for entry in root.iter():
+            if _local_name(entry.tag) == "entry":
+                links = [child for child in entry if _local_name(child.tag) == "link"]
+                preferred = [link for link in links if link.get("rel", "alternate") == "alternate"] or links
+                urls.extend(link.get("href") for link in preferred[:1])
+    return list(dict.fromkeys(url.strip() for url in urls if url and url.strip()))
+
+
+class Page():
+    """A fetched URL, or a 304 response when it did not change."""
+
+    def __init__(self, url, status, body=b"", content_type="", charset=None, etag=None, last_modified=None):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.charset = charset
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def not_modified(self):
+        return self.status == 304
+
+    @property
+    def text(self):
+        return self.body.decode(self.charset or "utf-8", errors="replace")
+
+    def links(self):
+        """URLs listed by the page if it is a sitemap or a feed, else an empty list."""
+        if not any(kind in self.content_type for kind in LISTING_CONTENT_TYPES) and not self.body.lstrip().startswith(b"<?xml"):
+            return []
+        return parse_listing(self.body)
+
+
+class Fetcher():
+    """One aiohttp session shared by all chats, with per-host connection limits.
+
+    fetch() sends If-None-Match / If-Modified-Since when validators from an
+    earlier fetch are given and returns a 304 Page when nothing changed.
+    The session is created on first use in the running loop.
+    """
+
+    def __init__(self, max_connections=WEB_MAX_CONNECTIONS, max_per_host=WEB_MAX_PER_HOST, timeout=WEB_TIMEOUT, max_bytes=WEB_MAX_BYTES):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self._session = None
+
+    def _get_session(self):
+        import aiohttp
+
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_per_host, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout), headers={"User-Agent": WEB_USER_AGENT})
+        return self._session
+
+    async def fetch(self, url, etag=None, last_modified=None):
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        with metrics.span("web.fetch", conditional=bool(headers)) as fetch_span:
+            async with self._get_session().get(url, headers=headers) as response:
+                fetch_span.set(status=response.status)
+                if response.status == 304:
+                    return Page(url, 304, etag=etag, last_modified=last_modified)
+                response.raise_for_status()
+
+                if response.content_length is not None and response.content_length > self.max_bytes:
+                    raise ValueError(f"{url} is larger than {self.max_bytes} bytes")
+
+                # read(n) returns what is buffered, the body is read to the end
+                parts, size = [], 0
+                async for part in response.content.iter_chunked(READ_CHUNK_BYTES):
+                    size += len(part)
+                    if size > self.max_bytes:
+                        raise ValueError(f"{url} is larger than {self.max_bytes} bytes")
+                    parts.append(part)
+                body = b"".join(parts)
+                return Page(url, response.status, body=body, content_type=response.content_type or "", charset=response.charset,
+                            etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+fetcher = Fetcher()
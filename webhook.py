@@ -0,0 +1,344 @@
+"""
+Webhook mode: an HTTP front server that hands each update to the worker process of its chat.
+
+Chats are routed by a stable hash of the chat id, so per-chat state (the
+scheduler's ordering, the vector store of the chat) stays in one worker.
+Conversation history and caches live in the shared state, see
+shared_state.py. With the Chroma backends each worker persists to its own
+directory under CHROMA_PERSIST_DIRECTORY, so the worker count is recorded
+there and the server refuses to start with another one, which would move
+chats away from their stored documents. The mmap backend keeps every chat
+under one root and has no such tie.
+"""
+
+import os
+import sys
+import json
+import zlib
+import time
+import queue
+import signal
+import asyncio
+import logging
+import threading
+import contextlib
+import multiprocessing
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import metrics
+
+TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+
+# Public URL Telegram posts updates to, setting it enables webhook mode.
+# TLS is expected to be terminated by a reverse proxy in front of the server.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+
+# Worker processes, and the updates each may have queued before the server answers 503.
+# Fixed rather than per host, the Chroma backends store each worker's chats apart.
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+
+# Seconds workers get to finish their queued updates on shutdown
+WORKER_STOP_TIMEOUT = float(os.environ.get("WORKER_STOP_TIMEOUT", 30))
+
+# Workers that exit within WORKER_MIN_UPTIME seconds of starting are restarted
+# with exponential backoff, and the server stops after WORKER_MAX_FAILURES in a row
+WORKER_MIN_UPTIME = float(os.environ.get("WORKER_MIN_UPTIME", 60))
+WORKER_MAX_FAILURES = int(os.environ.get("WORKER_MAX_FAILURES", 5))
+WORKER_MAX_RESTART_DELAY = 60
+
+# Update fields that carry the chat the update belongs to
+CHAT_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member", "chat_member", "chat_join_request")
+
+logger = logging.getLogger(__name__)
+
+webhook_updates = metrics.registry.counter("webhook_updates_total", "Updates received by the webhook server.")
+webhook_rejected = metrics.registry.counter("webhook_rejected_total", "Updates refused because a worker queue was full.")
+
+
+def chat_id_of(update):
+    """Return the chat of an update, or the user for updates without a chat."""
+    for field in CHAT_FIELDS:
+        if field in update:
+            return update[field]["chat"]["id"]
+    callback_query = update.get("callback_query")
+    if callback_query and callback_query.get("message"):
+        return callback_query["message"]["chat"]["id"]
+    # Inline queries and the like, a user's private chat has the user's id
+    for value in update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return None
+
+
+def route(chat_id, workers):
+    """Worker index of a chat, stable across processes and restarts."""
+    if chat_id is None:
+        return 0
+    return zlib.crc32(str(chat_id).encode("utf-8")) % workers
+
+
+def check_worker_count(workers):
+    """Record the worker count the Chroma directories belong to.
+
+    Returns False if they were created by another count. Directories
+    created before the count was recorded are counted.
+    """
+    if os.environ.get("STORAGE_BACKEND", "collections") == "mmap":
+        return True
+    root = os.environ.get("CHROMA_PERSIST_DIRECTORY", "db")
+    path = os.path.join(root, "webhook_workers")
+    if os.path.exists(path):
+        with open(path) as file:
+            recorded = int(file.read().strip())
+    else:
+        names = os.listdir(root) if os.path.isdir(root) else []
+        # A single process stores into the root itself
+        recorded = len([name for name in names if name.startswith("worker-")]) or (1 if names else workers)
+        os.makedirs(root, exist_ok=True)
+        with open(path, "w") as file:
+            file.write(str(recorded))
+
+    if recorded != workers:
+        logger.error(f"{root} holds the documents of {recorded} workers, set WEBHOOK_WORKERS={recorded}, "
+                     f"or move them to STORAGE_BACKEND=mmap with migrate_storage.py to run {workers}")
+        return False
+    return True
+
+
+def worker_environ(index, workers):
+    """Settings a worker overrides before it imports the bot."""
+    environ = {"RATE_LIMIT_WORKERS": str(workers)}
+    if metrics.METRICS_PORT:
+        environ["METRICS_PORT"] = str(metrics.METRICS_PORT + 1 + index)
+    if workers > 1:
+        directory = os.path.join(os.environ.get("CHROMA_PERSIST_DIRECTORY", "db"), f"worker-{index}")
+        environ["CHROMA_PERSIST_DIRECTORY"] = directory
+        environ["PERSIST_JOURNAL"] = os.path.join(directory, "journal.jsonl")
+    return environ
+
+
+@contextlib.contextmanager
+def _environ(overrides):
+    """Set environment variables for processes started inside the block."""
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _bot_module():
+    # Started as a script, the bot is already loaded as the main module
+    main = sys.modules.get("__mp_main__")
+    if main is not None and os.path.basename(getattr(main, "__file__", "") or "") == "telegram_bot.py":
+        sys.modules.setdefault("telegram_bot", main)
+    import telegram_bot
+    return telegram_bot
+
+
+async def _run_worker(index, updates):
+    from telegram import Update
+    from telegram.ext import Application
+
+    telegram_bot = _bot_module()
+    application = telegram_bot.build_application(Application.builder().token(TELEGRAM_BOT_TOKEN).updater(None))
+    loop = asyncio.get_running_loop()
+    logger.info(f"Worker {index} started")
+
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        try:
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                if data is None:
+                    break
+                try:
+                    update = Update.de_json(json.loads(data), application.bot)
+                except Exception as e:
+                    logger.error(f"Error decoding update: {e}")
+                    continue
+                await application.update_queue.put(update)
+        finally:
+            await application.stop()
+            await application.post_shutdown(application)
+
+
+def _worker(index, updates):
+    # The front server handles Ctrl-C and stops workers through their queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, updates))
+    logger.info(f"Worker {index} stopped")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != self.server.path:
+            self.send_error(404)
+            return
+        if WEBHOOK_SECRET_TOKEN and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET_TOKEN:
+            self.send_error(403)
+            return
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            update = json.loads(body)
+        except ValueError:
+            self.send_error(400)
+            return
+        # Telegram retries updates that were not answered with 200
+        self._reply(200 if self.server.front.dispatch(update, body) else 503)
+
+
+class WebhookServer():
+    """Receive updates over HTTP and queue each for the worker process of its chat.
+
+    Workers are separate processes running the bot without an updater. A
+    worker that dies is started again with the same queue, after a growing
+    delay if it keeps failing right after starting, and a full queue is
+    answered with 503 so Telegram delivers the update later.
+    """
+
+    def __init__(self, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=None):
+        self.workers = max(1, workers)
+        self.host = host
+        self.port = port
+        self.path = path or urlparse(WEBHOOK_URL or "").path or "/"
+
+        # Workers start from a fresh interpreter, not a fork of this process's threads
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue(maxsize=queue_size) for _ in range(self.workers)]
+        self.processes = [None] * self.workers
+        self._started_at = [0.0] * self.workers
+        self._failures = [0] * self.workers
+        self._restart_at = [None] * self.workers
+        self._httpd = None
+        self._stopped = threading.Event()
+
+    def _spawn(self, index):
+        process = self._context.Process(target=_worker, args=(index, self.queues[index]), name=f"worker-{index}", daemon=False)
+        with _environ(worker_environ(index, self.workers)):
+            process.start()
+        self._started_at[index] = time.monotonic()
+        return process
+
+    def start(self):
+        for index in range(self.workers):
+            self.processes[index] = self._spawn(index)
+
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.path = self.path
+        self._httpd.front = self
+        threading.Thread(target=self._httpd.serve_forever, name="webhook", daemon=True).start()
+        logger.info(f"Receiving updates on {self.host}:{self.port}{self.path} for {self.workers} workers")
+
+    def dispatch(self, update, body):
+        """Queue an update for its worker, returns False if the worker is backed up."""
+        index = route(chat_id_of(update), self.workers)
+        try:
+            self.queues[index].put(body, timeout=1)
+        except queue.Full:
+            webhook_rejected.inc(worker=index)
+            return False
+        webhook_updates.inc(worker=index)
+        return True
+
+    def stats(self):
+        return {f"worker_{index}_queued": updates.qsize() for index, updates in enumerate(self.queues)}
+
+    def supervise(self):
+        """Restart workers that exit until stop() is called.
+
+        Gives up and returns when a worker keeps failing right after it starts.
+        """
+        while not self._stopped.wait(1):
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                if self._restart_at[index] is None:
+                    # A worker that ran for a while failed for another reason than its start
+                    quick = now - self._started_at[index] < WORKER_MIN_UPTIME
+                    self._failures[index] = self._failures[index] + 1 if quick else 0
+                    if self._failures[index] >= WORKER_MAX_FAILURES:
+                        logger.error(f"Worker {index} exited {self._failures[index]} times in a row right after starting, stopping the server")
+                        self._stopped.set()
+                        return
+                    delay = min(WORKER_MAX_RESTART_DELAY, 2 ** self._failures[index] - 1)
+                    logger.warning(f"Worker {index} exited with code {process.exitcode}, restarting it in {delay}s")
+                    self._restart_at[index] = now + delay
+                if now >= self._restart_at[index]:
+                    self._restart_at[index] = None
+                    self.processes[index] = self._spawn(index)
+
+    def stop(self):
+        self._stopped.set()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+
+        # Workers handle what is already queued before the stop signal
+        for updates in self.queues:
+            try:
+                updates.put(None, timeout=WORKER_STOP_TIMEOUT)
+            except queue.Full:
+                pass
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop in time, terminating it")
+                process.terminate()
+                process.join()
+
+
+async def set_webhook():
+    """Point Telegram at WEBHOOK_URL."""
+    from telegram import Bot, Update
+
+    async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES)
+
+
+def serve(workers=WEBHOOK_WORKERS):
+    """Run the webhook server and its workers until interrupted."""
+    if not check_worker_count(max(1, workers)):
+        return
+    server = WebhookServer(workers=workers)
+    server.start()
+    metrics.registry.register_collector("webhook", server.stats)
+    metrics.start_server()
+
+    # SIGTERM stops the server like Ctrl-C does
+    signal.signal(signal.SIGTERM, lambda *_: server._stopped.set())
+    try:
+        asyncio.run(set_webhook())
+        server.supervise()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metrics.stop_server()
+        server.stop()